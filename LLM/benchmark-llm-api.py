@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+Load-testing and benchmark harness for the LLM API server
+Usage: python benchmark-llm-api.py [--profile transcript] [--concurrency 8] [--requests 64] [--output result.json]
+
+By default the server (main_optimized.py) runs in-process against a tiny
+random-weight Qwen2 model and a tokenizer trained on the spot, so the run
+needs no network and no model download. The numbers measure the serving
+stack (queueing, batching, prefill/decode scheduling), not model quality.
+Pass --url to benchmark a running server instead.
+
+The result is printed (or written with --output) as JSON. Pass --baseline
+with an earlier result to get a comparison and a non-zero exit code when
+latency or throughput regressed by more than --max-regression.
+"""
+
+import argparse
+import importlib
+import json
+import math
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+API_KEY = 'sk-demo123456789'
+
+# Length distributions (in tokens) are log-normal: `median` and `sigma`,
+# clipped to [min, max]. The transcript profile mirrors the map step of
+# /analyze/transcript: ~1500-token chunks and a few hundred tokens of findings.
+PROFILES = {
+    'transcript': {
+        'prompt_tokens': {'median': 1500, 'sigma': 0.35, 'min': 200, 'max': 2000},
+        'completion_tokens': {'median': 300, 'sigma': 0.5, 'min': 32, 'max': 1000},
+        'temperature': 0.3,
+    },
+    'chat': {
+        'prompt_tokens': {'median': 60, 'sigma': 0.8, 'min': 5, 'max': 500},
+        'completion_tokens': {'median': 150, 'sigma': 0.7, 'min': 16, 'max': 1000},
+        'temperature': 0.7,
+    },
+}
+
+# Stand-in model sizes; all use a Qwen2 architecture with random weights
+MODEL_SIZES = {
+    'tiny': {'hidden_size': 64, 'intermediate_size': 128, 'num_hidden_layers': 2,
+             'num_attention_heads': 4, 'num_key_value_heads': 2},
+    'small': {'hidden_size': 256, 'intermediate_size': 768, 'num_hidden_layers': 4,
+              'num_attention_heads': 8, 'num_key_value_heads': 2},
+}
+
+INSTRUCTIONS = 'Analyse this lesson transcript. List the questioning techniques the teacher used and how students responded.'
+
+TRANSCRIPT_LINES = [
+    "Teacher: Good morning everyone, let's start with a quick recap of yesterday's lesson on fractions.",
+    'Teacher: Who can tell me what the denominator tells us?',
+    "Student: It's how many equal parts the whole is split into.",
+    'Teacher: Exactly. Now turn to your partner and explain why three quarters is bigger than two thirds.',
+    'Student: Because if you draw them, the three quarters bar goes further along.',
+    'Teacher: Interesting. Can anyone build on that? What could we do to be sure?',
+    'Student: We could change them so they have the same denominator, like twelfths.',
+    "Teacher: Let's try that together on the board. Nine twelfths and eight twelfths, which is larger?",
+    "Teacher: I'm going to wait a few seconds before I take answers, so everyone has time to think.",
+    'Student: Nine twelfths, so three quarters is bigger.',
+    "Teacher: Well done. Thumbs up if you agree, thumbs sideways if you're not sure.",
+    'Teacher: Right, open your books to page forty two and try questions one to five on your own.',
+    'Student: Miss, do we need to simplify the answers?',
+    'Teacher: Yes please, always give the answer in its simplest form. Check with your neighbour when you finish.',
+    "Teacher: Let's hear from someone who hasn't answered yet today. Jamie, what did you get for question three?",
+    "Student: I got five sixths but I'm not sure if that's right.",
+    "Teacher: Talk us through how you got there, there's no wrong answer in explaining your thinking.",
+]
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}"
+    '{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}'
+)
+
+
+def build_stand_in_model(model_dir, size, seed):
+    """Save a random-weight Qwen2 model and a locally trained BPE tokenizer
+    to `model_dir`, so the server loads it through its normal code path."""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+    backend = Tokenizer(models.BPE())
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=2000,
+        special_tokens=['<|endoftext|>', '<|im_start|>', '<|im_end|>'],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    backend.train_from_iterator(TRANSCRIPT_LINES + [INSTRUCTIONS], trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, eos_token='<|im_end|>', pad_token='<|endoftext|>')
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    model_config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        max_position_embeddings=8192,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        tie_word_embeddings=True,
+        **MODEL_SIZES[size],
+    )
+    Qwen2ForCausalLM(model_config).save_pretrained(model_dir)
+    return tokenizer
+
+
+def http_request(url, payload=None, headers=None, timeout=60):
+    """Open a GET (or, with `payload`, a JSON POST) request. Returns the
+    response, which is also returned for HTTP error statuses; raises
+    OSError when the server can't be reached."""
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    request = urllib.request.Request(url, data=data, headers=dict(headers or {}, **{'Content-Type': 'application/json'}))
+    try:
+        return urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        return e
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_in_process_server(model_dir, server_config, timeout):
+    """Import main_optimized.py with a generated config.json and serve it on
+    a local port from a background thread. Returns the base URL."""
+    import uvicorn
+
+    work_dir = tempfile.mkdtemp(prefix='llm-bench-')
+    config = {
+        'api_keys': [API_KEY],
+        'users': {},
+        'model_name': model_dir,
+        'max_tokens': 2048,
+        'temperature': 0.7,
+        # Measure generation, not cache hits, unless asked otherwise
+        'response_cache_size': 0,
+    }
+    config.update(server_config)
+    with open(os.path.join(work_dir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+    # The server reads config.json (and the response cache) from the working directory
+    os.chdir(work_dir)
+    # Imported by name so worker processes (config "workers" > 1) can import it too
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    server = importlib.import_module('main_optimized')
+    if config.get('engine', 'transformers') != 'transformers' and not config.get('model_artifact_dir'):
+        # Other engines serve from a prepared artifact; build one for the model first
+        config['model_artifact_dir'] = os.path.join(work_dir, 'artifact')
+        server.prepare_artifact(config['model_artifact_dir'], config.get('precision', 'float32'))
+        server.config['model_artifact_dir'] = config['model_artifact_dir']
+        with open(os.path.join(work_dir, 'config.json'), 'w') as f:
+            json.dump(config, f, indent=2)
+
+    port = _free_port()
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=uvicorn_server.run, name='benchmark-server', daemon=True).start()
+    base_url = f'http://127.0.0.1:{port}'
+    wait_until_ready(base_url, timeout)
+    return base_url
+
+
+def wait_until_ready(base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with http_request(f'{base_url}/health/ready', timeout=5) as response:
+                if response.status == 200:
+                    return
+                body = json.load(response)
+            if body.get('status') == 'failed':
+                raise RuntimeError(f"Model failed to load: {body.get('error')}")
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Server at {base_url} was not ready after {timeout}s')
+
+
+def sample_length(rng, spec):
+    value = rng.lognormvariate(math.log(spec['median']), spec['sigma'])
+    return int(min(max(value, spec['min']), spec['max']))
+
+
+def make_prompt(rng, target_tokens, count_tokens):
+    """Build a transcript-style prompt of roughly `target_tokens` tokens."""
+    lines = [INSTRUCTIONS, '', 'Transcript:']
+    while count_tokens('\n'.join(lines)) < target_tokens:
+        lines.append(rng.choice(TRANSCRIPT_LINES))
+    return '\n'.join(lines)
+
+
+def make_workload(args, profile, count_tokens):
+    rng = random.Random(args.seed)
+    workload = []
+    for _ in range(args.warmup_requests + args.requests):
+        workload.append({
+            'message': make_prompt(rng, sample_length(rng, profile['prompt_tokens']), count_tokens),
+            'max_tokens': sample_length(rng, profile['completion_tokens']),
+            'temperature': profile['temperature'],
+            'cache': False,
+        })
+    return workload
+
+
+def run_request(base_url, endpoint, payload, timeout):
+    """Send one request and return its client-side measurements."""
+    headers = {'Authorization': f'Bearer {API_KEY}'}
+    started = time.perf_counter()
+    sample = {'ok': False, 'latency': None, 'ttft': None, 'prompt_tokens': None, 'completion_tokens': None}
+    try:
+        if endpoint == 'stream':
+            with http_request(f'{base_url}/chat/stream', payload, headers, timeout) as response:
+                if response.status != 200:
+                    sample['error'] = f"{response.status}: {response.read(200).decode('utf-8', 'replace')}"
+                    return sample
+                for line in response:
+                    line = line.decode('utf-8').strip()
+                    if not line.startswith('data: '):
+                        continue
+                    event = json.loads(line[len('data: '):])
+                    if event['type'] == 'token' and sample['ttft'] is None:
+                        sample['ttft'] = time.perf_counter() - started
+                    elif event['type'] == 'error':
+                        sample['error'] = event['detail']
+                        return sample
+                    elif event['type'] == 'done':
+                        sample.update(event['usage'])
+                        sample['finish_reason'] = event['finish_reason']
+        else:
+            with http_request(f'{base_url}/chat', dict(payload, include_timing=True), headers, timeout) as response:
+                if response.status != 200:
+                    sample['error'] = f"{response.status}: {response.read(200).decode('utf-8', 'replace')}"
+                    return sample
+                result = json.load(response)
+            sample['ttft'] = (result.get('timing') or {}).get('time_to_first_token')
+            sample['prompt_tokens'] = result['prompt_tokens']
+            sample['completion_tokens'] = result['completion_tokens']
+            sample['finish_reason'] = result['finish_reason']
+        sample['ok'] = True
+    except (OSError, ValueError) as e:
+        sample['error'] = str(e)
+    finally:
+        sample['latency'] = time.perf_counter() - started
+    return sample
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+    return {
+        'p50': round(pick(0.50), 4),
+        'p95': round(pick(0.95), 4),
+        'p99': round(pick(0.99), 4),
+        'mean': round(statistics.fmean(ordered), 4),
+        'max': round(ordered[-1], 4),
+    }
+
+
+def summarise(samples, duration):
+    ok = [s for s in samples if s['ok']]
+    completion_tokens = sum(s['completion_tokens'] or 0 for s in ok)
+    prompt_tokens = sum(s['prompt_tokens'] or 0 for s in ok)
+    per_request_rate = [
+        (s['completion_tokens'] - 1) / (s['latency'] - s['ttft'])
+        for s in ok
+        if s['completion_tokens'] and s['ttft'] is not None and s['latency'] > s['ttft']
+    ]
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'duration_seconds': round(duration, 3),
+        'requests_per_second': round(len(ok) / duration, 3) if duration else None,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'output_tokens_per_second': round(completion_tokens / duration, 2) if duration else None,
+        'total_tokens_per_second': round((prompt_tokens + completion_tokens) / duration, 2) if duration else None,
+        'latency_seconds': percentiles([s['latency'] for s in ok]),
+        'time_to_first_token_seconds': percentiles([s['ttft'] for s in ok if s['ttft'] is not None]),
+        'decode_tokens_per_second': percentiles(per_request_rate),
+        'finish_reasons': {
+            reason: sum(1 for s in ok if s.get('finish_reason') == reason)
+            for reason in sorted({s.get('finish_reason') for s in ok if s.get('finish_reason')})
+        },
+        'sample_errors': sorted({s['error'] for s in samples if s.get('error')})[:5],
+    }
+
+
+def compare(summary, baseline, max_regression):
+    """Relative change of the headline numbers against a previous run.
+    Returns (comparison, regressed)."""
+    checks = [
+        # (name, current, baseline, higher_is_better)
+        ('latency_p50', (summary['latency_seconds'] or {}).get('p50'), (baseline['latency_seconds'] or {}).get('p50'), False),
+        ('latency_p95', (summary['latency_seconds'] or {}).get('p95'), (baseline['latency_seconds'] or {}).get('p95'), False),
+        ('latency_p99', (summary['latency_seconds'] or {}).get('p99'), (baseline['latency_seconds'] or {}).get('p99'), False),
+        ('ttft_p95', (summary['time_to_first_token_seconds'] or {}).get('p95'),
+         (baseline['time_to_first_token_seconds'] or {}).get('p95'), False),
+        ('output_tokens_per_second', summary['output_tokens_per_second'], baseline['output_tokens_per_second'], True),
+        ('requests_per_second', summary['requests_per_second'], baseline['requests_per_second'], True),
+    ]
+    comparison, regressed = {}, False
+    for name, current, previous, higher_is_better in checks:
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        comparison[name] = {'current': current, 'baseline': previous, 'change': round(change, 4),
+                            'regressed': worse > max_regression}
+        regressed = regressed or worse > max_regression
+    return comparison, regressed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the LLM API server')
+    parser.add_argument('--url', help='Benchmark a running server (e.g. http://13.41.224.218:8000) instead of an in-process one')
+    parser.add_argument('--model-dir', help='Local model directory for the in-process server instead of the random stand-in')
+    parser.add_argument('--model-size', choices=sorted(MODEL_SIZES), default='tiny', help='Size of the random stand-in model')
+    parser.add_argument('--server-config', default='{}',
+                        help="JSON object merged into the in-process server's config.json, e.g. '{\"max_batch_size\": 16}'")
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='transcript')
+    parser.add_argument('--prompt-tokens', type=int, help="Override the profile's median prompt length")
+    parser.add_argument('--completion-tokens', type=int, help="Override the profile's median completion length")
+    parser.add_argument('--temperature', type=float, help="Override the profile's temperature")
+    parser.add_argument('--endpoint', choices=['stream', 'chat'], default='stream',
+                        help='stream measures time to first token on the client; chat uses the server-reported value')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of requests kept in flight')
+    parser.add_argument('--requests', type=int, default=64, help='Number of measured requests')
+    parser.add_argument('--warmup-requests', type=int, default=4, help='Requests sent before measuring')
+    parser.add_argument('--request-timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON result to this file instead of stdout')
+    parser.add_argument('--baseline', help='Earlier JSON result to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='Relative slowdown tolerated before --baseline comparison fails (default: 0.1)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # The in-process server changes the working directory
+    for name in ('output', 'baseline', 'model_dir'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    profile = json.loads(json.dumps(PROFILES[args.profile]))
+    if args.prompt_tokens:
+        profile['prompt_tokens'].update(median=args.prompt_tokens, max=max(profile['prompt_tokens']['max'], args.prompt_tokens))
+    if args.completion_tokens:
+        profile['completion_tokens'].update(
+            median=args.completion_tokens, max=max(profile['completion_tokens']['max'], args.completion_tokens))
+    if args.temperature is not None:
+        profile['temperature'] = args.temperature
+
+    # Server logs go to stderr so stdout only carries the JSON result
+    result_stream, sys.stdout = sys.stdout, sys.stderr
+    tokenizer = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        wait_until_ready(base_url, args.request_timeout)
+    else:
+        model_dir = args.model_dir
+        if model_dir:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        else:
+            model_dir = tempfile.mkdtemp(prefix='llm-bench-model-')
+            print(f'Building {args.model_size} stand-in model in {model_dir}', file=sys.stderr)
+            tokenizer = build_stand_in_model(model_dir, args.model_size, args.seed)
+        base_url = start_in_process_server(model_dir, json.loads(args.server_config), args.request_timeout)
+
+    if tokenizer is not None:
+        count_tokens = lambda text: len(tokenizer(text).input_ids)
+    else:
+        # Without the server's tokenizer, assume ~4 characters per token
+        count_tokens = lambda text: len(text) // 4
+
+    workload = make_workload(args, profile, count_tokens)
+    warmup, measured = workload[:args.warmup_requests], workload[args.warmup_requests:]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda payload: run_request(base_url, args.endpoint, payload, args.request_timeout), warmup))
+        print(f'Sending {len(measured)} requests with concurrency {args.concurrency} to {base_url}', file=sys.stderr)
+        started = time.perf_counter()
+        samples = list(pool.map(lambda payload: run_request(base_url, args.endpoint, payload, args.request_timeout),
+                                measured))
+        duration = time.perf_counter() - started
+
+    try:
+        with http_request(f'{base_url}/health', timeout=10) as response:
+            server = json.load(response)
+    except (OSError, ValueError):
+        server = {}
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'target': args.url or f"in-process ({args.model_dir or args.model_size + ' stand-in model'})",
+        'endpoint': args.endpoint,
+        'concurrency': args.concurrency,
+        'profile': dict(profile, name=args.profile),
+        'server_config': json.loads(args.server_config) if not args.url else None,
+        'summary': summarise(samples, duration),
+        'server': {
+            'engine': (server.get('model_state') or {}).get('engine'),
+            'precision': server.get('precision'),
+            'scheduler': server.get('scheduler'),
+            'memory': server.get('memory'),
+        },
+    }
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        result['comparison'], regressed = compare(result['summary'], baseline['summary'], args.max_regression)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f'Wrote {args.output}', file=sys.stderr)
+    else:
+        print(output, file=result_stream)
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
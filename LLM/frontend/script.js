@@ -3,6 +3,7 @@ let authToken = null;
 let isModelReady = false;
 let authMethod = 'apikey'; // 'apikey' or 'jwt'
 let userInfo = '';
+let sessionId = null; // Server-side conversation, so follow-ups don't resend the history
 
 // API Base URL
 const API_BASE = window.location.origin;
@@ -87,6 +88,15 @@ function addMessage(content, isUser = false, isLoading = false) {
     return messageDiv;
 }
 
+function updateMessage(messageElement, content) {
+    messageElement.innerHTML = `
+        <div class="message-content">
+            ${content.replace(/\n/g, '<br>')}
+        </div>
+    `;
+    scrollToBottom();
+}
+
 function removeMessage(messageElement) {
     if (messageElement && messageElement.parentNode) {
         messageElement.parentNode.removeChild(messageElement);
@@ -117,10 +127,57 @@ async function makeRequest(endpoint, options = {}) {
     return response.json();
 }
 
+// Read a server-sent events response, calling onEvent for each JSON event
+async function makeStreamRequest(endpoint, options = {}, onEvent) {
+    const headers = {
+        'Content-Type': 'application/json',
+        'Accept': 'text/event-stream',
+        ...options.headers
+    };
+    
+    if (authToken) {
+        headers['Authorization'] = `Bearer ${authToken}`;
+    }
+    
+    const response = await fetch(`${API_BASE}${endpoint}`, {
+        ...options,
+        headers
+    });
+    
+    if (!response.ok) {
+        const error = await response.json().catch(() => ({ detail: 'Unknown error' }));
+        throw new Error(error.detail || `HTTP ${response.status}`);
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const data = rawEvent
+                .split('\n')
+                .filter(line => line.startsWith('data: '))
+                .map(line => line.slice(6))
+                .join('\n');
+            if (data) {
+                onEvent(JSON.parse(data));
+            }
+        }
+    }
+}
+
 async function checkModelStatus() {
     try {
         const health = await makeRequest('/health');
-        if (health.model_loaded) {
+        if (health.ready) {
             isModelReady = true;
             modelStatus.textContent = 'Model Ready';
             modelStatus.className = 'status-badge ready';
@@ -128,7 +185,8 @@ async function checkModelStatus() {
             sendBtn.disabled = false;
             messageInput.placeholder = 'Type your message here...';
         } else {
-            modelStatus.textContent = 'Model Loading...';
+            const progress = health.model_state ? Math.round(health.model_state.progress * 100) : 0;
+            modelStatus.textContent = `Model Loading... ${progress}%`;
             modelStatus.className = 'status-badge loading';
             messageInput.disabled = true;
             sendBtn.disabled = true;
@@ -190,18 +248,49 @@ async function loginWithCredentials(username, password) {
     }
 }
 
-async function sendMessage(message, maxTokens, temperature) {
+async function startSession() {
+    const session = await makeRequest('/sessions', { method: 'POST', body: JSON.stringify({}) });
+    sessionId = session.session_id;
+}
+
+async function sendMessage(message, maxTokens, temperature, onText) {
     try {
-        const response = await makeRequest('/chat', {
+        let text = '';
+        let usage = null;
+        
+        if (!sessionId) {
+            await startSession();
+        }
+        const streamTurn = () => makeStreamRequest(`/sessions/${sessionId}/messages/stream`, {
             method: 'POST',
             body: JSON.stringify({
                 message: message,
                 max_tokens: parseInt(maxTokens),
                 temperature: parseFloat(temperature)
             })
+        }, (event) => {
+            if (event.type === 'token') {
+                text += event.text;
+                onText(text);
+            } else if (event.type === 'done') {
+                usage = event.usage;
+            } else if (event.type === 'error') {
+                throw new Error(event.detail);
+            }
         });
         
-        return response.response;
+        try {
+            await streamTurn();
+        } catch (error) {
+            if (!error.message.includes('Session not found')) {
+                throw error;
+            }
+            // The session expired while idle; continue in a new one
+            await startSession();
+            await streamTurn();
+        }
+        
+        return { text: text.trim(), usage };
     } catch (error) {
         throw new Error(`Chat error: ${error.message}`);
     }
@@ -282,6 +371,10 @@ usernameForm.addEventListener('submit', async (e) => {
 });
 
 logoutBtn.addEventListener('click', () => {
+    if (sessionId) {
+        makeRequest(`/sessions/${sessionId}`, { method: 'DELETE' }).catch(() => {});
+        sessionId = null;
+    }
     authToken = null;
     userInfo = '';
     isModelReady = false;
@@ -321,10 +414,24 @@ chatForm.addEventListener('submit', async (e) => {
     messageInput.disabled = true;
     sendBtn.disabled = true;
     
+    // Replace the loading indicator with the reply as soon as the first token arrives
+    let replyMessage = null;
+    
     try {
-        const response = await sendMessage(message, maxTokens, temperature);
+        const { text } = await sendMessage(message, maxTokens, temperature, (partial) => {
+            if (!replyMessage) {
+                removeMessage(loadingMessage);
+                replyMessage = addMessage(partial, false);
+            } else {
+                updateMessage(replyMessage, partial);
+            }
+        });
         removeMessage(loadingMessage);
-        addMessage(response, false);
+        if (replyMessage) {
+            updateMessage(replyMessage, text);
+        } else {
+            addMessage(text, false);
+        }
     } catch (error) {
         removeMessage(loadingMessage);
         addMessage(`❌ Error: ${error.message}`, false);
@@ -1,17 +1,43 @@
 import os
 import json
+import argparse
+import shutil
 import gc
-from datetime import datetime, timedelta
-from typing import Optional
+import time
+import asyncio
+import threading
+import multiprocessing
+import platform
+import queue
+import collections
+import contextlib
+import copy
+import functools
+import inspect
+import hashlib
+import re
+import sqlite3
+import urllib.parse
+import urllib.request
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Union
+import numpy as np
 import uvicorn
 from fastapi import FastAPI, HTTPException, Depends, status, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoConfig, AutoModel, AutoModelForCausalLM, AutoTokenizer, DynamicCache, GenerationConfig, LogitsProcessor
+try:
+    from transformers.cache_utils import DynamicLayer
+except ImportError:  # transformers < 4.56 keeps DynamicCache as plain per-layer lists
+    DynamicLayer = None
 from jose import JWTError, jwt
 import bcrypt
 
@@ -48,6 +74,49 @@ class ChatMessage(BaseModel):
     message: str
     max_tokens: Optional[int] = 1000
     temperature: Optional[float] = 0.7
+    stop: Optional[List[str]] = None
+    timeout: Optional[float] = Field(None, gt=0)  # Seconds, capped by config['request_timeout']
+    cache: Optional[bool] = None  # None: cache low-temperature requests only
+    include_timing: Optional[bool] = False  # Add per-stage latencies to the response
+    response_format: Optional[dict] = None  # {'type': 'json_object'} or {'type': 'json_schema', 'json_schema': {'schema': ...}}
+
+class BatchChatItem(BaseModel):
+    message: str
+    max_tokens: Optional[int] = 1000
+    temperature: Optional[float] = 0.7
+    stop: Optional[List[str]] = None
+    timeout: Optional[float] = Field(None, gt=0)
+
+class BatchChatRequest(BaseModel):
+    items: List[BatchChatItem]
+
+class BatchChatResult(BaseModel):
+    index: int
+    response: Optional[str] = None
+    error: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    finish_reason: Optional[str] = None
+
+class BatchChatResponse(BaseModel):
+    results: List[BatchChatResult]
+    timestamp: str
+    model: str
+
+class TranscriptAnalysisRequest(BaseModel):
+    transcript: str
+    instructions: str
+    max_tokens: Optional[int] = 1000  # Budget for the final merged analysis
+    chunk_max_tokens: Optional[int] = 400  # Budget for each chunk's findings
+    temperature: Optional[float] = 0.3
+    chunk_tokens: Optional[int] = None
+    overlap_tokens: Optional[int] = None
+
+class TranscriptAnalysisResponse(BaseModel):
+    response: str
+    chunks: int
+    timestamp: str
+    model: str
 
 class LoginRequest(BaseModel):
     username: str
@@ -57,100 +126,3795 @@ class ChatResponse(BaseModel):
     response: str
     timestamp: str
     model: str
+    cached: bool = False
+    finish_reason: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    timing: Optional[dict] = None
+
+class SessionCreateRequest(BaseModel):
+    system_prompt: Optional[str] = None
+
+class SessionInfo(BaseModel):
+    session_id: str
+    created_at: str
+    last_used_at: str
+    turns: int
+    kv_cached_tokens: int
+    idle_timeout: int
+    messages: List[dict] = []
+
+class SessionMessage(BaseModel):
+    message: str
+    max_tokens: Optional[int] = 1000
+    temperature: Optional[float] = 0.7
+    stop: Optional[List[str]] = None
+    timeout: Optional[float] = Field(None, gt=0)
+    include_timing: Optional[bool] = False
+
+class SessionChatResponse(BaseModel):
+    response: str
+    timestamp: str
+    model: str
+    session_id: str
+    finish_reason: Optional[str] = None
+    prompt_tokens: int
+    reused_tokens: int  # Prompt tokens served from the session's KV cache
+    completion_tokens: int
+    timing: Optional[dict] = None
+
+class JobSubmitRequest(BaseModel):
+    type: str = 'transcript'  # 'chat' or 'transcript'
+    request: dict  # Body of the matching /chat or /analyze/transcript call
+    priority: Optional[int] = 0  # Higher runs first
+    callback_url: Optional[str] = None  # Local URL that receives the job info when it finishes
+
+class JobInfo(BaseModel):
+    job_id: str
+    type: str
+    status: str  # queued, running, completed, failed or cancelled
+    priority: int
+    attempts: int
+    position: Optional[int] = None  # Queued jobs that will run before this one
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    error: Optional[str] = None
+    result: Optional[dict] = None
+
+class EmbeddingRequest(BaseModel):
+    input: Union[str, List[str]]
+
+class EmbeddingResponse(BaseModel):
+    data: List[List[float]]  # One unit-length vector per input, in order
+    model: str
+    dimensions: int
+    prompt_tokens: int
+
+class VectorItem(BaseModel):
+    id: str
+    text: Optional[str] = None  # Embedded like /embeddings when no embedding is given
+    embedding: Optional[List[float]] = None
+    metadata: Optional[dict] = None
+
+class VectorAddRequest(BaseModel):
+    items: List[VectorItem]
+
+class VectorSearchRequest(BaseModel):
+    text: Optional[str] = None
+    embedding: Optional[List[float]] = None
+    top_k: Optional[int] = 5
+
+class VectorMatch(BaseModel):
+    id: str
+    score: float  # Cosine similarity
+    metadata: Optional[dict] = None
+
+class VectorSearchResponse(BaseModel):
+    matches: List[VectorMatch]
+    search_ms: float
+
+class VectorIndexInfo(BaseModel):
+    name: str
+    count: int
+    dimensions: Optional[int] = None
+    model: Optional[str] = None
+    added: Optional[int] = None
+    updated: Optional[int] = None
+
+class LoginResponse(BaseModel):
+    access_token: str
+    token_type: str
+    expires_in: int
+
+# App setup
+app = FastAPI(title='Qwen2.5 7B API', description='Secure LLM API with authentication')
+security = HTTPBearer()
+model = None
+model_config = None
+tokenizer = None
+scheduler = None
+config = load_config()
+response_cache = None
+session_store = None
+job_queue = None
+rate_limiter = None
+vector_store = None
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=['*'],
+    allow_credentials=True,
+    allow_methods=['*'],
+    allow_headers=['*'],
+)
+
+# Static files setup
+if os.path.exists('frontend'):
+    app.mount('/static', StaticFiles(directory='frontend'), name='static')
+
+# Model loading with memory optimization
+#
+# The model is loaded once, eagerly at startup (see the startup hook), on a
+# background thread so liveness probes answer immediately. `_model_lock`
+# makes loading single-flight: concurrent callers wait for the one load in
+# progress instead of starting their own. `model_state` backs /health/ready.
+_model_lock = threading.Lock()
+model_state = {
+    'status': 'not_loaded',
+    'stage': None,
+    'progress': 0.0,
+    'load_seconds': None,
+    'warmup_seconds': None,
+    'precision': None,
+    'effective_precision': None,
+    'engine': None,
+    'artifact': None,
+    'error': None
+}
+
+def _set_stage(stage, progress, status='loading'):
+    model_state.update({'status': status, 'stage': stage, 'progress': progress})
+
+def load_model_sync():
+    global model, tokenizer, scheduler, model_config
+    with _model_lock:
+        if model_state['status'] == 'ready':
+            return
+        print('Loading Qwen2.5 7B model with memory optimizations...')
+        started = time.monotonic()
+        model_state['error'] = None
+        try:
+            # Force garbage collection before loading
+            gc.collect()
+            torch.cuda.empty_cache() if torch.cuda.is_available() else None
+            
+            engine = config.get('engine', 'transformers')
+            model_state.update({
+                'engine': engine,
+                'artifact': config.get('model_artifact_dir'),
+                'precision': config.get('precision', 'float32')
+            })
+            _apply_thread_settings()
+            # Prepared weights for the transformers engine; other engines find their own files
+            artifact = _artifact_file(ARTIFACT_WEIGHTS) if engine == 'transformers' else None
+            print('Loading tokenizer...')
+            _set_stage('tokenizer', 0.05)
+            tokenizer = AutoTokenizer.from_pretrained(_model_source())
+            
+            if config.get('workers', 1) > 1:
+                # Worker processes map the shared weights and run their own
+                # schedulers; this process only routes requests to them
+                _set_stage('weights', 0.1)
+                weights_path = artifact
+                if engine == 'transformers' and not weights_path:
+                    weights_path = _export_shared_weights(config.get('precision', 'float32'))
+                model_config = AutoConfig.from_pretrained(_model_source(), trust_remote_code=True)
+                _set_stage('workers', 0.5)
+                scheduler = WorkerPool(config['workers'], weights_path, _memory_budget_bytes())
+                scheduler.start()
+                model_state['load_seconds'] = round(time.monotonic() - started, 2)
+                MODEL_LOAD_SECONDS.set(model_state['load_seconds'])
+                print(f'{config["workers"]} workers ready in {model_state["load_seconds"]}s')
+                _set_stage('ready', 1.0, status='ready')
+                MODEL_READY.set(1)
+                return
+            
+            print('Loading model with optimized settings...')
+            _set_stage('weights', 0.1)
+            # With a prepared artifact the pre-converted weights are mapped, no Hub access
+            model = _load_backend(config.get('precision', 'float32'), artifact)
+            model_config = model.config
+            model_state['effective_precision'] = model.precision
+            
+            # Force garbage collection after loading
+            gc.collect()
+            
+            model_state['load_seconds'] = round(time.monotonic() - started, 2)
+            MODEL_LOAD_SECONDS.set(model_state['load_seconds'])
+            print(f'Model loaded successfully with {engine} in {model_state["load_seconds"]}s'
+                  f'{" from " + config["model_artifact_dir"] if config.get("model_artifact_dir") else ""}!')
+            if hasattr(model, 'num_parameters'):
+                print(f'Model parameters: {model.num_parameters():,}')
+
+            _set_stage('scheduler', 0.8)
+            scheduler = _start_scheduler(model, _memory_budget_bytes(), draft_model=_load_draft_model())
+
+            _set_stage('warmup', 0.9, status='warming_up')
+            warmup_model()
+            _set_stage('ready', 1.0, status='ready')
+            MODEL_READY.set(1)
+            
+        except Exception as e:
+            print(f'Error loading model: {e}')
+            # Clean up on error so the next caller retries from scratch
+            if isinstance(scheduler, WorkerPool):
+                scheduler.stop()
+            model, tokenizer, scheduler, model_config = None, None, None, None
+            model_state.update({'status': 'failed', 'error': str(e)})
+            gc.collect()
+            raise
+
+def _memory_budget_bytes():
+    memory_budget_mb = config.get('memory_budget_mb')
+    return memory_budget_mb * 1024 * 1024 if memory_budget_mb else int(0.85 * (_total_memory_bytes() or 0))
+
+def _start_scheduler(model, budget_bytes, draft_model=None):
+    """Create and start the inference scheduler (and its memory governor) for `model`."""
+    _check_kv_cache_config()
+    prefix_cache_mb = config.get('prefix_cache_mb', 1024)
+    started = InferenceScheduler(
+        model,
+        max_batch_size=config.get('max_batch_size', 8),
+        max_queue_size=config.get('max_queue_size', 64),
+        prefix_cache=PrefixCache(
+            prefix_cache_mb * 1024 * 1024,
+            block_size=config.get('prefix_cache_block_size', 64)
+        ) if prefix_cache_mb > 0 else None,
+        prefill_max_tokens=config.get('prefill_max_tokens', 8192),
+        draft_model=draft_model,
+        speculative_tokens=config.get('speculative_tokens', 4),
+        min_acceptance_rate=config.get('min_acceptance_rate', 0.5),
+        speculative_window=config.get('speculative_window', 64),
+        speculative_cooldown=config.get('speculative_cooldown', 256),
+        window_tokens=config.get('kv_window_tokens', 0),
+        sink_tokens=config.get('kv_sink_tokens', 4),
+        bulk_batch_share=config.get('bulk_batch_share', 0.75)
+    )
+    if budget_bytes:
+        started.memory = MemoryGovernor(
+            model,
+            budget_bytes,
+            min_new_tokens=config.get('min_new_tokens', 64),
+            gc_threshold=config.get('gc_threshold', 0.9),
+            prefix_cache=started.prefix_cache,
+            max_cached_tokens=started.max_cached_tokens
+        )
+    started.start()
+    return started
+
+# Supported values of config['precision']
+PRECISIONS = ('float32', 'bfloat16', 'int8', 'int4')
+
+def _load_weights(precision, model_name=None):
+    """Load the model in the requested precision.
+
+    float32 and bfloat16 load the weights directly in that dtype. int8 applies
+    PyTorch dynamic quantization to every nn.Linear (int8 weights, activations
+    quantized on the fly). int4 uses optimum-quanto weight-only quantization
+    when it is installed and falls back to int8 otherwise. Returns the model
+    and the precision it was loaded in.
+    """
+    loaded = _from_pretrained(model_name or config['model_name'], _base_dtype(precision))
+    loaded.eval()
+    return _quantize(loaded, precision)
+
+def _from_pretrained(model_name, dtype):
+    return AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=dtype,
+        device_map='cpu',
+        trust_remote_code=True,
+        low_cpu_mem_usage=True  # Enable memory optimization
+    )
+
+def _load_draft_model():
+    """Load config['draft_model_name'] for speculative decoding, if set. The
+    draft must share the main model's tokenizer. With a prepared artifact the
+    draft comes from the artifact too, so startup stays offline."""
+    model_name = config.get('draft_model_name')
+    if not model_name:
+        return None
+    directory = config.get('model_artifact_dir')
+    if directory:
+        with open(os.path.join(directory, ARTIFACT_MANIFEST)) as f:
+            prepared = json.load(f).get('draft_model_name')
+        if prepared != model_name:
+            raise RuntimeError(f'{directory} was prepared without draft model {model_name}; rerun: '
+                               f'python main_optimized.py prepare with draft_model_name set in {CONFIG_FILE}')
+        model_name = os.path.join(directory, ARTIFACT_DRAFT)
+    print(f'Loading draft model {model_name}...')
+    _set_stage('draft_model', 0.75)
+    return TransformersBackend.load(config.get('precision', 'float32'), model_name=model_name)
+
+def _base_dtype(precision):
+    """The floating point dtype weights are loaded in before any quantization."""
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unsupported precision {precision!r}, expected one of {", ".join(PRECISIONS)}')
+    return torch.bfloat16 if precision in ('bfloat16', 'int4') else torch.float32
+
+def _quantize(loaded, precision):
+    """Apply int8 / int4 quantization; returns the model and the precision it ended up in."""
+    if precision == 'int4':
+        try:
+            from optimum.quanto import quantize, freeze, qint4
+        except ImportError:
+            print('optimum-quanto is not installed, falling back to int8 dynamic quantization')
+            precision = 'int8'
+            loaded = loaded.float()
+        else:
+            _set_stage('quantize', 0.7)
+            quantize(loaded, weights=qint4)
+            freeze(loaded)
+    if precision == 'int8':
+        _set_stage('quantize', 0.7)
+        loaded = torch.ao.quantization.quantize_dynamic(loaded, {torch.nn.Linear}, dtype=torch.qint8)
+    return loaded, precision
+
+# Inference backends
+#
+# The scheduler drives the model through an InferenceBackend, selected with
+# config['engine']. prefill and decode_step run one forward pass over a
+# batch and return (logits, cache): logits for every input position and the
+# grown KV cache. Whatever the engine, caches are DynamicCache objects of
+# per-layer (batch, kv_heads, sequence, head_dim) key / value tensors, so
+# batching, the prefix cache and sessions work the same way on all of them.
+
+class InferenceBackend:
+    """An inference engine the scheduler can drive.
+
+    generate and stream are a plain single-sequence greedy loop over
+    prefill and decode_step, for use outside the scheduler (checks and
+    benchmarks); request traffic always goes through the scheduler.
+    """
+
+    name = None
+
+    def __init__(self, model_config, generation_config, dtype, precision=None):
+        self.config = model_config
+        self.generation_config = generation_config
+        self.dtype = dtype
+        # The precision actually served, which can differ from the requested one
+        self.precision = precision
+
+    @classmethod
+    def load(cls, precision, weights_path=None):
+        raise NotImplementedError
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None):
+        raise NotImplementedError
+
+    def prefill(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None):
+        """Run prompt tokens (those after any cached prefix) through the model."""
+        return self.forward(input_ids, attention_mask, position_ids, past_key_values)
+
+    def decode_step(self, input_ids, attention_mask, position_ids, past_key_values):
+        """Run the newest token of every row (or several, when verifying draft tokens)."""
+        return self.forward(input_ids, attention_mask, position_ids, past_key_values)
+
+    def stream(self, prompt_ids, max_new_tokens, eos_token_ids=()):
+        """Yield greedily decoded token ids for one sequence."""
+        logits, cache = self.prefill(torch.tensor([prompt_ids], dtype=torch.long), past_key_values=DynamicCache())
+        for _ in range(max_new_tokens):
+            token = int(logits[0, -1].argmax())
+            yield token
+            if token in eos_token_ids:
+                return
+            logits, cache = self.decode_step(torch.tensor([[token]], dtype=torch.long), None, None, cache)
+
+    def generate(self, prompt_ids, max_new_tokens, eos_token_ids=()):
+        return list(self.stream(prompt_ids, max_new_tokens, eos_token_ids))
+
+class TransformersBackend(InferenceBackend):
+    """PyTorch through transformers, in any of the PRECISIONS."""
+
+    name = 'transformers'
+
+    def __init__(self, model, precision=None):
+        super().__init__(model.config, model.generation_config, model.dtype, precision)
+        self.model = model
+
+    @classmethod
+    def load(cls, precision, weights_path=None, model_name=None):
+        if weights_path:
+            return cls(*_load_shared_weights(weights_path, precision))
+        return cls(*_load_weights(precision, model_name))
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+        return outputs.logits, outputs.past_key_values
+
+    def num_parameters(self):
+        return self.model.num_parameters()
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """ONNX Runtime's CPU kernels, running the model.onnx written by
+    `prepare --engine onnxruntime`.
+
+    The graph takes the cache as past_key_values.{layer}.key / .value
+    inputs and returns it grown by the new tokens as present.{layer}.key /
+    .value; tensors cross between torch and ONNX Runtime as zero-copy NumPy
+    views.
+    """
+
+    name = 'onnxruntime'
+
+    def __init__(self, path, model_config, generation_config, precision=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        inputs = {i.name: i for i in self.session.get_inputs()}
+        dtype = torch.float16 if inputs['past_key_values.0.key'].type == 'tensor(float16)' else torch.float32
+        super().__init__(model_config, generation_config, dtype, precision)
+        self.num_layers = model_config.num_hidden_layers
+        self.kv_heads = getattr(model_config, 'num_key_value_heads', None) or model_config.num_attention_heads
+        self.head_dim = getattr(model_config, 'head_dim', None) or model_config.hidden_size // model_config.num_attention_heads
+        self.output_names = ['logits'] + [
+            f'present.{layer}.{kind}' for layer in range(self.num_layers) for kind in ('key', 'value')]
+
+    @classmethod
+    def load(cls, precision, weights_path=None):
+        path = _artifact_file(ONNX_MODEL)
+        print(f'Creating ONNX Runtime session for {path}...')
+        model_config = AutoConfig.from_pretrained(_model_source(), trust_remote_code=True)
+        # _artifact_file has checked the artifact was prepared for this precision
+        return cls(path, model_config, _generation_config(_model_source()), _onnx_precision(precision))
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None):
+        layers = _cache_layers(past_key_values) if past_key_values is not None else []
+        # The graph takes full-precision caches; an int8 cache is unpacked for the call
+        quantized = isinstance(past_key_values, Int8KVCache)
+        if quantized:
+            layers = [(_unpack_kv(k, self.dtype), _unpack_kv(v, self.dtype)) for k, v in layers]
+        batch, length = input_ids.shape
+        past = layers[0][0].shape[2] if layers else 0
+        if attention_mask is None:
+            attention_mask = torch.ones(batch, past + length, dtype=torch.long)
+        if position_ids is None:
+            position_ids = torch.arange(past, past + length).unsqueeze(0).expand(batch, -1)
+        feed = {
+            'input_ids': input_ids.numpy(),
+            'attention_mask': attention_mask.numpy(),
+            'position_ids': position_ids.contiguous().numpy()
+        }
+        empty = torch.zeros(batch, self.kv_heads, 0, self.head_dim, dtype=self.dtype)
+        for layer in range(self.num_layers):
+            key, value = layers[layer] if layers else (empty, empty)
+            feed[f'past_key_values.{layer}.key'] = key.contiguous().numpy()
+            feed[f'past_key_values.{layer}.value'] = value.contiguous().numpy()
+        outputs = [torch.from_numpy(output) for output in self.session.run(self.output_names, feed)]
+        if quantized:
+            outputs[1:] = [_pack_kv(output) for output in outputs[1:]]
+        return outputs[0], _make_cache(list(zip(outputs[1::2], outputs[2::2])))
+
+BACKENDS = {backend.name: backend for backend in (TransformersBackend, OnnxRuntimeBackend)}
+
+def _load_backend(precision, weights_path=None):
+    """Load the model with the engine named by config['engine']."""
+    engine = config.get('engine', 'transformers')
+    if engine not in BACKENDS:
+        raise ValueError(f'Unsupported engine {engine!r}, expected one of {", ".join(BACKENDS)}')
+    return BACKENDS[engine].load(precision, weights_path)
+
+def _onnx_precision(precision):
+    """What a precision becomes for the onnxruntime engine."""
+    _base_dtype(precision)  # Validates it
+    return {'bfloat16': 'float32', 'int4': 'int8'}.get(precision, precision)
+
+def _generation_config(source):
+    try:
+        return GenerationConfig.from_pretrained(source)
+    except OSError:
+        return GenerationConfig()
+
+class _OnnxExportWrapper(torch.nn.Module):
+    """Flattens the KV cache into plain tensor inputs and outputs for torch.onnx.export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids, *past):
+        cache = DynamicCache()
+        for layer in range(len(past) // 2):
+            cache.update(past[2 * layer], past[2 * layer + 1], layer)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True
+        )
+        present = []
+        for key, value in _cache_layers(outputs.past_key_values):
+            present += [key, value]
+        return (outputs.logits, *present)
+
+def _export_onnx(loaded, path, precision):
+    """Export a float32 model to ONNX; int8 / int4 get int8 weights. Returns the precision written."""
+    model_config = loaded.config
+    layers = model_config.num_hidden_layers
+    kv_heads = getattr(model_config, 'num_key_value_heads', None) or model_config.num_attention_heads
+    head_dim = getattr(model_config, 'head_dim', None) or model_config.hidden_size // model_config.num_attention_heads
+    # Example inputs: batch 2, 3 new tokens after 4 cached ones; every size is dynamic
+    past = [torch.zeros(2, kv_heads, 4, head_dim) for _ in range(2 * layers)]
+    example = (torch.ones(2, 3, dtype=torch.long), torch.ones(2, 7, dtype=torch.long),
+               torch.arange(4, 7).expand(2, -1), *past)
+    past_names = [f'past_key_values.{layer}.{kind}' for layer in range(layers) for kind in ('key', 'value')]
+    present_names = [f'present.{layer}.{kind}' for layer in range(layers) for kind in ('key', 'value')]
+    dynamic_axes = {
+        'input_ids': {0: 'batch', 1: 'sequence'},
+        'attention_mask': {0: 'batch', 1: 'total_sequence'},
+        'position_ids': {0: 'batch', 1: 'sequence'},
+        'logits': {0: 'batch', 1: 'sequence'}
+    }
+    dynamic_axes.update({name: {0: 'batch', 2: 'past_sequence'} for name in past_names})
+    dynamic_axes.update({name: {0: 'batch', 2: 'total_sequence'} for name in present_names})
+    if _onnx_precision(precision) != precision:
+        print(f'ONNX Runtime CPU has no {precision} kernels for this model, using {_onnx_precision(precision)}')
+        precision = _onnx_precision(precision)
+    # int8 is quantized from a float32 export written next to the target
+    export_dir = os.path.join(os.path.dirname(path), 'float32') if precision == 'int8' else None
+    export_path = os.path.join(export_dir, os.path.basename(path)) if export_dir else path
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            _OnnxExportWrapper(loaded.eval()),
+            example,
+            export_path,
+            input_names=['input_ids', 'attention_mask', 'position_ids'] + past_names,
+            output_names=['logits'] + present_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            dynamo=False
+        )
+    if precision == 'int8':
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(export_path, path, weight_type=QuantType.QInt8, use_external_data_format=True)
+        shutil.rmtree(export_dir)
+    return precision
+
+# Shared weights for the multi-process worker pool
+#
+# The weights are written once, in their load dtype, to a single safetensors
+# file. Each worker maps that file copy-on-write and points the model's
+# parameters straight at the mapping, so all workers share the same page
+# cache pages instead of each holding a private copy.
+
+SAFETENSORS_DTYPES = {
+    'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool
+}
+
+def _shared_weights_path(precision):
+    name = config['model_name'].strip('/').replace('/', '--')
+    dtype = str(_base_dtype(precision)).replace('torch.', '')
+    return os.path.join(config.get('shared_weights_dir', 'shared_weights'), f'{name}-{dtype}.safetensors')
+
+def _export_shared_weights(precision):
+    """Write the model's weights to one safetensors file unless it already exists."""
+    path = _shared_weights_path(precision)
+    if os.path.exists(path):
+        return path
+    print(f'Exporting shared weights to {path}...')
+    loaded = _from_pretrained(config['model_name'], _base_dtype(precision))
+    _save_weights(loaded, path)
+    del loaded
+    gc.collect()
+    return path
+
+def _save_weights(loaded, path):
+    """Write a model's weights to one safetensors file, atomically."""
+    from safetensors.torch import save_file
+    # Tied weights (e.g. lm_head and embed_tokens) are stored once, under
+    # the first name; tie_weights() restores the other after loading
+    state, seen = {}, set()
+    for name, tensor in loaded.state_dict().items():
+        if tensor.data_ptr() not in seen:
+            seen.add(tensor.data_ptr())
+            state[name] = tensor.contiguous()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    save_file(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def _mmap_safetensors(path):
+    """Map a safetensors file and return its tensors as views of the mapping.
+
+    The mapping is private (copy-on-write): pages are shared with every
+    other process mapping the same file until someone writes to them.
+    """
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_size))
+    header.pop('__metadata__', None)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)[8 + header_size:]
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        begin, end = info['data_offsets']
+        raw = data[begin:end]
+        if (8 + header_size + begin) % torch.empty(0, dtype=dtype).element_size():
+            raw = raw.clone()  # Misaligned for this dtype; this tensor gets a private copy
+        tensors[name] = raw.view(dtype).view(info['shape'])
+    return tensors
+
+def _load_shared_weights(path, precision):
+    """Build the model around the mapped weights without copying them;
+    returns (model, precision) like _load_weights."""
+    from accelerate import init_empty_weights
+    dtype = _base_dtype(precision)
+    with init_empty_weights(include_buffers=False):
+        loaded = AutoModelForCausalLM.from_config(
+            AutoConfig.from_pretrained(_model_source(), trust_remote_code=True),
+            torch_dtype=dtype,
+            trust_remote_code=True
+        )
+    # from_config starts from default sampling settings (top_k, top_p, ...)
+    loaded.generation_config = _generation_config(_model_source())
+    loaded.load_state_dict(_mmap_safetensors(path), strict=False, assign=True)
+    loaded.tie_weights()
+    missing = [name for name, param in loaded.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(f'Shared weights file {path} is missing {", ".join(missing[:5])}')
+    loaded.eval()
+    return _quantize(loaded, precision)
+
+# Prepared model artifact
+#
+# `python main_optimized.py prepare` downloads the model once and writes a
+# directory holding the tokenizer, the model and generation configs, and all
+# weights, already converted to the load dtype of the configured precision,
+# in a single safetensors file. With config['model_artifact_dir'] set the
+# server (and every worker) loads only from that directory: no Hub lookups,
+# and the weights are memory mapped instead of deserialized and converted.
+# int8 / int4 quantization is still applied after mapping, since the
+# quantized modules have no mmap-able on-disk format. For the onnxruntime
+# engine the artifact holds model.onnx instead of the safetensors file.
+# With config['draft_model_name'] set, the draft model is saved alongside in
+# draft/ (always for the transformers engine, which is what runs it).
+
+ARTIFACT_WEIGHTS = 'model.safetensors'
+ARTIFACT_DRAFT = 'draft'
+ONNX_MODEL = 'model.onnx'
+ARTIFACT_MANIFEST = 'artifact.json'
+
+def _model_source():
+    """Where the tokenizer and model config come from: the artifact or the Hub."""
+    return config.get('model_artifact_dir') or config['model_name']
+
+def _artifact_file(name):
+    """Path of `name` in the prepared artifact, after checking the artifact
+    was prepared for the configured engine and precision. None when serving
+    straight from the Hub."""
+    directory = config.get('model_artifact_dir')
+    engine = config.get('engine', 'transformers')
+    if not directory:
+        if engine != 'transformers':
+            raise RuntimeError(f'The {engine} engine serves a prepared artifact, run: '
+                               f'python main_optimized.py prepare --engine {engine} and set model_artifact_dir')
+        return None
+    manifest_path = os.path.join(directory, ARTIFACT_MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise RuntimeError(f'{directory} is not a prepared model artifact, run: python main_optimized.py prepare')
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    precision = config.get('precision', 'float32')
+    if manifest.get('engine', 'transformers') != engine:
+        raise RuntimeError(f'{directory} was prepared for the {manifest.get("engine", "transformers")} engine; '
+                           f'rerun: python main_optimized.py prepare --engine {engine}')
+    if engine == 'transformers':
+        matches = manifest['dtype'] == str(_base_dtype(precision)).replace('torch.', '')
+    else:
+        matches = manifest['precision'] == _onnx_precision(precision)
+    if not matches:
+        raise RuntimeError(
+            f'{directory} was prepared for precision {manifest["precision"]!r} but config.json asks for '
+            f'{precision!r}; rerun: python main_optimized.py prepare --precision {precision}')
+    return os.path.join(directory, name)
+
+def prepare_artifact(output_dir, precision, model_name=None, engine=None, draft_model_name=None):
+    """Write a prepared artifact for `model_name` (and the draft model, if
+    any) to `output_dir`, replacing any previous one."""
+    import transformers
+    model_name = model_name or config['model_name']
+    engine = engine or config.get('engine', 'transformers')
+    draft_model_name = draft_model_name or config.get('draft_model_name')
+    started = time.monotonic()
+    staging = output_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    print(f'Preparing {model_name} ({precision}, {engine}) in {output_dir}...')
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(staging)
+    AutoConfig.from_pretrained(model_name, trust_remote_code=True).save_pretrained(staging)
+    if draft_model_name:
+        draft = _from_pretrained(draft_model_name, _base_dtype(precision))
+        draft.save_pretrained(os.path.join(staging, ARTIFACT_DRAFT))
+        del draft
+    if engine == 'onnxruntime':
+        loaded = _from_pretrained(model_name, torch.float32)
+        loaded.generation_config.save_pretrained(staging)
+        precision = _export_onnx(loaded, os.path.join(staging, ONNX_MODEL), precision)
+        dtype = torch.float32
+    else:
+        dtype = _base_dtype(precision)
+        loaded = _from_pretrained(model_name, dtype)
+        loaded.generation_config.save_pretrained(staging)
+        _save_weights(loaded, os.path.join(staging, ARTIFACT_WEIGHTS))
+    del loaded
+    with open(os.path.join(staging, ARTIFACT_MANIFEST), 'w') as f:
+        json.dump({
+            'model_name': model_name,
+            'draft_model_name': draft_model_name,
+            'engine': engine,
+            'precision': precision,
+            'dtype': str(dtype).replace('torch.', ''),
+            'created_at': datetime.utcnow().isoformat(),
+            'torch': torch.__version__,
+            'transformers': transformers.__version__
+        }, f, indent=2)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(staging, output_dir)
+    size_mb = sum(entry.stat().st_size for entry in os.scandir(output_dir)) / (1024 * 1024)
+    print(f'Prepared {output_dir} ({size_mb:,.0f} MB) in {time.monotonic() - started:.1f}s')
+    return output_dir
+
+def warmup_model():
+    """Run a short generation so weights are paged in and kernels primed
+    before the node reports ready."""
+    warmup_tokens = config.get('warmup_tokens', 16)
+    if warmup_tokens <= 0:
+        return
+    started = time.monotonic()
+    job = GenerationJob(
+        [{'role': 'user', 'content': config.get('warmup_prompt', 'Summarise this lesson in one sentence.')}],
+        max_new_tokens=warmup_tokens,
+        temperature=0
+    )
+    scheduler.submit(job).result()
+    model_state['warmup_seconds'] = round(time.monotonic() - started, 2)
+    MODEL_WARMUP_SECONDS.set(model_state['warmup_seconds'])
+    print(f'Warmup generation finished in {model_state["warmup_seconds"]}s')
+
+async def load_model():
+    if model_state['status'] != 'ready':
+        await asyncio.get_running_loop().run_in_executor(None, load_model_sync)
+
+@app.on_event('startup')
+async def start_model_loading():
+    global response_cache, session_store, job_queue, rate_limiter, vector_store
+    rate_limiter = RateLimiter(
+        tokens_per_minute=config.get('rate_limit_tokens_per_minute', 0),
+        burst_tokens=config.get('rate_limit_burst_tokens', 0)
+    )
+    session_store = SessionStore(
+        max_bytes=config.get('session_kv_mb', 2048) * 1024 * 1024,
+        idle_timeout=config.get('session_idle_timeout', 1800),
+        max_sessions=config.get('max_sessions', 1000)
+    )
+    if config.get('response_cache_size', 1024) > 0:
+        response_cache = ResponseCache(
+            max_entries=config.get('response_cache_size', 1024),
+            ttl_seconds=config.get('response_cache_ttl', 86400),
+            path=config.get('response_cache_path', 'response_cache.db')
+        )
+    job_queue = JobQueue(
+        config.get('job_db_path', 'jobs.db'),
+        concurrency=config.get('job_concurrency', 2),
+        max_pending_per_user=config.get('max_pending_jobs_per_user', 100),
+        max_attempts=config.get('job_max_attempts', 3),
+        retention_seconds=config.get('job_retention_hours', 168) * 3600
+    )
+    job_queue.start()
+    vector_store = VectorStore(config.get('vector_index_dir', 'vector_indexes'))
+    if config.get('eager_load', True):
+        threading.Thread(target=_load_model_in_background, name='model-loader', daemon=True).start()
+
+def _load_model_in_background():
+    try:
+        load_model_sync()
+    except Exception:
+        pass  # Reported through model_state; /chat will retry the load
+
+# Metrics
+#
+# A minimal Prometheus registry (text exposition format 0.0.4) so /metrics
+# needs no extra dependency. Stage histograms are observed once per request
+# with the time that request spent in the stage; the decode step histogram
+# is observed once per batched forward pass.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+RATE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 4, 16, 64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+class Metric:
+    """One metric family: a counter, gauge or histogram with optional labels."""
+
+    def __init__(self, name, help_text, kind, buckets=None):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            # Per-bucket counts, then sum and count
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = {key: list(value) if self.kind == 'histogram' else value for key, value in self.values.items()}
+        for key, value in sorted(values.items()):
+            if self.kind != 'histogram':
+                lines.append(f'{self.name}{self._labels(key)} {value}')
+                continue
+            for bound, count in zip(self.buckets, value):
+                lines.append(f'{self.name}_bucket{self._labels(key + (("le", bound),))} {count}')
+            lines.append(f'{self.name}_bucket{self._labels(key + (("le", "+Inf"),))} {value[-1]}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {value[-2]}')
+            lines.append(f'{self.name}_count{self._labels(key)} {value[-1]}')
+        return '\n'.join(lines)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, name, help_text, kind, buckets=None):
+        metric = Metric(name, help_text, kind, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._add(name, help_text, 'counter')
+
+    def gauge(self, name, help_text):
+        return self._add(name, help_text, 'gauge')
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._add(name, help_text, 'histogram', buckets)
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    'llm_stage_duration_seconds',
+    'Time a request spent in each stage (template, tokenize, prefill, decode, detokenize)')
+DECODE_STEP_SECONDS = metrics.histogram('llm_decode_step_seconds', 'Duration of one batched decode step')
+QUEUE_WAIT_SECONDS = metrics.histogram('llm_queue_wait_seconds', 'Time from submission until the scheduler admits a request')
+TTFT_SECONDS = metrics.histogram('llm_time_to_first_token_seconds', 'Time from submission until the first generated token')
+REQUEST_SECONDS = metrics.histogram('llm_request_duration_seconds', 'Time from submission until generation finished')
+TOKENS_PER_SECOND = metrics.histogram(
+    'llm_tokens_per_second', 'Per-request completion tokens per second of generation', buckets=RATE_BUCKETS)
+PROMPT_TOKENS = metrics.histogram('llm_prompt_tokens', 'Prompt length in tokens', buckets=TOKEN_BUCKETS)
+COMPLETION_TOKENS = metrics.histogram('llm_completion_tokens', 'Completion length in tokens', buckets=TOKEN_BUCKETS)
+PROMPT_TOKENS_TOTAL = metrics.counter('llm_prompt_tokens_total', 'Prompt tokens processed')
+COMPLETION_TOKENS_TOTAL = metrics.counter('llm_completion_tokens_total', 'Completion tokens generated')
+REQUESTS_TOTAL = metrics.counter('llm_requests_total', 'Finished generations by finish reason')
+REJECTED_TOTAL = metrics.counter('llm_requests_rejected_total', 'Requests rejected because the queue was full')
+RATE_LIMITED_TOTAL = metrics.counter('llm_requests_rate_limited_total', 'Requests rejected by a tenant token budget')
+TENANT_TOKENS_TOTAL = metrics.counter('llm_tenant_tokens_total', 'Prompt plus completion tokens charged per tenant')
+IN_FLIGHT = metrics.gauge('llm_requests_in_flight', 'Generations submitted and not yet finished')
+QUEUE_DEPTH = metrics.gauge('llm_queue_depth', 'Generations waiting to be admitted')
+ACTIVE_SEQUENCES = metrics.gauge('llm_active_sequences', 'Sequences in the running decode batch')
+KV_CACHE_BYTES = metrics.gauge('llm_kv_cache_bytes', 'KV cache memory held by the running decode batch')
+REQUEST_KV_BYTES = metrics.histogram(
+    'llm_request_kv_cache_bytes', 'Most KV cache memory a request held at once', buckets=BYTE_BUCKETS)
+MODEL_LOAD_SECONDS = metrics.gauge('llm_model_load_seconds', 'Time taken to load the model weights')
+MODEL_WARMUP_SECONDS = metrics.gauge('llm_model_warmup_seconds', 'Time taken by the warmup generation')
+MODEL_READY = metrics.gauge('llm_model_ready', '1 once the model is loaded and warmed up')
+EMBEDDING_SECONDS = metrics.histogram('llm_embedding_duration_seconds', 'Time to embed the inputs of one request')
+VECTOR_SEARCH_SECONDS = metrics.histogram('llm_vector_search_seconds', 'Duration of one vector index search')
+SPECULATIVE_PROPOSED = metrics.counter('llm_speculative_proposed_tokens_total', 'Tokens proposed by the draft model')
+SPECULATIVE_ACCEPTED = metrics.counter('llm_speculative_accepted_tokens_total', 'Draft tokens accepted by the main model')
+SPECULATIVE_ACCEPTANCE = metrics.gauge(
+    'llm_speculative_acceptance_rate', 'Draft token acceptance rate over the last speculative_window proposals')
+
+STAGES = ('template', 'tokenize', 'prefill', 'decode', 'detokenize')
+
+def observe_job(result):
+    """Record a finished job's latency and token metrics from its result."""
+    REQUESTS_TOTAL.inc(finish_reason=result['finish_reason'])
+    for stage in STAGES:
+        if stage in result['timing']:
+            STAGE_SECONDS.observe(result['timing'][stage], stage=stage)
+    if result['timing']['queue_wait'] is not None:
+        QUEUE_WAIT_SECONDS.observe(result['timing']['queue_wait'])
+    REQUEST_SECONDS.observe(result['timing']['total'])
+    if result['time_to_first_token'] is not None:
+        TTFT_SECONDS.observe(result['time_to_first_token'])
+    if result['timing']['tokens_per_second'] is not None:
+        TOKENS_PER_SECOND.observe(result['timing']['tokens_per_second'])
+    PROMPT_TOKENS.observe(result['prompt_tokens'])
+    COMPLETION_TOKENS.observe(result['completion_tokens'])
+    if result.get('kv_cache_bytes'):
+        REQUEST_KV_BYTES.observe(result['kv_cache_bytes'])
+    PROMPT_TOKENS_TOTAL.inc(result['prompt_tokens'])
+    COMPLETION_TOKENS_TOTAL.inc(result['completion_tokens'])
+
+# Constrained JSON output
+#
+# With response_format set, every sampling step masks the tokens that could
+# not continue a valid JSON object (optionally one matching a JSON schema).
+# The grammar is a pushdown automaton over characters: the state is a tuple
+# of frames, and a token is allowed if feeding its decoded text through the
+# automaton does not fail. Only the highest scoring json_candidate_tokens
+# are checked (more if none of them fit), which covers everything top_k /
+# top_p could pick anyway. Generation stops as soon as the top-level object
+# closes, so there is no trailing prose to strip.
+#
+# Supported schema keywords: type (one type), properties, required,
+# additionalProperties (false restricts keys to properties), items,
+# minItems, maxItems and string enum. Anything else is accepted unchecked.
+
+JSON_WHITESPACE = ' \t\n\r'
+JSON_NUMBER = re.compile(r'-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?')
+JSON_NUMBER_PREFIX = re.compile(r'-|-?(0|[1-9]\d*)(\.\d*|(\.\d+)?[eE][+-]?\d*)?')
+JSON_INTEGER = re.compile(r'-?(0|[1-9]\d*)')
+JSON_INTEGER_PREFIX = re.compile(r'-|-?(0|[1-9]\d*)')
+JSON_LITERALS = {'t': ('true', 'boolean'), 'f': ('false', 'boolean'), 'n': ('null', 'null')}
+JSON_TYPES = ('object', 'array', 'string', 'number', 'integer', 'boolean', 'null')
+
+def _json_schema(response_format):
+    """Validate a response_format and return the schema to enforce (None for free text)."""
+    if not response_format or response_format.get('type', 'text') == 'text':
+        return None
+    if response_format['type'] == 'json_object':
+        return {'type': 'object'}
+    if response_format['type'] == 'json_schema':
+        schema = (response_format.get('json_schema') or {}).get('schema')
+        if not isinstance(schema, dict) or schema.get('type', 'object') != 'object':
+            raise HTTPException(status_code=400, detail='json_schema.schema must be a JSON schema for an object')
+        _check_types(schema)
+        return dict(schema, type='object')
+    raise HTTPException(status_code=400, detail="response_format type must be 'text', 'json_object' or 'json_schema'")
+
+def _check_types(schema):
+    """Reject schemas whose `type` the grammar can't enforce, before generating anything."""
+    if not isinstance(schema, dict):
+        return
+    expected = schema.get('type')
+    names = expected if isinstance(expected, list) else [expected]
+    if expected is not None and (not names or not all(name in JSON_TYPES for name in names)):
+        raise HTTPException(status_code=400, detail=f'Unsupported JSON schema type: {expected!r}')
+    for child in (schema.get('properties') or {}).values():
+        _check_types(child)
+    for key in ('items', 'additionalProperties'):
+        _check_types(schema.get(key))
+
+def _allows(schema, json_type):
+    expected = schema.get('type')
+    if 'enum' in schema and all(isinstance(value, str) for value in schema['enum']):
+        expected = 'string'
+    if expected is None:
+        return True
+    # `type` may be a single name or a list of them, e.g. ["string", "null"]
+    names = expected if isinstance(expected, list) else [expected]
+    return json_type in names or (json_type == 'integer' and 'number' in names)
+
+class JsonLogitsProcessor(LogitsProcessor):
+    """Masks logits so the generated text is a JSON object matching `schema`.
+
+    Usable with model.generate (pass `prompt_length`; the state follows
+    `input_ids`) or driven token by token through `advance`, as the
+    scheduler does. Once the object is complete only EOS is allowed.
+    """
+
+    token_texts = {}  # Token id -> decoded text, shared by all instances
+
+    def __init__(self, schema, eos_token_ids=(), prompt_length=None, candidates=64, max_whitespace=16):
+        self.schema = schema
+        self.eos_token_ids = list(eos_token_ids)
+        self.prompt_length = prompt_length
+        self.candidates = candidates
+        self.max_whitespace = max_whitespace
+        self.state = ((('value', schema),), 0)
+        self.tokens = 0
+
+    @property
+    def done(self):
+        return not self.state[0]
+
+    def __call__(self, input_ids, scores):
+        if input_ids is not None and self.prompt_length is not None:
+            for token in input_ids[0, self.prompt_length + self.tokens:].tolist():
+                self.advance(token)
+        masked = torch.full_like(scores, float('-inf'))
+        if self.done:
+            masked[:, self.eos_token_ids] = scores[:, self.eos_token_ids]
+            return masked
+        allowed = self._allowed(scores[0])
+        masked[0, allowed] = scores[0, allowed]
+        return masked
+
+    def advance(self, token):
+        """Move the grammar past a generated token."""
+        self.tokens += 1
+        state = self._feed(self.state, self._text(token))
+        if state is not None:
+            self.state = state
+
+    def _allowed(self, scores):
+        order = torch.topk(scores, min(self.candidates, scores.shape[-1])).indices.tolist()
+        allowed = [token for token in order if self._feed(self.state, self._text(token)) is not None]
+        if not allowed:
+            # Nothing likely fits (e.g. only ':' is valid here): walk down the
+            # ranking a block at a time until something does
+            ranking = torch.argsort(scores, descending=True).tolist()
+            for start in range(len(order), len(ranking), self.candidates):
+                block = ranking[start:start + self.candidates]
+                allowed = [token for token in block if self._feed(self.state, self._text(token)) is not None]
+                if allowed:
+                    break
+        return allowed
+
+    def _text(self, token):
+        text = self.token_texts.get(token)
+        if text is None:
+            special = token in tokenizer.all_special_ids
+            text = '' if special else tokenizer.decode([token], clean_up_tokenization_spaces=False)
+            self.token_texts[token] = text
+        return text
+
+    def _feed(self, state, text):
+        """Return the state after `text`, or None if it can't continue the JSON."""
+        if not text:
+            return None
+        stack, whitespace = state
+        for char in text:
+            if not stack:
+                return None
+            # Whitespace is allowed between tokens, except before the opening brace
+            if char in JSON_WHITESPACE and stack[-1][0] in ('value', 'object', 'array') and stack[0][0] != 'value':
+                whitespace += 1
+                if whitespace > self.max_whitespace:
+                    return None
+                continue
+            whitespace = 0
+            stack = self._step(stack, char)
+            if stack is None:
+                return None
+        return stack, whitespace
+
+    def _step(self, stack, char):
+        frame = stack[-1]
+        kind, schema = frame[0], frame[1]
+        if kind == 'value':
+            return self._start_value(stack[:-1], schema, char)
+        if kind == 'object':
+            _, _, stage, seen, key = frame
+            if stage in ('first', 'key') and char == '"':
+                return stack + (('string', None, '', None, True),)
+            if stage == 'colon' and char == ':':
+                child = schema.get('properties', {}).get(key)
+                if child is None and isinstance(schema.get('additionalProperties'), dict):
+                    child = schema['additionalProperties']
+                return stack[:-1] + (('object', schema, 'next', seen, None), ('value', child or {}))
+            if stage == 'next' and char == ',' and self._more_keys(schema, seen):
+                return stack[:-1] + (('object', schema, 'key', seen, None),)
+            if stage in ('first', 'next') and char == '}' and set(schema.get('required', ())) <= seen:
+                return stack[:-1]
+            return None
+        if kind == 'array':
+            _, _, stage, count = frame
+            items = schema.get('items') if isinstance(schema.get('items'), dict) else {}
+            if stage == 'first' and char == ']' and schema.get('minItems', 0) == 0:
+                return stack[:-1]
+            if stage == 'first' and schema.get('maxItems', 1) > 0:
+                return self._start_value(stack[:-1] + (('array', schema, 'next', count + 1),), items, char)
+            if char == ',' and count < schema.get('maxItems', float('inf')):
+                return stack[:-1] + (('array', schema, 'next', count + 1), ('value', items))
+            if char == ']' and count >= schema.get('minItems', 0):
+                return stack[:-1]
+            return None
+        if kind == 'string':
+            return self._string_step(stack, frame, char)
+        if kind == 'number':
+            buffer = frame[2] + char
+            integer = not _allows(schema, 'number')
+            if (JSON_INTEGER_PREFIX if integer else JSON_NUMBER_PREFIX).fullmatch(buffer):
+                return stack[:-1] + (('number', schema, buffer),)
+            if not (JSON_INTEGER if integer else JSON_NUMBER).fullmatch(frame[2]):
+                return None
+            # The number ended; the character belongs to the enclosing container
+            parent = stack[:-1]
+            if char in JSON_WHITESPACE:
+                return parent
+            return self._step(parent, char) if parent else None
+        # Literal: the rest of true / false / null
+        rest = frame[2]
+        if char != rest[0]:
+            return None
+        return stack[:-1] if len(rest) == 1 else stack[:-1] + (('literal', schema, rest[1:]),)
+
+    def _start_value(self, stack, schema, char):
+        if char == '{' and _allows(schema, 'object'):
+            return stack + (('object', schema, 'first', frozenset(), None),)
+        if char == '[' and _allows(schema, 'array'):
+            return stack + (('array', schema, 'first', 0),)
+        if char == '"' and _allows(schema, 'string'):
+            return self._string_step(stack + (('string', schema, '', None, False),), None, None)
+        if (char == '-' or '0' <= char <= '9') and (_allows(schema, 'number') or _allows(schema, 'integer')):
+            return stack + (('number', schema, char),)
+        if char in JSON_LITERALS and _allows(schema, JSON_LITERALS[char][1]):
+            return stack + (('literal', schema, JSON_LITERALS[char][0][1:]),)
+        return None
+
+    def _string_step(self, stack, frame, char):
+        if frame is None:
+            return stack  # Just opened
+        _, schema, buffer, escape, is_key = frame
+        if escape == '\\':
+            if char == 'u':
+                escape = 4
+            elif char in '"\\/bfnrt':
+                escape = None
+            else:
+                return None
+            return stack[:-1] + (('string', schema, buffer + char, escape, is_key),)
+        if isinstance(escape, int):
+            if char not in '0123456789abcdefABCDEF':
+                return None
+            return stack[:-1] + (('string', schema, buffer + char, escape - 1 or None, is_key),)
+        if char == '"':
+            return self._close_string(stack, buffer, is_key)
+        if ord(char) < 0x20:
+            return None
+        buffer += char
+        names = self._string_choices(stack, schema, is_key)
+        if names is not None and not any(name.startswith(buffer) for name in names):
+            return None
+        return stack[:-1] + (('string', schema, buffer, '\\' if char == '\\' else None, is_key),)
+
+    def _close_string(self, stack, buffer, is_key):
+        frame = stack[-1]
+        names = self._string_choices(stack, frame[1], is_key)
+        if names is not None and buffer not in names:
+            return None
+        if not is_key:
+            return stack[:-1]
+        _, schema, _, seen, _ = stack[-2]
+        if buffer in seen:
+            return None
+        return stack[:-2] + (('object', schema, 'colon', seen | {buffer}, buffer),)
+
+    def _string_choices(self, stack, schema, is_key):
+        """The complete strings allowed here, or None if any string is."""
+        if is_key:
+            owner, seen = stack[-2][1], stack[-2][3]
+            if owner.get('additionalProperties', True) is False:
+                return [name for name in owner.get('properties', {}) if name not in seen]
+            return None
+        if schema and 'enum' in schema and all(isinstance(value, str) for value in schema['enum']):
+            return schema['enum']
+        return None
+
+    @staticmethod
+    def _more_keys(schema, seen):
+        if schema.get('additionalProperties', True) is not False:
+            return True
+        return any(name not in seen for name in schema.get('properties', {}))
+
+# Continuous batching scheduler
+#
+# Every /chat request becomes a GenerationJob. A single background thread owns
+# the model: at each decode step it admits pending jobs (templating and
+# prefilling their prompts and merging their KV caches into the running batch),
+# advances all active sequences by one token in a single forward pass, and
+# retires the ones that hit EOS or their max_tokens budget. Nothing blocking
+# runs on the asyncio event loop; handlers only await the job's future.
+
+def _cache_layers(cache):
+    """Return the per-layer (key, value) tensors of a DynamicCache."""
+    if hasattr(cache, 'layers'):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+def _make_cache(layers):
+    """Build a DynamicCache from per-layer (key, value) tensors (an
+    Int8KVCache when they are packed int8)."""
+    if layers and layers[0][0].dtype == torch.int8:
+        return Int8KVCache(layers)
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(layers)
+
+def _left_pad(tensor, length, dim):
+    """Left-pad `tensor` with zeros along `dim` up to `length`."""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+# KV cache modes
+#
+# config['kv_cache'] = 'int8' stores keys and values as int8 with one float32
+# scale per token and head, packed into 4 extra int8 columns after head_dim
+# (see _pack_kv). Each layer is dequantized only for its own attention call,
+# so the resident cache shrinks to about a quarter (float32 models) or half
+# (bfloat16) and at most one layer exists in full precision at a time.
+# Because the scales are per token, a packed cache can be sliced, padded and
+# concatenated along the batch and sequence axes like any other, so
+# batching, the prefix cache and sessions need no special handling.
+#
+# config['kv_window_tokens'] bounds each sequence's cache (in either mode): once a
+# sequence outgrows kv_sink_tokens + kv_window_tokens, the scheduler drops
+# everything between its first kv_sink_tokens tokens (the "attention sinks"
+# the model keeps attending to) and its most recent kv_window_tokens. Tokens
+# keep their original positions. The prompt itself is still prefilled with
+# full attention; only later tokens see the shortened context.
+
+KV_CACHE_MODES = ('full', 'int8')
+# Bytes of the float32 scale packed at the end of every int8 row
+KV_SCALE_BYTES = 4
+
+def _pack_kv(tensor):
+    """Quantize (..., head_dim) to int8 rows of head_dim + KV_SCALE_BYTES."""
+    scale = tensor.abs().amax(dim=-1, keepdim=True).float() / 127
+    quantized = (tensor.float() / scale.clamp(min=1e-12)).round().clamp(-127, 127).to(torch.int8)
+    return torch.cat([quantized, scale.view(torch.int8)], dim=-1)
+
+def _unpack_kv(packed, dtype):
+    """Inverse of _pack_kv; all-zero (padding) rows come back as zeros."""
+    scale = packed[..., -KV_SCALE_BYTES:].contiguous().view(torch.float32)
+    return packed[..., :-KV_SCALE_BYTES].to(dtype) * scale.to(dtype)
+
+_LAZY_INIT_TAKES_VALUES = DynamicLayer is not None and 'value_states' in inspect.signature(DynamicLayer.lazy_initialization).parameters
+
+class Int8KVLayer(DynamicLayer or object):
+    """A DynamicLayer whose keys / values are kept packed by _pack_kv."""
+
+    @classmethod
+    def packed(cls, keys, values):
+        layer = cls()
+        layer.keys, layer.values = keys, values
+        layer.dtype, layer.device = keys.dtype, keys.device
+        layer.is_initialized = True
+        return layer
+
+    def lazy_initialization(self, key_states, value_states=None):
+        # transformers 4.x passes only key_states, 5.x both
+        value_states = key_states if value_states is None else value_states
+        if _LAZY_INIT_TAKES_VALUES:
+            super().lazy_initialization(key_states, value_states)
+        else:
+            super().lazy_initialization(key_states)
+        self.keys, self.values = (
+            torch.zeros(*states.shape[:-2], 0, states.shape[-1] + KV_SCALE_BYTES, dtype=torch.int8, device=self.device)
+            for states in (key_states, value_states)
+        )
+
+    def update(self, key_states, value_states, *args, **kwargs):
+        if not self.is_initialized:
+            self.lazy_initialization(key_states, value_states)
+        past_keys = _unpack_kv(self.keys, key_states.dtype)
+        past_values = _unpack_kv(self.values, value_states.dtype)
+        self.keys = torch.cat([self.keys, _pack_kv(key_states)], dim=-2)
+        self.values = torch.cat([self.values, _pack_kv(value_states)], dim=-2)
+        # The new tokens attend to themselves unquantized
+        return torch.cat([past_keys, key_states], dim=-2), torch.cat([past_values, value_states], dim=-2)
+
+class Int8KVCache(DynamicCache):
+    """A DynamicCache of Int8KVLayers, optionally filled with packed tensors."""
+
+    def __init__(self, layers=()):
+        super().__init__()
+        self.layer_class_to_replicate = Int8KVLayer
+        self.layers = [Int8KVLayer.packed(k, v) for k, v in layers]
+
+def _new_cache():
+    """An empty cache for config['kv_cache']."""
+    return Int8KVCache() if config.get('kv_cache', 'full') == 'int8' else DynamicCache()
+
+def _kv_bytes_per_token(model_config, dtype):
+    """Bytes one token adds to the KV cache under config['kv_cache']."""
+    head_dim = getattr(model_config, 'head_dim', None) or model_config.hidden_size // model_config.num_attention_heads
+    kv_heads = getattr(model_config, 'num_key_value_heads', None) or model_config.num_attention_heads
+    if config.get('kv_cache', 'full') == 'int8':
+        row_bytes = head_dim + KV_SCALE_BYTES
+    else:
+        row_bytes = head_dim * (torch.finfo(dtype).bits // 8 if dtype.is_floating_point else 4)
+    return 2 * model_config.num_hidden_layers * kv_heads * row_bytes
+
+def _check_kv_cache_config():
+    mode = config.get('kv_cache', 'full')
+    if mode not in KV_CACHE_MODES:
+        raise ValueError(f'Unsupported kv_cache {mode!r}, expected one of {", ".join(KV_CACHE_MODES)}')
+    if mode == 'int8' and DynamicLayer is None:
+        raise RuntimeError('kv_cache int8 needs transformers 4.56 or newer')
+
+class QueueFullError(Exception):
+    """Raised when the scheduler's pending queue is at capacity."""
+
+    def __init__(self, retry_after):
+        super().__init__('Inference queue is full')
+        self.retry_after = retry_after
+
+# Priority lanes, most urgent first (see Tenant)
+LANES = ('interactive', 'bulk')
+
+class FairQueue:
+    """Pending jobs by lane, taken round robin between tenants within a lane."""
+
+    def __init__(self):
+        # Lane -> tenant id -> that tenant's jobs; tenants in the order they are served
+        self.lanes = {lane: collections.OrderedDict() for lane in LANES}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, job):
+        queues = self.lanes[job.lane]
+        queues.setdefault(job.tenant.id if job.tenant else None, collections.deque()).append(job)
+        self.size += 1
+
+    def push_front(self, jobs):
+        """Return popped jobs to the head of the queue in their original order."""
+        for job in reversed(jobs):
+            tenant_id = job.tenant.id if job.tenant else None
+            queues = self.lanes[job.lane]
+            queues.setdefault(tenant_id, collections.deque()).appendleft(job)
+            queues.move_to_end(tenant_id, last=False)
+            self.size += 1
+
+    def pop(self, lanes=LANES):
+        """The next job of the first non-empty lane in `lanes`, or None."""
+        for lane in lanes:
+            queues = self.lanes[lane]
+            if not queues:
+                continue
+            tenant_id, jobs = next(iter(queues.items()))
+            job = jobs.popleft()
+            if jobs:
+                queues.move_to_end(tenant_id)
+            else:
+                del queues[tenant_id]
+            self.size -= 1
+            return job
+        return None
+
+    def stats(self):
+        return {lane: sum(len(jobs) for jobs in queues.values()) for lane, queues in self.lanes.items()}
+
+class IncrementalDetokenizer:
+    """Turns a growing list of token ids into text deltas.
+
+    A single token can be an incomplete UTF-8 sequence (or only make sense
+    merged with its neighbours), so text is only released once the decoded
+    window no longer ends in a replacement character.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def step(self, token):
+        self.ids.append(token)
+        prefix_text = tokenizer.decode(self.ids[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        new_text = tokenizer.decode(self.ids[self.prefix_offset:], skip_special_tokens=True)
+        if len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ''
+
+    def flush(self):
+        """Release whatever is still buffered once the sequence is done."""
+        prefix_text = tokenizer.decode(self.ids[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        new_text = tokenizer.decode(self.ids[self.prefix_offset:], skip_special_tokens=True)
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+class GenerationJob:
+    """A single sequence tracked by the inference scheduler.
+
+    If `on_text` is given it is called from the scheduler thread with each
+    newly decoded piece of text. Generation ends early when one of the `stop`
+    strings is produced, when the job is cancelled, or when its deadline
+    (the requested timeout, capped by config['request_timeout']) passes.
+    With `json_schema` set the output is constrained to a matching JSON
+    object and generation stops when that object is complete. `tenant`
+    decides the job's lane and who its tokens are charged to.
+    """
+
+    def __init__(self, messages, max_new_tokens, temperature, prompt_ids=None, on_text=None,
+                 stop=None, timeout=None, json_schema=None, tenant=None):
+        self.messages = messages
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.output_ids = []
+        self.text = ''
+        self.finish_reason = None
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.first_token_at = None
+        self.cached_tokens = 0
+        # Most tokens this job held in the KV cache, tokens dropped by the
+        # sliding window, and the peak KV bytes reported in its result
+        self.kv_tokens = 0
+        self.evicted_tokens = 0
+        self.kv_bytes = 0
+        self.on_text = on_text
+        self.emitted = 0
+        self.detokenizer = IncrementalDetokenizer()
+        self.stop = [s for s in stop or [] if s]
+        # Streamed text holds back enough characters to hide a partial stop string
+        self.holdback = max((len(s) for s in self.stop), default=1) - 1
+        # A request_timeout of 0 or null turns the server-wide cap off
+        limits = [limit for limit in (timeout, config.get('request_timeout', 600)) if limit]
+        self.deadline = self.submitted_at + min(limits) if limits else None
+        self.cancelled = False
+        self.on_cancel = None
+        self.tenant = tenant
+        self.lane = tenant.lane if tenant else LANES[0]
+        self.reserved_bytes = 0
+        self.deferred = False
+        self.finished_at = None
+        # Sessions: (token ids, KV layers) of the previous turn to resume from,
+        # and whether to hand this job's final KV cache back in final_layers
+        self.session_cache = None
+        self.keep_cache = False
+        self.final_layers = None
+        # Schema the output must match; the scheduler enforces it through `grammar`
+        self.json_schema = json_schema
+        self.grammar = None
+        # Draft model KV cache (speculative decoding) and how many tokens it covers
+        self.draft_cache = None
+        self.draft_length = 0
+        # Seconds spent per stage, reported in metrics and optionally in responses
+        self.timing = collections.defaultdict(float)
+
+    def cancel(self):
+        """Ask the scheduler to stop this job at the next decode step."""
+        self.cancelled = True
+        if self.on_cancel:
+            self.on_cancel()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def encode(self):
+        """Apply the chat template and tokenize (runs on the scheduler thread)."""
+        if self.prompt_ids is None:
+            started = time.perf_counter()
+            text = tokenizer.apply_chat_template(self.messages, tokenize=False, add_generation_prompt=True)
+            templated = time.perf_counter()
+            self.prompt_ids = tokenizer(text).input_ids
+            self.timing['template'] += templated - started
+            self.timing['tokenize'] += time.perf_counter() - templated
+        return self.prompt_ids
+
+    def result(self):
+        return {
+            'text': self.text,
+            'prompt_tokens': len(self.prompt_ids),
+            'cached_tokens': self.cached_tokens,
+            'completion_tokens': len(self.output_ids),
+            'kv_cache_bytes': self.kv_bytes,
+            'finish_reason': self.finish_reason,
+            'time_to_first_token': round(self.first_token_at - self.submitted_at, 3) if self.first_token_at else None,
+            'timing': self.timing_summary()
+        }
+
+    def timing_summary(self):
+        """Per-stage seconds plus queue wait, total time and decode throughput."""
+        summary = {stage: round(seconds, 4) for stage, seconds in self.timing.items()}
+        end = self.finished_at or time.monotonic()
+        summary['queue_wait'] = round(self.started_at - self.submitted_at, 4) if self.started_at else None
+        summary['time_to_first_token'] = round(self.first_token_at - self.submitted_at, 4) if self.first_token_at else None
+        summary['total'] = round(end - self.submitted_at, 4)
+        decoding = end - self.first_token_at if self.first_token_at else 0
+        # The first token comes out of the prefill, so it isn't counted here
+        summary['tokens_per_second'] = round((len(self.output_ids) - 1) / decoding, 2) if decoding > 0 else None
+        return summary
+
+class PrefixCache:
+    """Reuses the KV cache of prompt prefixes shared between requests.
+
+    Prompts are split into fixed-size token blocks. Each block's keys and
+    values are stored under a chained hash of every token up to the end of
+    that block, so a block is only reused when the whole prefix before it
+    matches. Blocks are evicted least-recently-used once the memory budget
+    is exceeded.
+    """
+
+    def __init__(self, max_bytes, block_size=64):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.blocks = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.lock = threading.Lock()
+
+    def _block_keys(self, prompt_ids, limit):
+        """Chained digests for every full block within the first `limit` tokens."""
+        digest = hashlib.blake2b(digest_size=16)
+        keys = []
+        for end in range(self.block_size, limit + 1, self.block_size):
+            digest.update(array('q', prompt_ids[end - self.block_size:end]).tobytes())
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def lookup(self, prompt_ids):
+        """Return (cached_length, layers) for the longest cached prefix.
+
+        At least one prompt token is always left uncached so the caller has
+        something to run through the model to get next-token logits.
+        """
+        with self.lock:
+            matched = []
+            for key in self._block_keys(prompt_ids, len(prompt_ids) - 1):
+                if key not in self.blocks:
+                    break
+                matched.append(key)
+            if not matched:
+                self.misses += 1
+                return 0, None
+            # Touch from the last block back so earlier blocks, which every
+            # longer prefix depends on, stay the most recently used
+            for key in reversed(matched):
+                self.blocks.move_to_end(key)
+            self.hits += 1
+            length = len(matched) * self.block_size
+            self.reused_tokens += length
+            blocks = [self.blocks[key][0] for key in matched]
+        layers = [
+            (torch.cat([block[i][0] for block in blocks], dim=2), torch.cat([block[i][1] for block in blocks], dim=2))
+            for i in range(len(blocks[0]))
+        ]
+        return length, layers
+
+    def insert(self, prompt_ids, layers):
+        """Store every full block of a freshly prefilled prompt."""
+        keys = self._block_keys(prompt_ids, layers[0][0].shape[2])
+        # All blocks of a prompt are the same size; if one can't fit the budget, store nothing
+        size = sum(
+            k[:, :, :self.block_size].numel() * k.element_size() + v[:, :, :self.block_size].numel() * v.element_size()
+            for k, v in layers)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            for index, key in enumerate(keys):
+                if key in self.blocks:
+                    continue
+                start, end = index * self.block_size, (index + 1) * self.block_size
+                block = [(k[:, :, start:end].clone(), v[:, :, start:end].clone()) for k, v in layers]
+                self.blocks[key] = (block, size)
+                self.bytes += size
+            # As in lookup, leading blocks end up most recently used so the
+            # tail of a long prompt is evicted before the shared instructions
+            for key in reversed(keys):
+                if key in self.blocks:
+                    self.blocks.move_to_end(key)
+            while self.bytes > self.max_bytes:
+                _, (_, size) = self.blocks.popitem(last=False)
+                self.bytes -= size
+
+    def stats(self):
+        return {
+            'blocks': len(self.blocks),
+            'block_size': self.block_size,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused_tokens': self.reused_tokens
+        }
+
+# Memory governor
+#
+# Instead of calling gc.collect() after every request, the scheduler asks the
+# governor before admitting a job. Each job reserves the KV cache it can grow
+# to ((prompt + max_new_tokens) * bytes per token); jobs that don't fit wait
+# in the queue, and a job that would fit with a smaller budget has its
+# max_tokens clamped. Garbage collection only runs when RSS crosses
+# gc_threshold of the budget.
+
+def _rss_bytes():
+    """Current resident set size of this process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _total_memory_bytes():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (OSError, ValueError):
+        return None
+
+class MemoryGovernor:
+    """Admission control against a process memory budget."""
+
+    def __init__(self, model, budget_bytes, min_new_tokens=64, gc_threshold=0.9, prefix_cache=None,
+                 max_cached_tokens=None):
+        self.kv_bytes_per_token = _kv_bytes_per_token(model.config, model.dtype)
+        # With a sliding window no sequence holds more than this many tokens
+        self.max_cached_tokens = max_cached_tokens
+        self.budget_bytes = budget_bytes
+        self.baseline_bytes = _rss_bytes()
+        self.min_new_tokens = min_new_tokens
+        self.gc_threshold = gc_threshold
+        # The prefix cache (and session_store) hold KV memory outside of per-job reservations
+        self.prefix_cache = prefix_cache
+        self.reserved_bytes = 0
+        self.lock = threading.Lock()
+        self.deferred = 0
+        self.clamped = 0
+        self.rejected = 0
+        self.gc_runs = 0
+
+    def _available(self):
+        # RSS already holds part of the reserved KV caches, so this errs on
+        # the side of admitting too little rather than too much
+        cached_bytes = self.prefix_cache.bytes if self.prefix_cache else 0
+        cached_bytes += session_store.bytes if session_store else 0
+        used = max(_rss_bytes(), self.baseline_bytes + cached_bytes) + self.reserved_bytes
+        return self.budget_bytes - used
+
+    def reserve(self, job, idle):
+        """Reserve KV memory for `job`; return False if it has to wait.
+
+        When nothing else is running (`idle`) waiting can't help, so the job
+        is clamped to whatever fits or failed with MemoryError.
+        """
+        prompt_tokens = len(job.prompt_ids)
+        with self.lock:
+            available_tokens = self._available() // self.kv_bytes_per_token
+            if self._held_tokens(prompt_tokens + job.max_new_tokens) > available_tokens:
+                # Only reached when available_tokens is below max_cached_tokens
+                fits = available_tokens - prompt_tokens
+                if fits >= min(self.min_new_tokens, job.max_new_tokens) or (idle and fits > 0):
+                    job.max_new_tokens = fits
+                    self.clamped += 1
+                elif idle:
+                    self.rejected += 1
+                    raise MemoryError(f'Prompt of {prompt_tokens} tokens does not fit in the memory budget')
+                else:
+                    if not job.deferred:
+                        self.deferred += 1
+                        job.deferred = True
+                    return False
+            job.reserved_bytes = self._held_tokens(prompt_tokens + job.max_new_tokens) * self.kv_bytes_per_token
+            self.reserved_bytes += job.reserved_bytes
+        job.future.add_done_callback(lambda _: self.release(job))
+        return True
+
+    def _held_tokens(self, tokens):
+        return min(tokens, self.max_cached_tokens) if self.max_cached_tokens else tokens
+
+    def release(self, job):
+        with self.lock:
+            self.reserved_bytes -= job.reserved_bytes
+            job.reserved_bytes = 0
+        if _rss_bytes() > self.gc_threshold * self.budget_bytes:
+            gc.collect()
+            self.gc_runs += 1
+
+    def stats(self):
+        mb = 1024 * 1024
+        return {
+            'rss_mb': round(_rss_bytes() / mb, 1),
+            'budget_mb': round(self.budget_bytes / mb, 1),
+            'baseline_mb': round(self.baseline_bytes / mb, 1),
+            'reserved_kv_mb': round(self.reserved_bytes / mb, 1),
+            'kv_cache': config.get('kv_cache', 'full'),
+            'kv_bytes_per_token': self.kv_bytes_per_token,
+            'max_cached_tokens': self.max_cached_tokens,
+            'deferred': self.deferred,
+            'clamped': self.clamped,
+            'rejected': self.rejected,
+            'gc_runs': self.gc_runs
+        }
+
+class InferenceScheduler:
+    """Decodes all in-flight jobs together, one token per step. `model`
+    (and `draft_model`) are InferenceBackends."""
+
+    def __init__(self, model, max_batch_size=8, max_queue_size=64, prefix_cache=None, prefill_max_tokens=8192,
+                 memory=None, draft_model=None, speculative_tokens=4, min_acceptance_rate=0.5,
+                 speculative_window=64, speculative_cooldown=256, window_tokens=0, sink_tokens=4,
+                 bulk_batch_share=0.75):
+        self.model = model
+        self.kv_bytes_per_token = _kv_bytes_per_token(model.config, model.dtype)
+        self.window_tokens = window_tokens
+        self.sink_tokens = sink_tokens
+        # The cache may overrun the window by a sixteenth of it, so _evict
+        # copies it once every few steps instead of on every step
+        self.max_cached_tokens = sink_tokens + window_tokens + max(window_tokens // 16, 1) if window_tokens else None
+        self.draft_model = draft_model
+        self.speculative_tokens = speculative_tokens
+        self.min_acceptance_rate = min_acceptance_rate
+        self.speculative_window = speculative_window
+        self.speculative_cooldown = speculative_cooldown
+        self.speculation_paused = 0
+        self.window_proposed = 0
+        self.window_accepted = 0
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+        self.prefix_cache = prefix_cache
+        self.memory = memory
+        self.prefill_max_tokens = prefill_max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        # Bulk jobs never take the last batch slots, so interactive requests get in quickly
+        self.max_bulk_jobs = max(1, int(bulk_batch_share * max_batch_size))
+        self.pending = FairQueue()
+        self.active = []
+        # (function, future) pairs to run on this thread between decode steps
+        self.calls = []
+        self.cache = None
+        self.attention_mask = None
+        self.condition = threading.Condition()
+        self.eos_token_ids = self._eos_token_ids()
+        self.avg_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.avg_job_seconds = 0.0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.timed_out = 0
+        self.thread = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+
+    def _eos_token_ids(self):
+        eos = self.model.generation_config.eos_token_id
+        ids = set(eos if isinstance(eos, list) else [eos]) if eos is not None else set()
+        if tokenizer.eos_token_id is not None:
+            ids.add(tokenizer.eos_token_id)
+        return ids
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, job):
+        with self.condition:
+            if len(self.pending) >= self.max_queue_size:
+                self.rejected += 1
+                REJECTED_TOTAL.inc()
+                raise QueueFullError(self.retry_after())
+            self.pending.append(job)
+            self.condition.notify()
+        IN_FLIGHT.inc()
+        job.future.add_done_callback(lambda future: IN_FLIGHT.dec())
+        return job.future
+
+    def call(self, function):
+        """Run `function()` on the scheduler thread between decode steps, for
+        other work on the model that must not overlap a forward pass.
+        Returns a Future for its result."""
+        future = Future()
+        with self.condition:
+            self.calls.append((function, future))
+            self.condition.notify()
+        return future
+
+    def retry_after(self):
+        """Rough number of seconds until a queue slot frees up."""
+        waves = len(self.pending) / max(self.max_batch_size, 1)
+        return max(1, int(waves * self.avg_job_seconds + 0.5))
+
+    def stats(self):
+        return {
+            'active': len(self.active),
+            'pending': len(self.pending),
+            'max_batch_size': self.max_batch_size,
+            'max_queue_size': self.max_queue_size,
+            'pending_by_lane': self.pending.stats(),
+            'max_bulk_jobs': self.max_bulk_jobs,
+            'avg_queue_wait_seconds': round(self.avg_queue_wait, 3),
+            'max_queue_wait_seconds': round(self.max_queue_wait, 3),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'cancelled': self.cancelled,
+            'timed_out': self.timed_out,
+            'kv_cache_bytes': self._cache_bytes(),
+            'speculative': {
+                'proposed_tokens': self.proposed_tokens,
+                'accepted_tokens': self.accepted_tokens,
+                'acceptance_rate': round(self.accepted_tokens / self.proposed_tokens, 3) if self.proposed_tokens else None,
+                'paused_steps': self.speculation_paused
+            } if self.draft_model is not None else None
+        }
+
+    def _cache_bytes(self):
+        """Memory held by the running batch's KV cache."""
+        cache = self.cache
+        if cache is None:
+            return 0
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in _cache_layers(cache))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.active and not self.calls:
+                    self.condition.wait()
+                calls, self.calls = self.calls, []
+                candidates = []
+                while len(self.active) + len(candidates) < self.max_batch_size:
+                    bulk = sum(job.lane == 'bulk' for job in self.active + candidates)
+                    job = self.pending.pop(LANES if bulk < self.max_bulk_jobs else LANES[:1])
+                    if job is None:
+                        break
+                    candidates.append(job)
+            for function, future in calls:
+                try:
+                    future.set_result(function())
+                except Exception as e:
+                    future.set_exception(e)
+            admitted = self._reserve(candidates)
+            try:
+                with torch.no_grad():
+                    if admitted:
+                        self._admit(admitted)
+                    self._reap()
+                    if self.active:
+                        self._decode_step()
+            except Exception as e:
+                print(f'Inference scheduler error: {e}')
+                for job in self.active + [job for job in admitted if not job.future.done()]:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                self.active, self.cache, self.attention_mask = [], None, None
+
+    def _reserve(self, candidates):
+        """Tokenize candidates and keep those the memory governor admits; the
+        rest go back to the front of the queue in their original order."""
+        admitted = []
+        for index, job in enumerate(candidates):
+            try:
+                job.encode()
+                if self.memory and not self.memory.reserve(job, idle=not self.active and not admitted):
+                    with self.condition:
+                        self.pending.push_front(candidates[index:])
+                    break
+            except Exception as e:
+                job.future.set_exception(e)
+                continue
+            admitted.append(job)
+        return admitted
+
+    def _start(self, job):
+        job.started_at = time.monotonic()
+        wait = job.started_at - job.submitted_at
+        self.avg_queue_wait = 0.9 * self.avg_queue_wait + 0.1 * wait
+        self.max_queue_wait = max(self.max_queue_wait, wait)
+
+    def _admit(self, jobs):
+        """Prefill newly admitted jobs.
+
+        Jobs with a prefix cache hit are prefilled one by one from their
+        cached prefix; the rest are grouped into length buckets and prefilled
+        together with left padding. A failure only fails the jobs involved.
+        """
+        singles, batched = [], []
+        for job in jobs:
+            self._start(job)
+            if self._interrupted(job):
+                # Cancelled or timed out while still queued: skip the prefill
+                self._finish(job)
+                continue
+            try:
+                prompt_ids = job.encode()
+                if job.json_schema is not None:
+                    job.grammar = JsonLogitsProcessor(
+                        job.json_schema,
+                        self.eos_token_ids,
+                        candidates=config.get('json_candidate_tokens', 64),
+                        max_whitespace=config.get('json_max_whitespace', 16)
+                    )
+            except Exception as e:
+                job.future.set_exception(e)
+                continue
+            cached = self._session_prefix(job)
+            if not cached[0] and self.prefix_cache:
+                cached = self.prefix_cache.lookup(prompt_ids)
+            if cached[0]:
+                singles.append((job, cached))
+            else:
+                batched.append(job)
+        for job, (cached_length, cached_layers) in singles:
+            try:
+                self._prefill(job, cached_length, cached_layers)
+            except Exception as e:
+                job.future.set_exception(e)
+        for bucket in self._buckets(batched):
+            try:
+                self._prefill_bucket(bucket)
+            except Exception as e:
+                for job in bucket:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+    def _session_prefix(self, job):
+        """The part of a session's previous KV cache that the new prompt starts with."""
+        if not job.session_cache:
+            return 0, None
+        cached_ids, layers = job.session_cache
+        job.session_cache = None
+        # Leave at least one prompt token to prefill
+        limit = min(len(cached_ids), len(job.prompt_ids) - 1)
+        length = 0
+        while length < limit and cached_ids[length] == job.prompt_ids[length]:
+            length += 1
+        if not length:
+            return 0, None
+        return length, [(k[:, :, :length], v[:, :, :length]) for k, v in layers]
+
+    def _buckets(self, jobs):
+        """Group jobs of similar prompt length so padding stays small."""
+        bucket = []
+        for job in sorted(jobs, key=lambda job: len(job.prompt_ids)):
+            length = len(job.prompt_ids)
+            too_uneven = bucket and length > 1.5 * len(bucket[0].prompt_ids)
+            too_big = bucket and length * (len(bucket) + 1) > self.prefill_max_tokens
+            if too_uneven or too_big:
+                yield bucket
+                bucket = []
+            bucket.append(job)
+        if bucket:
+            yield bucket
+
+    def _prefill(self, job, cached_length, cached_layers):
+        # Only the part of the prompt after the cached prefix is prefilled
+        job.cached_tokens = cached_length
+        started = time.perf_counter()
+        input_ids = torch.tensor([job.prompt_ids[cached_length:]], dtype=torch.long)
+        logits, cache = self.model.prefill(input_ids, past_key_values=_make_cache(cached_layers))
+        job.timing['prefill'] += time.perf_counter() - started
+        job.kv_tokens = len(job.prompt_ids)
+        layers = _cache_layers(cache)
+        if self.prefix_cache:
+            self.prefix_cache.insert(job.prompt_ids, layers)
+        token = self._sample(logits[:, -1, :], [job])[0]
+        if self._append_token(job, token):
+            if job.keep_cache:
+                job.final_layers = layers
+            self._finish(job)
+            return
+        self._merge([job], layers, torch.ones(1, layers[0][0].shape[2], dtype=torch.long))
+
+    def _prefill_bucket(self, jobs):
+        """Prefill several prompts in one left-padded forward pass."""
+        started = time.perf_counter()
+        length = max(len(job.prompt_ids) for job in jobs)
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        input_ids = torch.tensor(
+            [[pad_token_id] * (length - len(job.prompt_ids)) + job.prompt_ids for job in jobs], dtype=torch.long)
+        mask = torch.tensor(
+            [[0] * (length - len(job.prompt_ids)) + [1] * len(job.prompt_ids) for job in jobs], dtype=torch.long)
+        logits, cache = self.model.prefill(
+            input_ids,
+            attention_mask=mask,
+            position_ids=(mask.cumsum(dim=1) - 1).clamp(min=0),
+            past_key_values=_new_cache()
+        )
+        elapsed = time.perf_counter() - started
+        for job in jobs:
+            job.timing['prefill'] += elapsed
+            job.kv_tokens = len(job.prompt_ids)
+        layers = _cache_layers(cache)
+        tokens = self._sample(logits[:, -1, :], jobs)
+        keep = []
+        for row, (job, token) in enumerate(zip(jobs, tokens)):
+            start = length - len(job.prompt_ids)
+            if self.prefix_cache:
+                self.prefix_cache.insert(job.prompt_ids, [(k[row:row + 1, :, start:], v[row:row + 1, :, start:]) for k, v in layers])
+            if self._append_token(job, token):
+                if job.keep_cache:
+                    job.final_layers = [(k[row:row + 1, :, start:].clone(), v[row:row + 1, :, start:].clone()) for k, v in layers]
+                self._finish(job)
+            else:
+                keep.append(row)
+        if keep:
+            index = torch.tensor(keep, dtype=torch.long)
+            self._merge(
+                [jobs[row] for row in keep],
+                [(k.index_select(0, index), v.index_select(0, index)) for k, v in layers],
+                mask.index_select(0, index)
+            )
+
+    def _merge(self, jobs, layers, mask):
+        """Add freshly prefilled sequences to the running batch."""
+        if self.cache is None:
+            self.cache, self.attention_mask, self.active = _make_cache(layers), mask, list(jobs)
+            return
+        length = max(self.attention_mask.shape[1], mask.shape[1])
+        merged = []
+        for (batch_k, batch_v), (k, v) in zip(_cache_layers(self.cache), layers):
+            merged.append((
+                torch.cat([_left_pad(batch_k, length, 2), _left_pad(k, length, 2)], dim=0),
+                torch.cat([_left_pad(batch_v, length, 2), _left_pad(v, length, 2)], dim=0)
+            ))
+        self.attention_mask = torch.cat([_left_pad(self.attention_mask, length, 1), _left_pad(mask, length, 1)], dim=0)
+        self.cache = _make_cache(merged)
+        self.active.extend(jobs)
+        self._evict()
+
+    def _evict(self):
+        """Cut rows longer than max_cached_tokens down to their attention
+        sinks plus their most recent window_tokens tokens."""
+        if not self.window_tokens or self.cache is None:
+            return
+        length = self.attention_mask.shape[1]
+        if length <= self.max_cached_tokens:
+            return
+        # Rows are left-padded: row i holds its tokens in columns [length - lengths[i], length)
+        lengths = self.attention_mask.sum(dim=1)
+        evict = lengths > self.max_cached_tokens
+        if not evict.any():
+            return
+        limit = self.sink_tokens + self.window_tokens
+        width = int(torch.where(evict, limit, lengths).max())
+        # Every row keeps its last `width` columns, except that evicted rows
+        # put their sinks right before their last window_tokens columns and
+        # mask out what comes before
+        index = torch.arange(length - width, length).repeat(len(self.active), 1)
+        sinks = (length - lengths).unsqueeze(1) + torch.arange(self.sink_tokens)
+        columns = slice(width - limit, width - self.window_tokens)
+        index[:, columns] = torch.where(evict.unsqueeze(1), sinks, index[:, columns])
+        for job, tokens in zip(self.active, lengths.tolist()):
+            job.kv_tokens = max(job.kv_tokens, tokens)
+            job.evicted_tokens += tokens - limit if tokens > self.max_cached_tokens else 0
+
+        def gather(tensor):
+            return tensor.gather(2, index[:, None, :, None].expand(-1, tensor.shape[1], -1, tensor.shape[3]))
+
+        self.attention_mask = self.attention_mask.gather(1, index)
+        self.attention_mask[evict, :width - limit] = 0
+        self.cache = _make_cache([(gather(k), gather(v)) for k, v in _cache_layers(self.cache)])
+
+    def _decode_step(self):
+        if self._should_speculate():
+            self._speculative_step()
+            return
+        if self.speculation_paused:
+            self.speculation_paused -= 1
+        started = time.perf_counter()
+        input_ids = torch.tensor([[job.output_ids[-1]] for job in self.active], dtype=torch.long)
+        # Positions count every token so far, including any the window dropped
+        position_ids = torch.tensor([[len(job.prompt_ids) + len(job.output_ids) - 1] for job in self.active])
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(len(self.active), 1)], dim=1)
+        logits, self.cache = self.model.decode_step(input_ids, self.attention_mask, position_ids, self.cache)
+        self._evict()
+        tokens = self._sample(logits[:, -1, :], self.active)
+        elapsed = time.perf_counter() - started
+        DECODE_STEP_SECONDS.observe(elapsed)
+        for job in self.active:
+            job.timing['decode'] += elapsed
+        finished = [job for job, token in zip(self.active, tokens) if self._append_token(job, token)]
+        if finished:
+            self._retire(finished)
+
+    def _sample(self, logits, jobs):
+        """Pick the next token per row, honouring each job's temperature. A
+        row with nothing to pick from (NaN scores, or every token masked out)
+        gets None, so _append_token fails just that job."""
+        logits = logits.float()
+        for i, job in enumerate(jobs):
+            if job.grammar is not None:
+                logits[i:i + 1] = job.grammar(None, logits[i:i + 1])
+        greedy = logits.argmax(dim=-1)
+        temperatures = torch.tensor([[max(job.temperature or 0.0, 1e-5)] for job in jobs])
+        probs = self._warp(logits / temperatures).softmax(dim=-1)
+        # softmax turns both NaN and all -inf rows into NaN, which torch.multinomial rejects for the whole batch
+        invalid = probs.isnan().any(dim=-1)
+        sampled = torch.multinomial(probs.masked_fill(invalid.unsqueeze(-1), 1.0), num_samples=1).squeeze(-1)
+        return [None if invalid[i] else int(greedy[i]) if not job.temperature or job.temperature <= 0 else int(sampled[i])
+                for i, job in enumerate(jobs)]
+
+    def _warp(self, scores):
+        """Apply the model's top_k / top_p filtering to temperature-scaled logits."""
+        generation_config = self.model.generation_config
+        top_k = generation_config.top_k
+        if top_k and top_k < scores.shape[-1]:
+            threshold = torch.topk(scores, top_k, dim=-1).values[:, -1:]
+            scores = scores.masked_fill(scores < threshold, float('-inf'))
+        top_p = generation_config.top_p
+        if top_p is not None and top_p < 1.0:
+            sorted_scores, sorted_indices = torch.sort(scores, descending=True, dim=-1)
+            probs = sorted_scores.softmax(dim=-1)
+            remove = probs.cumsum(dim=-1) - probs > top_p
+            scores = scores.masked_fill(remove.scatter(1, sorted_indices, remove), float('-inf'))
+        return scores
+
+    def _probabilities(self, logits, temperature, vocab_size=None):
+        """The distribution _sample draws from, one row per position (one-hot when greedy)."""
+        logits = logits.float()
+        if not temperature or temperature <= 0:
+            probs = torch.nn.functional.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+        else:
+            probs = self._warp(logits / temperature).softmax(dim=-1)
+        if vocab_size and probs.shape[-1] < vocab_size:
+            # A draft model's vocabulary can be smaller than the main model's
+            probs = torch.nn.functional.pad(probs, (0, vocab_size - probs.shape[-1]))
+        return probs[..., :vocab_size] if vocab_size else probs
+
+    def _should_speculate(self):
+        if self.draft_model is None or len(self.active) != 1 or self.speculation_paused:
+            return False
+        job = self.active[0]
+        if job.grammar is not None:
+            return False  # Draft proposals aren't constrained
+        # The verify pass assumes an unpadded single row
+        return job.max_new_tokens - len(job.output_ids) > 1 and bool(self.attention_mask.all())
+
+    def _speculative_step(self):
+        """Let the draft model propose tokens and keep those the main model agrees with.
+
+        Proposals are accepted with probability min(1, p/q) (p: main model,
+        q: draft) and the first rejected one is resampled from max(p - q, 0),
+        so the output follows the same distribution as normal decoding (and is
+        identical for greedy requests). Every step yields at least one token.
+        """
+        job = self.active[0]
+        started = time.perf_counter()
+        count = min(self.speculative_tokens, job.max_new_tokens - len(job.output_ids) - 1)
+        sequence = job.prompt_ids + job.output_ids
+        vocab_size = self.model.config.vocab_size
+        
+        # Catch the draft's cache up with the sequence, then propose `count` tokens
+        draft_cache = job.draft_cache if job.draft_cache is not None else DynamicCache()
+        pending = sequence[job.draft_length:]
+        proposals, draft_probs = [], []
+        for _ in range(count):
+            logits, draft_cache = self.draft_model.decode_step(
+                torch.tensor([pending], dtype=torch.long), None, None, draft_cache)
+            probs = self._probabilities(logits[:, -1, :], job.temperature, vocab_size)[0]
+            token = int(torch.multinomial(probs, 1)) if job.temperature and job.temperature > 0 else int(probs.argmax())
+            proposals.append(token)
+            draft_probs.append(probs)
+            pending = [token]
+        
+        # Score the last real token and every proposal in one forward pass
+        cache_length = self.attention_mask.shape[1]
+        position = len(sequence) - 1
+        logits, cache = self.model.decode_step(
+            torch.tensor([[sequence[-1]] + proposals], dtype=torch.long),
+            torch.ones(1, cache_length + count + 1, dtype=torch.long),
+            torch.arange(position, position + count + 1).unsqueeze(0),
+            self.cache
+        )
+        target_probs = self._probabilities(logits[0], job.temperature)
+        tokens = []
+        for i, token in enumerate(proposals):
+            p, q = target_probs[i], draft_probs[i]
+            if float(torch.rand(())) * float(q[token]) < float(p[token]):
+                tokens.append(token)
+                continue
+            residual = (p - q).clamp(min=0)
+            tokens.append(int(torch.multinomial(residual, 1)) if residual.sum() > 0 else int(p.argmax()))
+            break
+        else:
+            bonus = target_probs[count]
+            tokens.append(int(torch.multinomial(bonus, 1)) if job.temperature and job.temperature > 0 else int(bonus.argmax()))
+        accepted = len(tokens) - 1
+        
+        # Drop the cache entries of rejected proposals
+        keep = cache_length + 1 + accepted
+        self.cache = _make_cache([(k[:, :, :keep], v[:, :, :keep]) for k, v in _cache_layers(cache)])
+        self.attention_mask = torch.ones(1, keep, dtype=torch.long)
+        self._evict()
+        job.draft_length = len(sequence) + min(accepted, count - 1)
+        job.draft_cache = _make_cache(
+            [(k[:, :, :job.draft_length], v[:, :, :job.draft_length]) for k, v in _cache_layers(draft_cache)])
+        
+        self._record_acceptance(count, accepted)
+        elapsed = time.perf_counter() - started
+        DECODE_STEP_SECONDS.observe(elapsed)
+        job.timing['decode'] += elapsed
+        for token in tokens:
+            if self._append_token(job, token):
+                self._retire([job])
+                return
+
+    def _record_acceptance(self, proposed, accepted):
+        """Track the acceptance rate and pause speculation while it stays poor."""
+        self.proposed_tokens += proposed
+        self.accepted_tokens += accepted
+        SPECULATIVE_PROPOSED.inc(proposed)
+        SPECULATIVE_ACCEPTED.inc(accepted)
+        self.window_proposed += proposed
+        self.window_accepted += accepted
+        if self.window_proposed < self.speculative_window:
+            return
+        rate = self.window_accepted / self.window_proposed
+        SPECULATIVE_ACCEPTANCE.set(round(rate, 4))
+        if rate < self.min_acceptance_rate:
+            print(f'Speculative acceptance rate {rate:.2f} is below {self.min_acceptance_rate}, '
+                  f'pausing speculation for {self.speculative_cooldown} steps')
+            self.speculation_paused = self.speculative_cooldown
+        self.window_proposed = self.window_accepted = 0
+
+    def _append_token(self, job, token):
+        """Record a generated token; return True once the job is finished."""
+        if token is None:
+            job.finish_reason = 'error'
+            job.future.set_exception(RuntimeError('No valid next token: the scores were NaN or every token was masked out'))
+            return True
+        job.output_ids.append(token)
+        if job.first_token_at is None:
+            job.first_token_at = time.monotonic()
+        if token in self.eos_token_ids:
+            job.finish_reason = 'stop'
+        else:
+            previous_length = len(job.text)
+            started = time.perf_counter()
+            job.text += job.detokenizer.step(token)
+            job.timing['detokenize'] += time.perf_counter() - started
+            if len(job.output_ids) >= job.max_new_tokens:
+                job.finish_reason = 'length'
+            if job.grammar is not None:
+                job.grammar.advance(token)
+                if job.grammar.done:
+                    job.finish_reason = 'stop'
+            if job.stop:
+                # Only the newly added text (plus a stop string's length of
+                # context) can contain a stop sequence that wasn't there before
+                search_from = max(previous_length - job.holdback, 0)
+                found = [i for i in (job.text.find(s, search_from) for s in job.stop) if i != -1]
+                if found:
+                    job.text = job.text[:min(found)]
+                    job.finish_reason = 'stop'
+                    job.detokenizer = None
+        if job.finish_reason and job.detokenizer:
+            started = time.perf_counter()
+            job.text += job.detokenizer.flush()
+            job.timing['detokenize'] += time.perf_counter() - started
+        self._emit(job)
+        return job.finish_reason is not None
+
+    def _emit(self, job):
+        """Stream any text that can no longer turn out to be part of a stop string."""
+        if not job.on_text:
+            return
+        ready = len(job.text) if job.finish_reason else len(job.text) - job.holdback
+        if ready > job.emitted:
+            job.on_text(job.text[job.emitted:ready])
+            job.emitted = ready
+
+    def _interrupted(self, job):
+        """Mark a cancelled or expired job as finished."""
+        if job.cancelled:
+            job.finish_reason = 'cancelled'
+        elif job.expired():
+            job.finish_reason = 'timeout'
+        return job.finish_reason is not None
+
+    def _reap(self):
+        """Retire active jobs that were cancelled or ran past their deadline."""
+        finished = [job for job in self.active if self._interrupted(job)]
+        if finished:
+            self._retire(finished)
+
+    def _finish(self, job):
+        self.completed += 1
+        if job.finish_reason == 'cancelled':
+            self.cancelled += 1
+        elif job.finish_reason == 'timeout':
+            self.timed_out += 1
+        self._emit(job)
+        job.finished_at = time.monotonic()
+        self.avg_job_seconds = 0.9 * self.avg_job_seconds + 0.1 * (job.finished_at - job.started_at)
+        job.kv_bytes = job.kv_tokens * self.kv_bytes_per_token
+        job.draft_cache = None
+        result = job.result()
+        observe_job(result)
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _retire(self, finished):
+        """Drop finished rows from the batch and trim all-padding columns."""
+        lengths = self.attention_mask.sum(dim=1).tolist()
+        for job in finished:
+            job.kv_tokens = max(job.kv_tokens, lengths[self.active.index(job)])
+            # A cache the window has cut into no longer lines up with the token ids
+            if job.keep_cache and not job.evicted_tokens:
+                # Copy the row out (without its left padding) before the batch drops it
+                row = self.active.index(job)
+                start = int(self.attention_mask[row].argmax())
+                job.final_layers = [
+                    (k[row:row + 1, :, start:].clone(), v[row:row + 1, :, start:].clone())
+                    for k, v in _cache_layers(self.cache)
+                ]
+            self._finish(job)
+        keep = [i for i, job in enumerate(self.active) if job.finish_reason is None]
+        self.active = [self.active[i] for i in keep]
+        if not self.active:
+            self.cache, self.attention_mask = None, None
+            return
+        index = torch.tensor(keep, dtype=torch.long)
+        mask = self.attention_mask.index_select(0, index)
+        start = int(mask.any(dim=0).long().argmax())
+        self.attention_mask = mask[:, start:]
+        self.cache = _make_cache([
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in _cache_layers(self.cache)
+        ])
+
+# Multi-process worker pool
+#
+# With config['workers'] > 1 this process only routes requests. Each worker
+# process maps the shared weights file, pins itself to its own slice of the
+# CPU cores and runs a normal InferenceScheduler. Jobs go to the worker with
+# the fewest outstanding jobs; text deltas, results and stats come back over
+# a single event queue. A worker that dies fails its outstanding jobs and is
+# restarted.
+
+def _worker_cores(index, workers):
+    """The CPU cores worker `index` is pinned to."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if len(cores) < workers:
+        return [cores[index % len(cores)]]
+    per_worker = len(cores) // workers
+    return cores[index * per_worker:(index + 1) * per_worker]
+
+def _worker_main(index, cores, weights_path, budget_bytes, requests, events):
+    """Entry point of a worker process (see WorkerPool)."""
+    global model, model_config, tokenizer, scheduler
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        threads = config.get('worker_threads') or len(cores)
+        _apply_thread_settings(threads)
+        tokenizer = AutoTokenizer.from_pretrained(_model_source())
+        model = _load_backend(config.get('precision', 'float32'), weights_path)
+        model_config = model.config
+        scheduler = _start_scheduler(model, budget_bytes, draft_model=_load_draft_model())
+        warmup_model()
+    except Exception as e:
+        events.put(('failed', index, str(e)))
+        return
+    events.put(('ready', index, {
+        'pid': os.getpid(),
+        'threads': threads,
+        'precision': model.precision
+    }))
+    
+    def report_stats():
+        while True:
+            events.put(('stats', index, {
+                'scheduler': scheduler.stats(),
+                'prefix_cache': scheduler.prefix_cache.stats() if scheduler.prefix_cache else None,
+                'memory': scheduler.memory.stats() if scheduler.memory else None
+            }))
+            time.sleep(config.get('worker_stats_seconds', 1.0))
+    
+    threading.Thread(target=report_stats, name='worker-stats', daemon=True).start()
+    
+    jobs = {}
+    
+    def report(job_id, future):
+        jobs.pop(job_id, None)
+        error = future.exception()
+        if error is None:
+            events.put(('done', job_id, future.result()))
+        else:
+            events.put(('error', job_id, 'memory' if isinstance(error, MemoryError) else 'error', str(error), None))
+    
+    while True:
+        message = requests.get()
+        if message[0] == 'stop':
+            return
+        if message[0] == 'cancel':
+            if message[1] in jobs:
+                jobs[message[1]].cancel()
+            continue
+        _, job_id, spec = message
+        job = GenerationJob(
+            spec['messages'],
+            max_new_tokens=spec['max_new_tokens'],
+            temperature=spec['temperature'],
+            prompt_ids=spec['prompt_ids'],
+            on_text=(lambda text, job_id=job_id: events.put(('text', job_id, text))) if spec['stream'] else None,
+            stop=spec['stop'],
+            timeout=spec['timeout'],
+            json_schema=spec['json_schema'],
+            tenant=Tenant(*spec['tenant']) if spec['tenant'] else None
+        )
+        jobs[job_id] = job
+        try:
+            future = scheduler.submit(job)
+        except QueueFullError as e:
+            del jobs[job_id]
+            events.put(('error', job_id, 'queue_full', 'Inference queue is full', e.retry_after))
+            continue
+        future.add_done_callback(functools.partial(report, job_id))
+
+class WorkerPool:
+    """Routes jobs to worker processes.
+
+    Offers the parts of the InferenceScheduler interface the request
+    handlers use (submit, retry_after, stats, max_batch_size), so handlers
+    don't care whether they run against one in-process model or a pool.
+    """
+
+    def __init__(self, workers, weights_path, budget_bytes):
+        self.context = multiprocessing.get_context('spawn')
+        self.weights_path = weights_path
+        # With the transformers engine every worker maps the same weights file and
+        # the rest of the budget is split between them; other engines (no weights
+        # file) load a private copy of the model in each worker
+        shared_bytes = os.path.getsize(weights_path) if weights_path else 0
+        self.worker_budget = shared_bytes + max(budget_bytes - shared_bytes, 0) // workers if budget_bytes else 0
+        self.worker_capacity = config.get('max_batch_size', 8) + config.get('max_queue_size', 64)
+        self.max_batch_size = config.get('max_batch_size', 8) * workers
+        self.max_queue_size = config.get('max_queue_size', 64) * workers
+        self.prefix_cache = None
+        self.memory = None
+        self.workers = [{
+            'index': index,
+            'cores': _worker_cores(index, workers),
+            'process': None,
+            'requests': None,
+            'ready': False,
+            'outstanding': 0,
+            'restarts': 0,
+            'info': {},
+            'stats': {}
+        } for index in range(workers)]
+        self.events = self.context.Queue()
+        self.jobs = {}
+        self.next_job_id = 0
+        self.rejected = 0
+        self.started = False
+        self.startup_error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='worker-pool', daemon=True)
+
+    def start(self):
+        """Start the workers and block until all of them are ready."""
+        for worker in self.workers:
+            self._spawn(worker)
+        self.thread.start()
+        with self.condition:
+            while not all(worker['ready'] for worker in self.workers) and self.startup_error is None:
+                self.condition.wait()
+            if self.startup_error:
+                raise RuntimeError(self.startup_error)
+            self.started = True
+        model_state['effective_precision'] = self.workers[0]['info'].get('precision')
+
+    def stop(self):
+        for worker in self.workers:
+            if worker['process'] and worker['process'].is_alive():
+                worker['process'].terminate()
+
+    def _spawn(self, worker):
+        worker['requests'] = self.context.Queue()
+        worker['process'] = self.context.Process(
+            target=_worker_main,
+            args=(worker['index'], worker['cores'], self.weights_path, self.worker_budget,
+                  worker['requests'], self.events),
+            name=f'llm-worker-{worker["index"]}',
+            daemon=True
+        )
+        worker['process'].start()
+        print(f'Started worker {worker["index"]} (pid {worker["process"].pid}) on cores {worker["cores"]}')
+
+    def submit(self, job):
+        with self.condition:
+            ready = [worker for worker in self.workers if worker['ready']]
+            worker = min(ready, key=lambda worker: worker['outstanding'], default=None)
+            if worker is None or worker['outstanding'] >= self.worker_capacity:
+                self.rejected += 1
+                REJECTED_TOTAL.inc()
+                raise QueueFullError(self.retry_after())
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.jobs[job_id] = (job, worker)
+            worker['outstanding'] += 1
+        IN_FLIGHT.inc()
+        job.future.add_done_callback(lambda future: IN_FLIGHT.dec())
+        requests = worker['requests']
+        requests.put(('submit', job_id, {
+            'messages': job.messages,
+            'prompt_ids': job.prompt_ids,
+            'max_new_tokens': job.max_new_tokens,
+            'temperature': job.temperature,
+            'stop': job.stop,
+            'json_schema': job.json_schema,
+            'tenant': (job.tenant.id, job.tenant.lane) if job.tenant else None,
+            # The worker starts its own clock, so send what is left of the deadline
+            'timeout': max(job.deadline - time.monotonic(), 1e-3) if job.deadline else None,
+            'stream': job.on_text is not None
+        }))
+        job.on_cancel = lambda: requests.put(('cancel', job_id))
+        if job.cancelled:
+            job.on_cancel()
+        return job.future
+
+    def retry_after(self):
+        outstanding = sum(worker['outstanding'] for worker in self.workers)
+        return max(1, int(outstanding / max(self.max_batch_size, 1) + 0.5))
+
+    def stats(self):
+        totals = dict.fromkeys(('active', 'pending', 'completed', 'rejected', 'cancelled', 'timed_out', 'kv_cache_bytes'), 0)
+        workers = []
+        for worker in self.workers:
+            scheduler_stats = worker['stats'].get('scheduler') or {}
+            for key in totals:
+                totals[key] += scheduler_stats.get(key, 0)
+            workers.append({
+                'index': worker['index'],
+                'ready': worker['ready'],
+                'cores': worker['cores'],
+                'outstanding': worker['outstanding'],
+                'restarts': worker['restarts'],
+                **worker['info'],
+                **worker['stats']
+            })
+        totals['rejected'] += self.rejected
+        return {
+            **totals,
+            'max_batch_size': self.max_batch_size,
+            'max_queue_size': self.max_queue_size,
+            'weights_path': self.weights_path,
+            'workers': workers
+        }
+
+    def _run(self):
+        while True:
+            try:
+                event = self.events.get(timeout=1.0)
+            except queue.Empty:
+                event = None
+            try:
+                if event:
+                    self._handle(event)
+                self._check_workers()
+            except Exception as e:
+                print(f'Worker pool error: {e}')
+
+    def _handle(self, event):
+        kind = event[0]
+        if kind == 'text':
+            entry = self.jobs.get(event[1])
+            if entry and entry[0].on_text:
+                entry[0].on_text(event[2])
+            return
+        if kind in ('done', 'error'):
+            with self.condition:
+                entry = self.jobs.pop(event[1], None)
+                if entry:
+                    entry[1]['outstanding'] -= 1
+            if entry is None or entry[0].future.done():
+                return
+            job = entry[0]
+            if kind == 'done':
+                result = event[2]
+                job.text, job.finish_reason = result['text'], result['finish_reason']
+                observe_job(result)
+                job.future.set_result(result)
+            elif event[2] == 'queue_full':
+                job.future.set_exception(QueueFullError(event[4]))
+            elif event[2] == 'memory':
+                job.future.set_exception(MemoryError(event[3]))
+            else:
+                job.future.set_exception(RuntimeError(event[3]))
+            return
+        worker = self.workers[event[1]]
+        with self.condition:
+            if kind == 'ready':
+                worker['ready'] = True
+                worker['info'] = event[2]
+                print(f'Worker {worker["index"]} ready (pid {event[2]["pid"]}, {event[2]["threads"]} threads)')
+            elif kind == 'failed':
+                print(f'Worker {worker["index"]} failed to start: {event[2]}')
+                if not self.started:
+                    self.startup_error = f'Worker {worker["index"]} failed to start: {event[2]}'
+            elif kind == 'stats':
+                worker['stats'] = event[2]
+            self.condition.notify_all()
+
+    def _check_workers(self):
+        """Fail the jobs of workers that died and restart them."""
+        for worker in self.workers:
+            process = worker['process']
+            if process is None or process.is_alive():
+                continue
+            with self.condition:
+                lost = [(job_id, job) for job_id, (job, owner) in self.jobs.items() if owner is worker]
+                for job_id, _ in lost:
+                    del self.jobs[job_id]
+                worker['outstanding'], worker['ready'], worker['stats'] = 0, False, {}
+                if not self.started and self.startup_error is None:
+                    self.startup_error = f'Worker {worker["index"]} exited with code {process.exitcode}'
+                self.condition.notify_all()
+            for _, job in lost:
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError(f'Worker {worker["index"]} exited'))
+            if self.started or self.startup_error is None:
+                print(f'Worker {worker["index"]} exited with code {process.exitcode}, restarting')
+                worker['restarts'] += 1
+                self._spawn(worker)
+            else:
+                worker['process'] = None
+
+# Response cache
+#
+# Deterministic (or opted-in) requests are answered from a cache keyed on the
+# normalized chat template text plus generation parameters. Identical
+# requests that arrive while the first is still generating wait for that
+# generation instead of starting their own.
+
+class ResponseCache:
+    """LRU + TTL cache of generation results with optional SQLite persistence."""
+
+    def __init__(self, max_entries=1024, ttl_seconds=86400, path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache '
+                '(key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._load()
+
+    def _load(self):
+        with self.lock:
+            self.db.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+            self.db.commit()
+            rows = self.db.execute(
+                'SELECT key, result, expires_at FROM response_cache ORDER BY expires_at DESC LIMIT ?',
+                (self.max_entries,)
+            ).fetchall()
+            for key, result, expires_at in reversed(rows):
+                self.entries[key] = (expires_at, json.loads(result))
+        print(f'Response cache: restored {len(rows)} entries')
+
+    @staticmethod
+    def key_for(messages, max_new_tokens, temperature, stop=None, json_schema=None):
+        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        text = '\n'.join(line.rstrip() for line in text.replace('\r\n', '\n').split('\n')).strip()
+        payload = json.dumps({
+            'model': config['model_name'],
+            'text': text,
+            'max_new_tokens': max_new_tokens,
+            'temperature': temperature,
+            'stop': stop or [],
+            'json_schema': json_schema
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    @staticmethod
+    def complete(result):
+        """Whether `result` ran to a normal finish; cancelled or timed out
+        output is partial and is neither stored nor shared."""
+        return result is not None and result['finish_reason'] in ('stop', 'length')
+
+    def put(self, key, result):
+        if not self.complete(result):
+            return
+        expires_at = time.time() + self.ttl_seconds
+        with self.lock:
+            self.entries[key] = (expires_at, result)
+            self.entries.move_to_end(key)
+            evicted = []
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[0])
+            if self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO response_cache (key, result, expires_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(result), expires_at)
+                )
+                self.db.executemany('DELETE FROM response_cache WHERE key = ?', [(k,) for k in evicted])
+                self.db.commit()
+
+    async def get_or_generate(self, key, generate):
+        """Return (result, cached), sharing one generation between identical
+        concurrent requests. Requests waiting on a generation that fails, is
+        cancelled or times out run their own instead."""
+        while True:
+            result = self.get(key)
+            if result is not None:
+                return result, True
+            if key not in self.inflight:
+                break
+            self.coalesced += 1
+            result = await asyncio.shield(self.inflight[key])
+            if result is not None:
+                return result, True
+        loop = asyncio.get_running_loop()
+        leader = loop.create_future()
+        self.inflight[key] = leader
+        result = None
+        try:
+            result = await generate()
+            await loop.run_in_executor(None, self.put, key, result)
+            return result, False
+        finally:
+            # Also reached when this request is cancelled, so followers never hang
+            del self.inflight[key]
+            leader.set_result(result if self.complete(result) else None)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds,
+            'persistent': self.db is not None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'inflight': len(self.inflight)
+        }
+
+def _use_response_cache(request):
+    """Cache when the caller opts in, or by default for low-temperature requests."""
+    if response_cache is None or request.cache is False:
+        return False
+    return request.cache or (request.temperature or 0.0) <= config.get('response_cache_max_temperature', 0.2)
+
+@contextlib.asynccontextmanager
+async def cancel_on_disconnect(http_request, jobs):
+    """Cancel every job in `jobs` (which may grow while inside the block)
+    if the client goes away before they finish."""
+    async def watch():
+        while True:
+            if await http_request.is_disconnected():
+                for job in jobs:
+                    job.cancel()
+                return
+            await asyncio.sleep(config.get('disconnect_poll_seconds', 1.0))
+    watcher = asyncio.create_task(watch())
+    try:
+        yield
+    finally:
+        watcher.cancel()
+
+def submit_job(job):
+    """Queue a job on the scheduler, mapping a full queue to 503, and charge
+    it to its tenant."""
+    try:
+        future = scheduler.submit(job)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Inference queue is full, please retry later',
+            headers={'Retry-After': str(e.retry_after)}
+        )
+    if job.tenant and rate_limiter:
+        rate_limiter.reserve(job)
+    return future
+
+# Sessions
+#
+# A session keeps its conversation server-side together with the KV cache
+# of the last turn (prompt plus generated tokens). The next turn's prompt
+# is the same conversation with one more user message, so only the part
+# after the longest common token prefix has to be prefilled. Idle sessions
+# are closed after session_idle_timeout; when the KV caches of all sessions
+# exceed session_kv_mb the least recently used ones lose their cache (not
+# their history) and simply re-prefill on their next turn.
+
+class Session:
+    def __init__(self, session_id, owner, system_prompt=None):
+        self.id = session_id
+        self.owner = owner
+        self.messages = [{'role': 'system', 'content': system_prompt}] if system_prompt else []
+        self.token_ids = []
+        self.layers = None
+        self.kv_bytes = 0
+        self.turns = 0
+        self.busy = False
+        self.created_at = self.last_used = time.time()
+
+    def info(self, idle_timeout, include_messages=False):
+        return SessionInfo(
+            session_id=self.id,
+            created_at=datetime.utcfromtimestamp(self.created_at).isoformat(),
+            last_used_at=datetime.utcfromtimestamp(self.last_used).isoformat(),
+            turns=self.turns,
+            kv_cached_tokens=len(self.token_ids) if self.layers else 0,
+            idle_timeout=idle_timeout,
+            messages=self.messages if include_messages else []
+        )
+
+class SessionStore:
+    """Sessions by id, in least recently used order."""
+
+    def __init__(self, max_bytes, idle_timeout=1800, max_sessions=1000):
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.created = 0
+        self.expired = 0
+        self.kv_evictions = 0
+        self.reused_tokens = 0
+
+    def create(self, owner, system_prompt=None):
+        with self.lock:
+            self._expire()
+            if len(self.sessions) >= self.max_sessions:
+                # Make room by closing the least recently used idle session
+                oldest = next((s for s in self.sessions.values() if not s.busy), None)
+                if oldest is None:
+                    raise QueueFullError(retry_after=60)
+                self._drop(oldest.id)
+            session = Session(os.urandom(16).hex(), owner, system_prompt)
+            self.sessions[session.id] = session
+            self.created += 1
+            return session
+
+    def get(self, session_id, owner):
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None or session.owner != owner:
+                return None
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            return session
+
+    def close(self, session_id, owner):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None or session.owner != owner:
+                return False
+            self._drop(session_id)
+            return True
+
+    def finish_turn(self, session, user_message, job, future):
+        """Record a finished turn (runs as the job future's done callback)."""
+        with self.lock:
+            session.busy = False
+            session.last_used = time.time()
+            if future.exception() is not None or job.finish_reason == 'cancelled':
+                return
+            session.messages.append(user_message)
+            session.messages.append({'role': 'assistant', 'content': job.text})
+            session.turns += 1
+            self.reused_tokens += job.cached_tokens
+            self._set_kv(session, None, [])
+            if job.final_layers and session.id in self.sessions:
+                length = job.final_layers[0][0].shape[2]
+                self._set_kv(session, job.final_layers, (job.prompt_ids + job.output_ids)[:length])
+                self._enforce_budget()
+
+    def _set_kv(self, session, layers, token_ids):
+        self.bytes -= session.kv_bytes
+        session.layers, session.token_ids = layers, token_ids
+        session.kv_bytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size()
+                               for k, v in layers) if layers else 0
+        self.bytes += session.kv_bytes
+
+    def _enforce_budget(self):
+        for session in self.sessions.values():
+            if self.bytes <= self.max_bytes:
+                break
+            if session.layers is not None:
+                self._set_kv(session, None, [])
+                self.kv_evictions += 1
+
+    def _expire(self):
+        cutoff = time.time() - self.idle_timeout
+        for session in [s for s in self.sessions.values() if s.last_used < cutoff and not s.busy]:
+            self._drop(session.id)
+            self.expired += 1
+
+    def _drop(self, session_id):
+        session = self.sessions.pop(session_id)
+        self._set_kv(session, None, [])
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            return {
+                'sessions': len(self.sessions),
+                'max_sessions': self.max_sessions,
+                'kv_mb': round(self.bytes / (1024 * 1024), 1),
+                'max_kv_mb': round(self.max_bytes / (1024 * 1024), 1),
+                'idle_timeout': self.idle_timeout,
+                'created': self.created,
+                'expired': self.expired,
+                'kv_evictions': self.kv_evictions,
+                'reused_tokens': self.reused_tokens
+            }
 
-class LoginResponse(BaseModel):
-    access_token: str
-    token_type: str
-    expires_in: int
+def _session_or_404(session_id, owner):
+    session = session_store.get(session_id, owner)
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Session not found or expired')
+    return session
 
-# App setup
-app = FastAPI(title='Qwen2.5 7B API', description='Secure LLM API with authentication')
-security = HTTPBearer()
-model = None
-tokenizer = None
-config = load_config()
+def _start_session_turn(session, request, on_text=None, tenant=None):
+    """Queue the next turn of `session`; returns (job, future)."""
+    if session.busy:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='A turn is already in progress for this session')
+    user_message = {'role': 'user', 'content': request.message}
+    job = GenerationJob(
+        session.messages + [user_message],
+        max_new_tokens=min(request.max_tokens, config['max_tokens']),
+        temperature=request.temperature,
+        on_text=on_text,
+        stop=request.stop,
+        timeout=request.timeout,
+        tenant=tenant
+    )
+    if session.layers:
+        job.session_cache = (session.token_ids, session.layers)
+    job.keep_cache = True
+    session.busy = True
+    try:
+        future = submit_job(job)
+    except Exception:
+        session.busy = False
+        raise
+    future.add_done_callback(functools.partial(session_store.finish_turn, session, user_message, job))
+    return job, future
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=['*'],
-    allow_credentials=True,
-    allow_methods=['*'],
-    allow_headers=['*'],
+# Long transcript analysis (map-reduce)
+#
+# A long transcript is split into overlapping token-bounded chunks, every
+# chunk is analysed concurrently through the scheduler (the instructions come
+# first in each prompt so they hit the prefix cache), and the per-chunk
+# findings are merged by a final reduce generation.
+
+MAP_PROMPT = (
+    '{instructions}\n\n'
+    'The lesson transcript is too long to analyse at once, so it has been split into {count} '
+    'overlapping parts. Analyse only part {index} below and list your findings concisely, '
+    'quoting evidence from the transcript.\n\n'
+    'Transcript part {index} of {count}:\n{chunk}'
 )
 
-# Static files setup
-if os.path.exists('frontend'):
-    app.mount('/static', StaticFiles(directory='frontend'), name='static')
+REDUCE_PROMPT = (
+    '{instructions}\n\n'
+    'The lesson transcript was analysed in {count} consecutive parts. The parts overlap slightly, '
+    'so the same moment may appear twice. Combine the findings below into one complete analysis '
+    'of the whole lesson, following the instructions above.\n\n{findings}'
+)
 
-# Model loading with memory optimization
-async def load_model():
-    global model, tokenizer
-    if model is None:
-        print('Loading Qwen2.5 7B model with memory optimizations...')
+def split_transcript(transcript, chunk_tokens, overlap_tokens):
+    """Split text into chunks of at most `chunk_tokens` tokens, each
+    overlapping the previous one by `overlap_tokens`."""
+    ids = tokenizer(transcript, add_special_tokens=False).input_ids
+    if len(ids) <= chunk_tokens:
+        return [transcript]
+    chunks = []
+    start = 0
+    while True:
+        end = start + chunk_tokens
+        if end >= len(ids):
+            chunks.append(tokenizer.decode(ids[start:]))
+            return chunks
+        end = _clean_cut(ids, end, start, end)
+        chunks.append(tokenizer.decode(ids[start:end]))
+        start = _clean_cut(ids, max(end - overlap_tokens, start + 1), start, end)
+
+def _clean_cut(ids, index, lowest, highest):
+    """Move a split point by up to 3 tokens (back first, staying within
+    (lowest, highest]) so it doesn't fall inside a multi-byte character.
+    Byte-level tokens can hold part of a character; a cut there decodes to
+    U+FFFD on both sides instead of the character, so the two halves don't
+    match the whole."""
+    candidates = [index - step for step in range(4)] + [index + step for step in range(1, 4)]
+    for cut in (cut for cut in candidates if lowest < cut <= highest):
+        window = ids[max(cut - 4, 0):cut + 4]
+        middle = cut - max(cut - 4, 0)
+        if tokenizer.decode(window) == tokenizer.decode(window[:middle]) + tokenizer.decode(window[middle:]):
+            return cut
+    return index
+
+def count_tokens(text):
+    return len(tokenizer(text, add_special_tokens=False).input_ids)
+
+async def _generate_text(prompt, max_new_tokens, temperature, jobs, tenant=None):
+    job = GenerationJob([{'role': 'user', 'content': prompt}], max_new_tokens=max_new_tokens, temperature=temperature,
+                        tenant=tenant)
+    jobs.append(job)
+    result = await asyncio.wrap_future(submit_job(job))
+    if result['finish_reason'] in ('cancelled', 'timeout'):
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=f'Transcript analysis {result["finish_reason"]}')
+    return result['text'].strip()
+
+async def _reduce_findings(instructions, findings, chunk_tokens, max_new_tokens, temperature, jobs, tenant=None):
+    """Merge findings, reducing in groups first if they don't fit one prompt."""
+    loop = asyncio.get_running_loop()
+    sizes = await loop.run_in_executor(None, lambda: [count_tokens(f) for f in findings])
+    groups, current, current_size = [], [], 0
+    for finding, size in zip(findings, sizes):
+        if current and current_size + size > chunk_tokens:
+            groups.append(current)
+            current, current_size = [], 0
+        current.append(finding)
+        current_size += size
+    groups.append(current)
+    
+    def reduce_prompt(group):
+        parts = '\n\n'.join(f'Findings from part {i}:\n{f}' for i, f in enumerate(group, 1))
+        return REDUCE_PROMPT.format(instructions=instructions, count=len(group), findings=parts)
+    
+    if len(groups) == 1 or len(groups) == len(findings):
+        # Everything fits, or grouping can't shrink the findings any further
+        return await _generate_text(reduce_prompt(findings), max_new_tokens, temperature, jobs, tenant)
+    merged = await asyncio.gather(*[
+        _generate_text(reduce_prompt(group), max_new_tokens, temperature, jobs, tenant) for group in groups
+    ])
+    return await _reduce_findings(instructions, list(merged), chunk_tokens, max_new_tokens, temperature, jobs, tenant)
+
+# Asynchronous jobs
+#
+# POST /jobs stores a /chat or /analyze/transcript request in a SQLite table
+# and returns straight away. A dispatcher task on the event loop runs up to
+# job_concurrency jobs at a time, highest priority first and oldest first
+# within a priority (preferring tenants with fewer running jobs), through the
+# same code as the synchronous endpoints, in the scheduler's bulk lane.
+# Jobs that were running when the server stopped are queued again at
+# startup and rerun from the beginning (generation state is not
+# checkpointed), up to job_max_attempts times. A finished job's info is
+# POSTed to its callback_url, which must point at one of job_callback_hosts.
+
+JOB_TYPES = {
+    'chat': (ChatMessage, lambda request, jobs, tenant: _chat_response(request, jobs, tenant)),
+    'transcript': (TranscriptAnalysisRequest, lambda request, jobs, tenant: _transcript_analysis(request, jobs, tenant))
+}
+JOB_FINISHED = ('completed', 'failed', 'cancelled')
+
+def _timestamp(seconds):
+    return datetime.utcfromtimestamp(seconds).isoformat() if seconds else None
+
+class JobQueue:
+    """Persistent priority queue of asynchronous jobs."""
+
+    COLUMNS = 'id, type, status, priority, attempts, created_at, started_at, finished_at, error, result, callback_url'
+
+    def __init__(self, path, concurrency=2, max_pending_per_user=100, max_attempts=3, retention_seconds=7 * 86400):
+        self.concurrency = concurrency
+        self.max_pending_per_user = max_pending_per_user
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs '
+            '(id TEXT PRIMARY KEY, owner TEXT NOT NULL, type TEXT NOT NULL, request TEXT NOT NULL, '
+            'priority INTEGER NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, callback_url TEXT, '
+            'result TEXT, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL)'
+        )
+        if 'tenant' not in [column[1] for column in self.db.execute('PRAGMA table_info(jobs)')]:
+            self.db.execute('ALTER TABLE jobs ADD COLUMN tenant TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, priority DESC, created_at)')
+        self.running = {}  # Job id -> (asyncio task, list of its GenerationJobs)
+        self.cancelled = set()
+        self.completed = 0
+        self.failed = 0
+        self.wakeup = None
+        self.dispatcher = None
+        with self.db:
+            self.db.execute('DELETE FROM jobs WHERE finished_at < ?', (time.time() - retention_seconds,))
+            resumed = self.db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+        queued = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        print(f'Job queue: {queued} queued ({resumed} resumed after restart)')
+
+    def start(self):
+        """Start the dispatcher on the running event loop."""
+        self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    def submit(self, owner, job_type, request, priority=0, callback_url=None, tenant=None):
+        pending = self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE owner = ? AND status IN ('queued', 'running')", (owner,)
+        ).fetchone()[0]
+        if pending >= self.max_pending_per_user:
+            raise QueueFullError(retry_after=60)
+        job_id = os.urandom(16).hex()
+        with self.db:
+            self.db.execute(
+                'INSERT INTO jobs (id, owner, tenant, type, request, priority, status, attempts, callback_url, created_at) '
+                "VALUES (?, ?, ?, ?, ?, ?, 'queued', 0, ?, ?)",
+                (job_id, owner, tenant, job_type, json.dumps(request), priority, callback_url, time.time())
+            )
+        self.wakeup.set()
+        return self.get(job_id, owner)
+
+    def get(self, job_id, owner, include_result=False):
+        row = self.db.execute(f'SELECT {self.COLUMNS} FROM jobs WHERE id = ? AND owner = ?', (job_id, owner)).fetchone()
+        return self._info(row, include_result) if row else None
+
+    def list(self, owner, limit=100):
+        rows = self.db.execute(
+            f'SELECT {self.COLUMNS} FROM jobs WHERE owner = ? ORDER BY created_at DESC LIMIT ?', (owner, limit)
+        ).fetchall()
+        return [self._info(row) for row in rows]
+
+    def cancel(self, job_id, owner):
+        """Cancel a queued or running job; returns its info, or None if unknown."""
+        info = self.get(job_id, owner)
+        if info is None or info.status in JOB_FINISHED:
+            return info
+        self._finish(job_id, 'cancelled', error='Cancelled by user')
+        if job_id in self.running:
+            self.cancelled.add(job_id)
+            task, jobs = self.running[job_id]
+            for job in jobs:
+                job.cancel()
+            task.cancel()  # _run sends the callback once the task has stopped
+        else:
+            self._notify(job_id)
+        return self.get(job_id, owner)
+
+    def _info(self, row, include_result=False):
+        job_id, job_type, status, priority, attempts, created_at, started_at, finished_at, error, result, _ = row
+        position = None
+        if status == 'queued':
+            position = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND "
+                '(priority > ? OR (priority = ? AND created_at < ?))',
+                (priority, priority, created_at)
+            ).fetchone()[0]
+        return JobInfo(
+            job_id=job_id,
+            type=job_type,
+            status=status,
+            priority=priority,
+            attempts=attempts,
+            position=position,
+            created_at=_timestamp(created_at),
+            started_at=_timestamp(started_at),
+            finished_at=_timestamp(finished_at),
+            error=error,
+            result=json.loads(result) if include_result and result else None
+        )
+
+    async def _dispatch(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while len(self.running) < self.concurrency:
+                row = self._claim()
+                if row is None:
+                    break
+                job_id, job_type, request, callback_url, tenant = row
+                jobs = []
+                task = asyncio.create_task(self._run(job_id, job_type, request, callback_url, Tenant(tenant, 'bulk'), jobs))
+                self.running[job_id] = (task, jobs)
+
+    def _claim(self):
+        """Mark the next queued job as running and return it. Within a
+        priority, tenants with fewer running jobs go first."""
+        with self.db:
+            while True:
+                row = self.db.execute(
+                    "SELECT id, type, request, callback_url, COALESCE(tenant, owner), attempts FROM jobs AS queued "
+                    "WHERE status = 'queued' ORDER BY priority DESC, "
+                    "(SELECT COUNT(*) FROM jobs WHERE status = 'running' AND "
+                    'COALESCE(tenant, owner) = COALESCE(queued.tenant, queued.owner)), created_at LIMIT 1'
+                ).fetchone()
+                if row is None:
+                    return None
+                job_id, job_type, request, callback_url, tenant, attempts = row
+                if attempts < self.max_attempts:
+                    break
+                # Started max_attempts times without finishing: the server keeps
+                # going down while running it, so don't try again
+                self.db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    (f'Interrupted {attempts} times, giving up', time.time(), job_id)
+                )
+                self.failed += 1
+            self.db.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+        return job_id, job_type, request, callback_url, tenant
+
+    async def _run(self, job_id, job_type, request, callback_url, tenant, jobs):
+        model_type, handler = JOB_TYPES[job_type]
         try:
-            # Force garbage collection before loading
-            gc.collect()
-            torch.cuda.empty_cache() if torch.cuda.is_available() else None
-            
-            print('Loading tokenizer...')
-            tokenizer = AutoTokenizer.from_pretrained(config['model_name'])
-            
-            print('Loading model with optimized settings...')
-            model = AutoModelForCausalLM.from_pretrained(
-                config['model_name'],
-                torch_dtype=torch.float32,
-                device_map='cpu',
-                trust_remote_code=True,
-                low_cpu_mem_usage=True,  # Enable memory optimization
-                max_memory={0: "12GiB"}  # Limit memory usage
+            await load_model()
+            response = await handler(model_type(**json.loads(request)), jobs, tenant)
+            self._finish(job_id, 'completed', result=jsonable_encoder(response))
+        except asyncio.CancelledError:
+            # Cancelled by the user (already recorded) or by server shutdown,
+            # in which case the job stays 'running' and is resumed at startup
+            if job_id not in self.cancelled:
+                raise
+        except HTTPException as e:
+            self._finish(job_id, 'failed', error=str(e.detail))
+        except Exception as e:
+            self._finish(job_id, 'failed', error=str(e) or type(e).__name__)
+        finally:
+            for job in jobs:
+                if not job.future.done():
+                    job.cancel()
+            del self.running[job_id]
+            self.cancelled.discard(job_id)
+            self.wakeup.set()
+        self._notify(job_id)
+
+    def _notify(self, job_id):
+        """Send a finished job's info to its callback_url in the background."""
+        row = self.db.execute(f'SELECT {self.COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row[-1]:
+            payload = jsonable_encoder(self._info(row, include_result=True))
+            asyncio.get_running_loop().run_in_executor(None, _post_callback, row[-1], payload)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self.db:
+            self.db.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?',
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
             )
-            
-            # Force garbage collection after loading
-            gc.collect()
-            
-            print('Model loaded successfully!')
-            print(f'Model parameters: {model.num_parameters():,}')
-            
+        if status == 'completed':
+            self.completed += 1
+        elif status == 'failed':
+            self.failed += 1
+
+    def stats(self):
+        counts = dict(self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {
+            'queued': counts.get('queued', 0),
+            'running': len(self.running),
+            'concurrency': self.concurrency,
+            'completed': self.completed,
+            'failed': self.failed,
+            'stored': sum(counts.values())
+        }
+
+def _post_callback(url, payload, attempts=3):
+    """POST `payload` as JSON to `url`, retrying with backoff."""
+    body = json.dumps(payload).encode('utf-8')
+    for attempt in range(attempts):
+        try:
+            request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=config.get('job_callback_timeout', 10)):
+                return True
         except Exception as e:
-            print(f'Error loading model: {e}')
-            # Clean up on error
-            if 'model' in locals():
-                del model
-            if 'tokenizer' in locals():
-                del tokenizer
-            gc.collect()
-            raise
+            print(f'Job callback to {url} failed (attempt {attempt + 1}): {e}')
+            if attempt + 1 < attempts:
+                time.sleep(2 ** attempt)
+    return False
+
+def _check_callback_url(url):
+    parsed = urllib.parse.urlparse(url)
+    allowed = config.get('job_callback_hosts', ['localhost', '127.0.0.1', '::1'])
+    if parsed.scheme not in ('http', 'https') or parsed.hostname not in allowed:
+        raise HTTPException(
+            status_code=400, detail=f'callback_url must be an http(s) URL on one of: {", ".join(allowed)}')
+
+def _job_or_404(job_id, owner, include_result=False):
+    info = job_queue.get(job_id, owner, include_result)
+    if info is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found')
+    return info
+
+# Embeddings and vector indexes
+#
+# /embeddings mean-pools the last hidden state over each input's tokens and
+# L2-normalises it, so a dot product is the cosine similarity. Inputs are
+# sorted by length and run in embedding_batch_size batches on a single
+# thread, so embedding requests neither pad much nor compete with each
+# other for cores. The encoder is config['embedding_model'] when set (loaded
+# on first use), otherwise the served model without its LM head, which
+# needs the transformers engine in this process (workers = 1). The served
+# model's batches run on the scheduler thread between decode steps, so they
+# never overlap a generation's forward pass, and tokenizing uses a private
+# copy of the tokenizer (a fast tokenizer can't be used from two threads).
+#
+# A vector index is a directory holding vectors.f32 (float32 rows back to
+# back, memory mapped) and index.json (ids, metadata, dimensions). New rows
+# are written to vectors.f32 before index.json is replaced, so a crash in
+# between only leaves unreferenced rows that the next add overwrites.
+# Search is a brute-force dot product over the mapped rows, which takes
+# milliseconds for tens of thousands of lessons.
+
+embedding_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embeddings')
+embedding_encoder = None  # (tokenizer, model) for config['embedding_model']
+embedding_tokenizer = (None, None)  # (served tokenizer, private copy of it)
+
+def _embedding_source():
+    """(name, tokenizer, encoder, run) that embeddings are computed with;
+    `run(function)` calls `function` where the encoder may be used."""
+    global embedding_encoder, embedding_tokenizer
+    name = config.get('embedding_model')
+    if name:
+        if embedding_encoder is None:
+            print(f'Loading embedding model {name}...')
+            embedding_encoder = (AutoTokenizer.from_pretrained(name), AutoModel.from_pretrained(name).eval())
+        return name, *embedding_encoder, lambda function: function()
+    served = scheduler
+    if not isinstance(model, TransformersBackend) or not isinstance(served, InferenceScheduler):
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail='Embeddings from the served model need the transformers engine and workers = 1; '
+                   'set embedding_model to use a separate encoder')
+    if embedding_tokenizer[0] is not tokenizer:
+        embedding_tokenizer = (tokenizer, copy.deepcopy(tokenizer))
+
+    def run(function):
+        return served.call(function).result()
+
+    return config['model_name'], embedding_tokenizer[1], model.model.base_model, run
+
+def embed_texts(texts):
+    """Embed `texts`; returns (encoder name, float32 array, token count).
+    Runs on embedding_executor."""
+    started = time.perf_counter()
+    name, encoder_tokenizer, encoder, run = _embedding_source()
+    batch_size = config.get('embedding_batch_size', 32)
+    # Capped by slicing rather than truncation=True, which changes the tokenizer's settings
+    max_tokens = config.get('embedding_max_tokens', 512)
+    ids = [row[:max_tokens] for row in encoder_tokenizer(texts).input_ids]
+    # Similar lengths share a batch so little of it is padding
+    order = sorted(range(len(texts)), key=lambda index: len(ids[index]))
+    vectors = np.zeros((len(texts), encoder.config.hidden_size), dtype=np.float32)
+
+    def encode(input_ids, mask):
+        with torch.inference_mode():
+            hidden = encoder(input_ids=input_ids, attention_mask=mask).last_hidden_state.float()
+            pooled = (hidden * mask.unsqueeze(-1)).sum(dim=1) / mask.sum(dim=1, keepdim=True)
+            return torch.nn.functional.normalize(pooled, dim=-1).numpy()
+
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        width = max(len(ids[index]) for index in rows)
+        # Right padding keeps position ids correct for decoder models too
+        input_ids = torch.zeros(len(rows), width, dtype=torch.long)
+        mask = torch.zeros(len(rows), width, dtype=torch.long)
+        for row, index in enumerate(rows):
+            input_ids[row, :len(ids[index])] = torch.tensor(ids[index])
+            mask[row, :len(ids[index])] = 1
+        vectors[rows] = run(functools.partial(encode, input_ids, mask))
+    EMBEDDING_SECONDS.observe(time.perf_counter() - started)
+    return name, vectors, sum(map(len, ids))
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class VectorIndex:
+    """One named index of unit-length vectors with ids and metadata."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.manifest_path = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        self.ids = []
+        self.metadata = []
+        self.dimensions = None
+        self.model = None
+        self.vectors = None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                saved = json.load(f)
+            self.ids, self.metadata = saved['ids'], saved['metadata']
+            self.dimensions, self.model = saved['dimensions'], saved['model']
+            self._map()
+        self.positions = {item_id: position for position, item_id in enumerate(self.ids)}
+
+    def _map(self):
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                 shape=(len(self.ids), self.dimensions)) if self.ids else None
+
+    def add(self, ids, vectors, metadata, model=None):
+        """Insert or replace rows by id; returns (added, updated)."""
+        with self.lock:
+            if self.dimensions is None:
+                self.dimensions = vectors.shape[1]
+            if vectors.shape[1] != self.dimensions:
+                raise ValueError(f'Index has {self.dimensions} dimensions, got {vectors.shape[1]}')
+            if model and self.model and model != self.model:
+                raise ValueError(f'Index was built with {self.model}, not {model}')
+            self.model = self.model or model
+            vectors = _normalize(vectors.astype(np.float32))
+            latest = {item_id: index for index, item_id in enumerate(ids)}  # Last one wins
+            new = [index for item_id, index in latest.items() if item_id not in self.positions]
+            for item_id, index in latest.items():
+                position = self.positions.get(item_id)
+                if position is not None:
+                    self.vectors[position] = vectors[index]
+                    self.metadata[position] = metadata[index]
+            if self.vectors is not None:
+                self.vectors.flush()
+            if new:
+                os.makedirs(self.directory, exist_ok=True)
+                mode = 'r+b' if os.path.exists(self.vectors_path) else 'wb'
+                with open(self.vectors_path, mode) as f:
+                    f.seek(len(self.ids) * self.dimensions * 4)
+                    f.write(vectors[new].tobytes())
+                    f.truncate()
+                for index in new:
+                    self.positions[ids[index]] = len(self.ids)
+                    self.ids.append(ids[index])
+                    self.metadata.append(metadata[index])
+            self._save()
+            self._map()
+            return len(new), len(latest) - len(new)
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        staging = self.manifest_path + '.tmp'
+        with open(staging, 'w') as f:
+            json.dump({'ids': self.ids, 'metadata': self.metadata, 'dimensions': self.dimensions, 'model': self.model}, f)
+        os.replace(staging, self.manifest_path)
+
+    def search(self, query, top_k):
+        """The top_k (id, score, metadata) by cosine similarity to `query`."""
+        started = time.perf_counter()
+        with self.lock:
+            if self.vectors is None:
+                return []
+            if query.shape[0] != self.dimensions:
+                raise ValueError(f'Index has {self.dimensions} dimensions, got {query.shape[0]}')
+            scores = self.vectors @ _normalize(query[None].astype(np.float32))[0]
+            top_k = min(top_k, len(scores))
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            best = best[np.argsort(-scores[best])]
+            matches = [(self.ids[i], float(scores[i]), self.metadata[i]) for i in best]
+        VECTOR_SEARCH_SECONDS.observe(time.perf_counter() - started)
+        return matches
+
+class VectorStore:
+    """Each owner's named VectorIndexes, under one directory per owner."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def _path(self, owner, name):
+        return os.path.join(self.directory, _digest(owner)[:16], name)
+
+    def get(self, owner, name, create=False):
+        """The index, loading it on first use; None if it doesn't exist and not `create`."""
+        path = self._path(owner, name)
+        with self.lock:
+            if path not in self.indexes:
+                if not create and not os.path.exists(path):
+                    return None
+                self.indexes[path] = VectorIndex(path)
+            return self.indexes[path]
+
+    def delete(self, owner, name):
+        path = self._path(owner, name)
+        with self.lock:
+            self.indexes.pop(path, None)
+            if not os.path.exists(path):
+                return False
+            shutil.rmtree(path)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'loaded_indexes': len(self.indexes), 'vectors': sum(len(index.ids) for index in self.indexes.values())}
+
+VECTOR_INDEX_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def _vector_index(owner, name, create=False):
+    if not VECTOR_INDEX_NAME.match(name):
+        raise HTTPException(status_code=400, detail='Index names are 1-64 letters, digits, "-" or "_"')
+    index = vector_store.get(owner, name, create)
+    if index is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Vector index not found')
+    return index
+
+def _index_info(name, index, added=None, updated=None):
+    return VectorIndexInfo(name=name, count=len(index.ids), dimensions=index.dimensions, model=index.model,
+                           added=added, updated=updated)
+
+async def _embed(texts, tenant=None):
+    """Embed `texts` off the event loop, charging the tokens to `tenant`."""
+    if any(not text.strip() for text in texts):
+        raise HTTPException(status_code=400, detail='Texts to embed must not be empty')
+    if not config.get('embedding_model'):
+        try:
+            await load_model()
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f'Model loading failed: {str(e)}')
+    name, vectors, tokens = await asyncio.get_running_loop().run_in_executor(embedding_executor, embed_texts, texts)
+    if tenant and rate_limiter:
+        rate_limiter.charge(tenant.id, tokens)
+        TENANT_TOKENS_TOTAL.inc(tokens, tenant=tenant.id)
+    return name, vectors, tokens
 
 # Auth functions
-def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)) -> bool:
-    if credentials.credentials in config['api_keys']:
-        return True
-    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid API key')
+#
+# API keys are looked up by their SHA-256 digest in a dict built once at
+# startup, so a request never scans config['api_keys']. JWTs that have been
+# verified once are kept in a bounded LRU (keyed by digest) until
+# auth_cache_ttl or the token's own expiry, whichever is first. The auth
+# dependencies are coroutines, so the common path never leaves the event
+# loop; only bcrypt runs on its own small thread pool (bcrypt_threads), which
+# caps how many CPU cores a login burst can take.
 
-def verify_jwt_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
-    try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        username: str = payload.get('sub')
-        if username is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid token')
+def _digest(secret):
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+def _api_key_tenant(api_key):
+    return 'key-' + _digest(api_key)[:12]
+
+api_key_index = {_digest(key): _api_key_tenant(key) for key in config['api_keys']}
+password_executor = ThreadPoolExecutor(max_workers=config.get('bcrypt_threads', 2), thread_name_prefix='bcrypt')
+
+class TokenCache:
+    """Bounded LRU of verified JWTs: digest -> (username, valid until)."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        key = _digest(token)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, token, username, expires_at):
+        if self.max_entries <= 0:
+            return
+        self.entries[_digest(token)] = (username, min(time.time() + self.ttl_seconds, expires_at))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+token_cache = TokenCache(config.get('auth_cache_size', 4096), config.get('auth_cache_ttl', 300))
+
+def verify_api_key(api_key: str) -> bool:
+    return _digest(api_key) in api_key_index
+
+async def verify_jwt_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    token = credentials.credentials
+    if verify_api_key(token):
+        return 'api_user'
+    username = token_cache.get(token)
+    if username is not None:
         return username
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except JWTError:
-        try:
-            verify_api_key(credentials)
-            return 'api_user'
-        except:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid token or API key')
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid token or API key')
+    username: str = payload.get('sub')
+    # Tokens are only issued with an expiry; one without it never stops being valid
+    if username is None or payload.get('exp') is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid token')
+    token_cache.put(token, username, payload['exp'])
+    return username
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(
+        password_executor, bcrypt.checkpw, plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
     to_encode.update({'exp': expire})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    token_cache.put(encoded_jwt, data['sub'], expire.replace(tzinfo=timezone.utc).timestamp())
     return encoded_jwt
 
+# Tenants, rate limits and priority lanes
+#
+# Every API key and every JWT user is a tenant (API keys are identified by a
+# hash so the key itself never shows up in stats or metrics). Each tenant has
+# a token bucket refilled at rate_limit_tokens_per_minute up to
+# rate_limit_burst_tokens, and every generation is charged its prompt plus
+# completion tokens: max_tokens is taken when the job is queued and the
+# difference is settled when it finishes. A bucket may go into debt; while
+# it is empty the tenant gets 429 with Retry-After set to the refill time.
+# Jobs run in the interactive or the bulk lane. The scheduler always admits
+# interactive jobs first, caps bulk jobs at bulk_batch_share of the batch,
+# and takes jobs round robin between tenants within a lane, so one tenant's
+# burst cannot hold back everyone else's requests.
+
+class Tenant:
+    """Who a generation is charged to and which lane it runs in."""
+
+    def __init__(self, tenant_id, lane=LANES[0]):
+        self.id = tenant_id
+        self.lane = lane
+
+    def bulk(self):
+        return Tenant(self.id, 'bulk')
+
+def _tenant_settings(tenant_id):
+    """The tenant's entry in config['tenants'], keyed by username or API key."""
+    for name, settings in config.get('tenants', {}).items():
+        if tenant_id in (name, _api_key_tenant(name)):
+            return settings
+    return {}
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity):
+        self.rate = per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class RateLimiter:
+    """Per-tenant token buckets; a tenant without a limit has no bucket."""
+
+    def __init__(self, tokens_per_minute, burst_tokens):
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_tokens = burst_tokens
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def _bucket(self, tenant_id):
+        if tenant_id not in self.buckets:
+            settings = _tenant_settings(tenant_id)
+            per_minute = settings.get('tokens_per_minute', self.tokens_per_minute)
+            burst = settings.get('burst_tokens', self.burst_tokens) or per_minute
+            self.buckets[tenant_id] = TokenBucket(per_minute, burst) if per_minute > 0 else None
+        bucket = self.buckets[tenant_id]
+        if bucket:
+            bucket.refill()
+        return bucket
+
+    def retry_after(self, tenant_id):
+        """Seconds until the tenant's bucket has tokens again, 0 if it has now."""
+        with self.lock:
+            bucket = self._bucket(tenant_id)
+            if bucket is None or bucket.tokens > 0:
+                return 0
+            self.rejected += 1
+            return max(1, int(-bucket.tokens / bucket.rate + 1))
+
+    def charge(self, tenant_id, tokens):
+        with self.lock:
+            bucket = self._bucket(tenant_id)
+            if bucket:
+                bucket.tokens -= tokens
+
+    def reserve(self, job):
+        """Charge max_tokens now and settle to the tokens actually used."""
+        tenant_id = job.tenant.id
+        reserved = job.max_new_tokens
+        self.charge(tenant_id, reserved)
+
+        def settle(future):
+            used = 0
+            if not future.cancelled() and future.exception() is None:
+                result = future.result()
+                used = result['prompt_tokens'] + result['completion_tokens']
+                TENANT_TOKENS_TOTAL.inc(used, tenant=tenant_id)
+            self.charge(tenant_id, used - reserved)
+
+        job.future.add_done_callback(settle)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'tokens_per_minute': self.tokens_per_minute,
+                'burst_tokens': self.burst_tokens,
+                'rejected': self.rejected,
+                'tokens_available': {
+                    tenant_id: int(self._bucket(tenant_id).tokens)
+                    for tenant_id, bucket in list(self.buckets.items()) if bucket
+                }
+            }
+
+async def current_tenant(http_request: Request, credentials: HTTPAuthorizationCredentials = Depends(security),
+                         current_user: str = Depends(verify_jwt_token)) -> Tenant:
+    """The caller's tenant; X-Priority: bulk moves a request to the bulk lane."""
+    tenant_id = api_key_index.get(_digest(credentials.credentials), current_user)
+    lane = _tenant_settings(tenant_id).get('priority', LANES[0])
+    if http_request.headers.get('x-priority', '').lower() == 'bulk':
+        lane = 'bulk'
+    return Tenant(tenant_id, lane if lane in LANES else LANES[0])
+
+async def rate_limit(tenant: Tenant = Depends(current_tenant)) -> Tenant:
+    """current_tenant, rejecting the request with 429 while its budget is used up."""
+    retry_after = rate_limiter.retry_after(tenant.id) if rate_limiter else 0
+    if retry_after:
+        RATE_LIMITED_TOTAL.inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail='Token budget exhausted, please retry later',
+            headers={'Retry-After': str(retry_after)}
+        )
+    return tenant
+
 # Routes - Chat Interface (serve frontend)
 @app.get('/chat-ui')
 async def chat_ui():
@@ -176,14 +3940,49 @@ async def health():
         'status': 'healthy', 
         'model': 'Qwen2.5-7B-Instruct',
         'timestamp': datetime.utcnow().isoformat(),
-        'model_loaded': model is not None,
+        'model_loaded': model is not None or isinstance(scheduler, WorkerPool),
+        'ready': model_state['status'] == 'ready',
+        'precision': model_state['effective_precision'],
+        'model_state': model_state,
+        'scheduler': scheduler.stats() if scheduler else None,
+        'prefix_cache': scheduler.prefix_cache.stats() if scheduler and scheduler.prefix_cache else None,
+        'response_cache': response_cache.stats() if response_cache else None,
+        'memory': scheduler.memory.stats() if scheduler and scheduler.memory else None,
+        'sessions': session_store.stats() if session_store else None,
+        'jobs': job_queue.stats() if job_queue else None,
+        'rate_limits': rate_limiter.stats() if rate_limiter else None,
+        'vectors': vector_store.stats() if vector_store else None,
+        'auth': {'api_keys': len(api_key_index), 'token_cache': token_cache.stats()},
         'server': 'Amazon Linux 2023'
     }
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus scrape endpoint."""
+    if scheduler:
+        stats = scheduler.stats()
+        QUEUE_DEPTH.set(stats['pending'])
+        ACTIVE_SEQUENCES.set(stats['active'])
+        KV_CACHE_BYTES.set(stats['kv_cache_bytes'])
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+@app.get('/health/live')
+async def health_live():
+    """Liveness probe: the process is up and the event loop is responsive."""
+    return {'status': 'alive', 'timestamp': datetime.utcnow().isoformat()}
+
+@app.get('/health/ready')
+async def health_ready():
+    """Readiness probe: only 200 once the model is loaded and warmed up."""
+    body = {'ready': model_state['status'] == 'ready', **model_state}
+    if not body['ready']:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=body)
+    return body
+
 @app.post('/auth/login', response_model=LoginResponse)
 async def login(request: LoginRequest):
     user_hash = config['users'].get(request.username)
-    if not user_hash or not verify_password(request.password, user_hash):
+    if not user_hash or not await verify_password(request.password, user_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid username or password')
     
     access_token = create_access_token(data={'sub': request.username})
@@ -194,49 +3993,497 @@ async def login(request: LoginRequest):
     )
 
 @app.post('/chat', response_model=ChatResponse)
-async def chat(request: ChatMessage, current_user: str = Depends(verify_jwt_token)):
+async def chat(request: ChatMessage, http_request: Request, tenant: Tenant = Depends(rate_limit)):
     try:
         await load_model()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f'Model loading failed: {str(e)}')
     
+    jobs = []
     try:
-        # Prepare the chat message
-        messages = [{'role': 'user', 'content': request.message}]
-        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        
-        # Tokenize input
-        model_inputs = tokenizer([text], return_tensors='pt')
-        
-        # Generate response with memory management
-        with torch.no_grad():
-            generated_ids = model.generate(
-                model_inputs.input_ids,
-                max_new_tokens=min(request.max_tokens, config['max_tokens']),
-                temperature=request.temperature,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-                use_cache=True,  # Enable KV cache for efficiency
-                early_stopping=True  # Stop early when possible
+        async with cancel_on_disconnect(http_request, jobs):
+            return await _chat_response(request, jobs, tenant)
+    except HTTPException:
+        raise
+    except MemoryError as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Error generating response: {str(e)}')
+
+async def _chat_response(request, jobs, tenant=None):
+    """Generate the ChatResponse for `request`, appending its GenerationJob to `jobs`."""
+    # Queue the sequence on the continuous batching scheduler; templating,
+    # tokenization and decoding all happen on the scheduler thread
+    messages = [{'role': 'user', 'content': request.message}]
+    max_new_tokens = min(request.max_tokens, config['max_tokens'])
+    json_schema = _json_schema(request.response_format)
+    
+    async def generate():
+        job = GenerationJob(
+            messages,
+            max_new_tokens=max_new_tokens,
+            temperature=request.temperature,
+            stop=request.stop,
+            timeout=request.timeout,
+            json_schema=json_schema,
+            tenant=tenant
+        )
+        jobs.append(job)
+        return await asyncio.wrap_future(submit_job(job))
+    
+    if _use_response_cache(request):
+        key = await asyncio.get_running_loop().run_in_executor(
+            None, ResponseCache.key_for, messages, max_new_tokens, request.temperature, request.stop, json_schema)
+        result, cached = await response_cache.get_or_generate(key, generate)
+    else:
+        result, cached = await generate(), False
+    
+    return ChatResponse(
+        response=result['text'].strip(),
+        timestamp=datetime.utcnow().isoformat(),
+        model='Qwen2.5-7B-Instruct',
+        cached=cached,
+        finish_reason=result['finish_reason'],
+        prompt_tokens=result['prompt_tokens'],
+        completion_tokens=result['completion_tokens'],
+        timing=result['timing'] if request.include_timing and not cached else None
+    )
+
+@app.post('/chat/stream')
+async def chat_stream(request: ChatMessage, tenant: Tenant = Depends(rate_limit)):
+    """Server-sent events version of /chat: one event per decoded text delta,
+    followed by a final event with usage stats."""
+    try:
+        await load_model()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Model loading failed: {str(e)}')
+    
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    messages = [{'role': 'user', 'content': request.message}]
+    max_new_tokens = min(request.max_tokens, config['max_tokens'])
+    job = GenerationJob(
+        messages,
+        max_new_tokens=max_new_tokens,
+        temperature=request.temperature,
+        on_text=lambda text: loop.call_soon_threadsafe(events.put_nowait, ('token', text)),
+        stop=request.stop,
+        timeout=request.timeout,
+        json_schema=_json_schema(request.response_format),
+        tenant=tenant
+    )
+    
+    # A cached response is replayed as a single token event
+    cache_key, cached = None, None
+    if _use_response_cache(request):
+        cache_key = await loop.run_in_executor(
+            None, ResponseCache.key_for, messages, max_new_tokens, request.temperature, request.stop, job.json_schema)
+        cached = response_cache.get(cache_key)
+    if cached is not None:
+        future = Future()
+        events.put_nowait(('token', cached['text']))
+        future.set_result(cached)
+    else:
+        future = submit_job(job)
+        if cache_key:
+            def store(f):
+                if f.exception() is None:
+                    loop.run_in_executor(None, response_cache.put, cache_key, f.result())
+            # Done callbacks run on the scheduler thread; the SQLite write goes through the event loop's executor
+            future.add_done_callback(lambda f: loop.call_soon_threadsafe(store, f))
+    return _stream_response(job, future, events, cached=cached is not None, include_timing=request.include_timing)
+
+def _stream_response(job, future, events, cached=False, include_timing=False, extra=None):
+    """Relay `job`'s text deltas (put on `events` by its on_text callback) as
+    server-sent events, then a final done (or error) event once `future`
+    resolves. `extra` is merged into the done event."""
+    loop = asyncio.get_running_loop()
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(events.put_nowait, ('done', f)))
+    
+    async def event_stream():
+        try:
+            async for event in _stream_events():
+                yield event
+        finally:
+            # The client disconnected (or the stream ended); stop decoding
+            if not future.done():
+                job.cancel()
+    
+    async def _stream_events():
+        while True:
+            kind, value = await events.get()
+            if kind == 'token':
+                yield f'data: {json.dumps({"type": "token", "text": value})}\n\n'
+                continue
+            if value.exception() is not None:
+                error = {'type': 'error', 'detail': f'Error generating response: {str(value.exception())}'}
+                yield f'data: {json.dumps(error)}\n\n'
+                return
+            result = value.result()
+            done = {
+                'type': 'done',
+                'timestamp': datetime.utcnow().isoformat(),
+                'model': 'Qwen2.5-7B-Instruct',
+                'finish_reason': result['finish_reason'],
+                'cached': cached,
+                'usage': {
+                    'prompt_tokens': result['prompt_tokens'],
+                    'cached_tokens': result['cached_tokens'],
+                    'completion_tokens': result['completion_tokens'],
+                    'total_tokens': result['prompt_tokens'] + result['completion_tokens'],
+                    'time_to_first_token': result['time_to_first_token'],
+                    'duration': round(time.monotonic() - job.submitted_at, 3)
+                },
+                **(extra or {})
+            }
+            if include_timing and not cached:
+                done['timing'] = result['timing']
+            yield f'data: {json.dumps(done)}\n\n'
+            return
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def _encode_batch(items):
+    """Template and tokenize every item with a single tokenizer call."""
+    started = time.perf_counter()
+    texts = [
+        tokenizer.apply_chat_template([{'role': 'user', 'content': item.message}], tokenize=False, add_generation_prompt=True)
+        for item in items
+    ]
+    templated = time.perf_counter()
+    input_ids = tokenizer(texts).input_ids
+    tokenized = time.perf_counter()
+    # Observed per item so the histograms stay per-request
+    for _ in items:
+        STAGE_SECONDS.observe((templated - started) / len(items), stage='template')
+        STAGE_SECONDS.observe((tokenized - templated) / len(items), stage='tokenize')
+    return input_ids
+
+@app.post('/chat/batch', response_model=BatchChatResponse)
+async def chat_batch(request: BatchChatRequest, http_request: Request, tenant: Tenant = Depends(rate_limit)):
+    """Generate for many messages in one call. Prompts are prefilled together
+    in length buckets and decoded in the shared batch; results come back in
+    request order, with an error per item instead of failing the whole call.
+    Batches always run in the bulk lane."""
+    max_items = config.get('max_batch_items', 256)
+    if not request.items:
+        raise HTTPException(status_code=400, detail='items must not be empty')
+    if len(request.items) > max_items:
+        raise HTTPException(status_code=400, detail=f'At most {max_items} items per batch')
+    try:
+        await load_model()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Model loading failed: {str(e)}')
+    
+    try:
+        prompt_ids = await asyncio.get_running_loop().run_in_executor(None, _encode_batch, request.items)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Error tokenizing batch: {str(e)}')
+    
+    # Keep enough items in flight to fill the batch without flooding the
+    # shared queue and starving other callers
+    in_flight = asyncio.Semaphore(2 * scheduler.max_batch_size)
+    max_positions = getattr(model_config, 'max_position_embeddings', None)
+    
+    async def run(index, item, ids):
+        if not item.message.strip():
+            return BatchChatResult(index=index, error='message must not be empty')
+        if item.max_tokens is None or item.max_tokens <= 0:
+            return BatchChatResult(index=index, error='max_tokens must be positive')
+        max_new_tokens = min(item.max_tokens, config['max_tokens'])
+        if max_positions and len(ids) + max_new_tokens > max_positions:
+            return BatchChatResult(index=index, error=f'Prompt is too long ({len(ids)} tokens)')
+        async with in_flight:
+            job = GenerationJob(
+                None,
+                max_new_tokens=max_new_tokens,
+                temperature=item.temperature,
+                prompt_ids=ids,
+                stop=item.stop,
+                timeout=item.timeout,
+                tenant=tenant.bulk()
             )
-        
-        # Extract and decode response
-        generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)]
-        response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        
-        # Clean up tensors to free memory
-        del model_inputs, generated_ids
-        gc.collect()
-        
-        return ChatResponse(
-            response=response.strip(),
-            timestamp=datetime.utcnow().isoformat(),
-            model='Qwen2.5-7B-Instruct'
+            jobs.append(job)
+            try:
+                result = await asyncio.wrap_future(submit_job(job))
+            except HTTPException as e:
+                return BatchChatResult(index=index, error=e.detail)
+            except Exception as e:
+                return BatchChatResult(index=index, error=f'Error generating response: {str(e)}')
+        return BatchChatResult(
+            index=index,
+            response=result['text'].strip(),
+            prompt_tokens=result['prompt_tokens'],
+            completion_tokens=result['completion_tokens'],
+            finish_reason=result['finish_reason']
         )
-        
+    
+    jobs = []
+    async with cancel_on_disconnect(http_request, jobs):
+        results = await asyncio.gather(*[
+            run(i, item, ids) for i, (item, ids) in enumerate(zip(request.items, prompt_ids))
+        ])
+    return BatchChatResponse(
+        results=results,
+        timestamp=datetime.utcnow().isoformat(),
+        model='Qwen2.5-7B-Instruct'
+    )
+
+@app.post('/sessions', response_model=SessionInfo)
+async def create_session(request: SessionCreateRequest, tenant: Tenant = Depends(current_tenant)):
+    """Start a multi-turn conversation whose history and KV cache stay on the server."""
+    try:
+        session = session_store.create(tenant.id, request.system_prompt)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Too many active sessions, please retry later',
+            headers={'Retry-After': str(e.retry_after)}
+        )
+    return session.info(session_store.idle_timeout)
+
+@app.get('/sessions/{session_id}', response_model=SessionInfo)
+async def get_session(session_id: str, tenant: Tenant = Depends(current_tenant)):
+    session = _session_or_404(session_id, tenant.id)
+    return session.info(session_store.idle_timeout, include_messages=True)
+
+@app.delete('/sessions/{session_id}')
+async def close_session(session_id: str, tenant: Tenant = Depends(current_tenant)):
+    if not session_store.close(session_id, tenant.id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Session not found or expired')
+    return {'session_id': session_id, 'closed': True}
+
+@app.post('/sessions/{session_id}/messages', response_model=SessionChatResponse)
+async def session_message(session_id: str, request: SessionMessage, http_request: Request,
+                          tenant: Tenant = Depends(rate_limit)):
+    """Send the next user message of a session; only the new tokens are prefilled."""
+    try:
+        await load_model()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Model loading failed: {str(e)}')
+    
+    session = _session_or_404(session_id, tenant.id)
+    job, future = _start_session_turn(session, request, tenant=tenant)
+    try:
+        async with cancel_on_disconnect(http_request, [job]):
+            result = await asyncio.wrap_future(future)
+    except MemoryError as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
     except Exception as e:
-        gc.collect()  # Clean up on error
         raise HTTPException(status_code=500, detail=f'Error generating response: {str(e)}')
+    
+    return SessionChatResponse(
+        response=result['text'].strip(),
+        timestamp=datetime.utcnow().isoformat(),
+        model='Qwen2.5-7B-Instruct',
+        session_id=session_id,
+        finish_reason=result['finish_reason'],
+        prompt_tokens=result['prompt_tokens'],
+        reused_tokens=result['cached_tokens'],
+        completion_tokens=result['completion_tokens'],
+        timing=result['timing'] if request.include_timing else None
+    )
+
+@app.post('/sessions/{session_id}/messages/stream')
+async def session_message_stream(session_id: str, request: SessionMessage, tenant: Tenant = Depends(rate_limit)):
+    """Server-sent events version of /sessions/{session_id}/messages."""
+    try:
+        await load_model()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Model loading failed: {str(e)}')
+    
+    session = _session_or_404(session_id, tenant.id)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    job, future = _start_session_turn(
+        session, request, on_text=lambda text: loop.call_soon_threadsafe(events.put_nowait, ('token', text)),
+        tenant=tenant)
+    return _stream_response(job, future, events, include_timing=request.include_timing,
+                            extra={'session_id': session_id})
+
+@app.post('/analyze/transcript', response_model=TranscriptAnalysisResponse)
+async def analyze_transcript(request: TranscriptAnalysisRequest, http_request: Request,
+                             tenant: Tenant = Depends(rate_limit)):
+    """Analyse a transcript of any length with a map-reduce over token-bounded chunks."""
+    try:
+        await load_model()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Model loading failed: {str(e)}')
+    
+    jobs = []
+    try:
+        async with cancel_on_disconnect(http_request, jobs):
+            return await _transcript_analysis(request, jobs, tenant)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Error analysing transcript: {str(e)}')
+    finally:
+        # One failed chunk fails the analysis; don't keep decoding the others
+        for job in jobs:
+            if not job.future.done():
+                job.cancel()
+
+async def _transcript_analysis(request, jobs, tenant=None):
+    """Run the map-reduce analysis for `request`, appending every GenerationJob to `jobs`."""
+    chunk_tokens = request.chunk_tokens or config.get('chunk_tokens', 1500)
+    overlap_tokens = request.overlap_tokens if request.overlap_tokens is not None else config.get('chunk_overlap_tokens', 100)
+    if overlap_tokens >= chunk_tokens:
+        raise HTTPException(status_code=400, detail='overlap_tokens must be smaller than chunk_tokens')
+    max_tokens = min(request.max_tokens, config['max_tokens'])
+    chunk_max_tokens = min(request.chunk_max_tokens, config['max_tokens'])
+    
+    chunks = await asyncio.get_running_loop().run_in_executor(
+        None, split_transcript, request.transcript, chunk_tokens, overlap_tokens)
+    
+    if len(chunks) == 1:
+        prompt = f'{request.instructions}\n\nTranscript:\n{request.transcript}'
+        response = await _generate_text(prompt, max_tokens, request.temperature, jobs, tenant)
+    else:
+        findings = await asyncio.gather(*[
+            _generate_text(
+                MAP_PROMPT.format(instructions=request.instructions, count=len(chunks), index=i, chunk=chunk),
+                chunk_max_tokens,
+                request.temperature,
+                jobs,
+                tenant
+            )
+            for i, chunk in enumerate(chunks, 1)
+        ])
+        response = await _reduce_findings(
+            request.instructions, list(findings), chunk_tokens, max_tokens, request.temperature, jobs, tenant)
+    
+    return TranscriptAnalysisResponse(
+        response=response,
+        chunks=len(chunks),
+        timestamp=datetime.utcnow().isoformat(),
+        model='Qwen2.5-7B-Instruct'
+    )
+
+@app.post('/jobs', response_model=JobInfo, status_code=status.HTTP_202_ACCEPTED)
+async def submit_async_job(request: JobSubmitRequest, tenant: Tenant = Depends(rate_limit)):
+    """Queue a /chat or /analyze/transcript request and return its job id at once."""
+    if request.type not in JOB_TYPES:
+        raise HTTPException(status_code=400, detail=f'type must be one of: {", ".join(JOB_TYPES)}')
+    try:
+        JOB_TYPES[request.type][0](**request.request)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=jsonable_encoder(e.errors()))
+    if request.type == 'chat':
+        _json_schema(request.request.get('response_format'))
+    if request.callback_url:
+        _check_callback_url(request.callback_url)
+    try:
+        return job_queue.submit(tenant.id, request.type, request.request, request.priority or 0, request.callback_url,
+                                tenant=tenant.id)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail='Too many unfinished jobs, please retry later',
+            headers={'Retry-After': str(e.retry_after)}
+        )
+
+@app.get('/jobs', response_model=List[JobInfo])
+async def list_async_jobs(tenant: Tenant = Depends(current_tenant)):
+    return job_queue.list(tenant.id)
+
+@app.get('/jobs/{job_id}', response_model=JobInfo)
+async def get_async_job(job_id: str, tenant: Tenant = Depends(current_tenant)):
+    return _job_or_404(job_id, tenant.id)
+
+@app.get('/jobs/{job_id}/result', response_model=JobInfo)
+async def get_async_job_result(job_id: str, tenant: Tenant = Depends(current_tenant)):
+    info = _job_or_404(job_id, tenant.id, include_result=True)
+    if info.status != 'completed':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'Job is {info.status}')
+    return info
+
+@app.delete('/jobs/{job_id}', response_model=JobInfo)
+async def cancel_async_job(job_id: str, tenant: Tenant = Depends(current_tenant)):
+    info = job_queue.cancel(job_id, tenant.id)
+    if info is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found')
+    return info
+
+@app.post('/embeddings', response_model=EmbeddingResponse)
+async def create_embeddings(request: EmbeddingRequest, tenant: Tenant = Depends(rate_limit)):
+    """Unit-length embeddings of one text or a list of texts."""
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    max_items = config.get('max_batch_items', 256)
+    if not texts or len(texts) > max_items:
+        raise HTTPException(status_code=400, detail=f'input must have 1 to {max_items} texts')
+    try:
+        name, vectors, tokens = await _embed(texts, tenant)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Error computing embeddings: {str(e)}')
+    return EmbeddingResponse(data=vectors.tolist(), model=name, dimensions=vectors.shape[1], prompt_tokens=tokens)
+
+@app.post('/vectors/{name}', response_model=VectorIndexInfo)
+async def add_vectors(name: str, request: VectorAddRequest, tenant: Tenant = Depends(rate_limit)):
+    """Add items to an index (created on first use); an existing id is replaced."""
+    max_items = config.get('max_batch_items', 256)
+    if not request.items or len(request.items) > max_items:
+        raise HTTPException(status_code=400, detail=f'items must have 1 to {max_items} entries')
+    if any((item.text is None) == (item.embedding is None) for item in request.items):
+        raise HTTPException(status_code=400, detail='Each item needs exactly one of text or embedding')
+    index = _vector_index(tenant.id, name, create=True)
+    texts = [item.text for item in request.items if item.text is not None]
+    model_name = None
+    if texts:
+        model_name, embedded, _ = await _embed(texts, tenant)
+        embedded = iter(embedded)
+    rows = [np.asarray(item.embedding, dtype=np.float32) if item.embedding is not None else next(embedded)
+            for item in request.items]
+    if len({row.shape[0] for row in rows}) > 1:
+        raise HTTPException(status_code=400, detail='All embeddings must have the same dimensions')
+    try:
+        added, updated = await asyncio.get_running_loop().run_in_executor(
+            None, index.add, [item.id for item in request.items], np.stack(rows),
+            [item.metadata for item in request.items], model_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _index_info(name, index, added, updated)
+
+@app.post('/vectors/{name}/search', response_model=VectorSearchResponse)
+async def search_vectors(name: str, request: VectorSearchRequest, tenant: Tenant = Depends(rate_limit)):
+    """The items most similar to a text or an embedding."""
+    if (request.text is None) == (request.embedding is None):
+        raise HTTPException(status_code=400, detail='Give exactly one of text or embedding')
+    if not request.top_k or request.top_k <= 0:
+        raise HTTPException(status_code=400, detail='top_k must be positive')
+    index = _vector_index(tenant.id, name)
+    if request.text is not None:
+        model_name, vectors, _ = await _embed([request.text], tenant)
+        if index.model and model_name != index.model:
+            raise HTTPException(status_code=400, detail=f'Index was built with {index.model}, not {model_name}')
+        query = vectors[0]
+    else:
+        query = np.asarray(request.embedding, dtype=np.float32)
+    started = time.perf_counter()
+    try:
+        matches = await asyncio.get_running_loop().run_in_executor(None, index.search, query, request.top_k)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return VectorSearchResponse(
+        matches=[VectorMatch(id=item_id, score=score, metadata=metadata) for item_id, score, metadata in matches],
+        search_ms=round((time.perf_counter() - started) * 1000, 3)
+    )
+
+@app.get('/vectors/{name}', response_model=VectorIndexInfo)
+async def get_vector_index(name: str, tenant: Tenant = Depends(current_tenant)):
+    return _index_info(name, _vector_index(tenant.id, name))
+
+@app.delete('/vectors/{name}')
+async def delete_vector_index(name: str, tenant: Tenant = Depends(current_tenant)):
+    _vector_index(tenant.id, name)
+    vector_store.delete(tenant.id, name)
+    return {'name': name, 'deleted': True}
 
 @app.get('/api-info')
 async def api_info():
@@ -249,8 +4496,28 @@ async def api_info():
         'endpoints': {
             'GET /chat-ui': 'Web chat interface',
             'POST /chat': 'Main chat endpoint (requires auth)',
+            'POST /chat/stream': 'Streaming chat endpoint, server-sent events (requires auth)',
+            'POST /chat/batch': 'Generate for a list of messages in one call (requires auth)',
+            'POST /analyze/transcript': 'Map-reduce analysis of long lesson transcripts (requires auth)',
+            'POST /sessions': 'Start a multi-turn session (requires auth)',
+            'POST /sessions/{id}/messages': 'Next turn of a session, add /stream for server-sent events (requires auth)',
+            'GET /sessions/{id}': 'Session history (requires auth)',
+            'DELETE /sessions/{id}': 'Close a session (requires auth)',
+            'POST /jobs': 'Queue a chat or transcript analysis to run in the background (requires auth)',
+            'GET /jobs': 'Your recent jobs (requires auth)',
+            'GET /jobs/{id}': 'Job status (requires auth)',
+            'GET /jobs/{id}/result': 'Result of a completed job (requires auth)',
+            'DELETE /jobs/{id}': 'Cancel a queued or running job (requires auth)',
+            'POST /embeddings': 'Embeddings of one or more texts (requires auth)',
+            'POST /vectors/{name}': 'Add texts or embeddings to a vector index (requires auth)',
+            'POST /vectors/{name}/search': 'Most similar items in a vector index (requires auth)',
+            'GET /vectors/{name}': 'Vector index size (requires auth)',
+            'DELETE /vectors/{name}': 'Delete a vector index (requires auth)',
             'POST /auth/login': 'Get JWT token', 
             'GET /health': 'Health check (public)',
+            'GET /health/live': 'Liveness probe (public)',
+            'GET /metrics': 'Prometheus metrics (public)',
+            'GET /health/ready': 'Readiness probe, 503 until the model is loaded and warmed up (public)',
             'GET /api-info': 'This endpoint (public)',
             'GET /docs': 'Interactive API documentation'
         },
@@ -266,5 +4533,241 @@ async def api_info():
         }
     }
 
+# Autotuning
+#
+# `python main_optimized.py autotune` measures this machine instead of
+# relying on PyTorch's default thread counts. Every precision / inter-op
+# thread count combination runs in its own spawned process (inter-op
+# threads can only be set once per process, and it keeps one precision's
+# weights from sharing memory with the next), which loads the model from the
+# usual local source and, for each intra-op thread count and batch size,
+# prefills a batch of representative prompts and greedily decodes a fixed
+# number of tokens. The fastest combination by batch decode throughput,
+# among batch sizes that still decode at least min_tokens_per_second per
+# request, is written to config.json and applied by the server at startup.
+
+AUTOTUNE_PROMPTS = [
+    'Summarise this lesson in one sentence.',
+    'What are three ways a teacher can check for understanding during a lesson?',
+    'Analyse the questioning techniques in this classroom transcript and suggest one improvement.\n\n'
+    'Teacher: Good morning everyone. Yesterday we looked at fractions. Who can tell me what the bottom number is called?\n'
+    'Student A: The denominator.\n'
+    'Teacher: Right. And what does it tell us?\n'
+    'Student A: How many parts the whole is split into.\n'
+    'Teacher: Good. Now, if I cut a pizza into eight slices and eat three, what fraction is left? Talk to your partner first.\n'
+    'Student B: Five eighths.\n'
+    'Teacher: How did you work that out?\n'
+    'Student B: Eight take away three is five, and there are still eight parts in the whole pizza.',
+    'Write feedback for a teacher whose students answered mostly with single words. Focus on wait time, '
+    'open questions and building on student answers, and give a concrete example for each.'
+]
+
+def _cpu_name():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def _apply_thread_settings(threads=None):
+    """Apply torch_threads / torch_interop_threads from config.json (see autotune)."""
+    tuned = config.get('autotune')
+    if tuned and tuned.get('cpu') != _cpu_name():
+        print(f'Settings in {CONFIG_FILE} were tuned on {tuned.get("cpu")}, rerun: python main_optimized.py autotune')
+    threads = threads or config.get('torch_threads')
+    if threads:
+        torch.set_num_threads(threads)
+    interop_threads = config.get('torch_interop_threads')
+    if interop_threads and torch.get_num_interop_threads() != interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print(f'Could not set {interop_threads} inter-op threads: {e}')
+
+def _measure_throughput(backend, rows, new_tokens):
+    """Prefill `rows` as one left-padded batch, then greedily decode
+    new_tokens for each; returns (prefill, decode) tokens per second."""
+    width = max(len(row) for row in rows)
+    input_ids = torch.stack([_left_pad(torch.tensor(row, dtype=torch.long), width, 0) for row in rows])
+    mask = torch.stack([_left_pad(torch.ones(len(row), dtype=torch.long), width, 0) for row in rows])
+    with torch.inference_mode():
+        started = time.perf_counter()
+        logits, cache = backend.prefill(input_ids, mask, (mask.cumsum(dim=1) - 1).clamp(min=0), _new_cache())
+        prefilled = time.perf_counter()
+        positions = mask.sum(dim=1, keepdim=True) - 1
+        for _ in range(new_tokens):
+            tokens = logits[:, -1].argmax(dim=-1, keepdim=True)
+            mask = torch.cat([mask, mask.new_ones(len(rows), 1)], dim=1)
+            positions = positions + 1
+            logits, cache = backend.decode_step(tokens, mask, positions, cache)
+        finished = time.perf_counter()
+    return sum(map(len, rows)) / (prefilled - started), len(rows) * new_tokens / (finished - prefilled)
+
+def _autotune_main(precision, interop_threads, thread_counts, batch_sizes, prompts, new_tokens, results):
+    """Entry point of an autotune process (one precision and inter-op thread count)."""
+    global tokenizer
+    try:
+        torch.set_num_interop_threads(interop_threads)
+        config['precision'] = precision
+        tokenizer = AutoTokenizer.from_pretrained(_model_source())
+        texts = [tokenizer.apply_chat_template([{'role': 'user', 'content': prompt}], tokenize=False,
+                                               add_generation_prompt=True) for prompt in prompts]
+        prompt_ids = tokenizer(texts).input_ids
+        engine = config.get('engine', 'transformers')
+        backend = None
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            # ONNX Runtime takes its thread count when the session is created
+            if backend is None or engine != 'transformers':
+                backend = _load_backend(precision, _artifact_file(ARTIFACT_WEIGHTS) if engine == 'transformers' else None)
+            for batch_size in batch_sizes:
+                rows = [prompt_ids[index % len(prompt_ids)] for index in range(batch_size)]
+                _measure_throughput(backend, rows, 2)  # Page in weights, prime kernels
+                prefill, decode = _measure_throughput(backend, rows, new_tokens)
+                results.put({
+                    'precision': backend.precision or precision,
+                    'threads': threads,
+                    'interop_threads': interop_threads,
+                    'batch_size': batch_size,
+                    'prefill_tokens_per_second': round(prefill, 1),
+                    'decode_tokens_per_second': round(decode, 1)
+                })
+    except Exception as e:
+        results.put({'precision': precision, 'interop_threads': interop_threads, 'error': str(e) or type(e).__name__})
+    results.put(None)
+
+def autotune(thread_counts=None, interop_counts=None, batch_sizes=None, precisions=None, prompts=None,
+             new_tokens=32, min_tokens_per_second=5.0, write=True):
+    """Sweep thread counts, batch sizes and precisions; returns the best
+    measurement and saves its settings to config.json when `write` is set."""
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    thread_counts = thread_counts or sorted({max(1, cores // 4), max(1, cores // 2), cores})
+    interop_counts = interop_counts or [1, 2]
+    batch_sizes = batch_sizes or [1, 4, 8, 16]
+    if not precisions:
+        # Other engines get their precision from the prepared artifact
+        engine = config.get('engine', 'transformers')
+        precisions = ['float32', 'bfloat16', 'int8'] if engine == 'transformers' else [config.get('precision', 'float32')]
+    prompts = prompts or AUTOTUNE_PROMPTS
+    print(f'Autotuning on {_cpu_name()} ({cores} cores): threads {thread_counts}, inter-op threads {interop_counts}, '
+          f'batch sizes {batch_sizes}, precisions {precisions}')
+    
+    context = multiprocessing.get_context('spawn')
+    measurements = []
+    for precision in precisions:
+        for interop_threads in interop_counts:
+            results = context.Queue()
+            process = context.Process(
+                target=_autotune_main,
+                args=(precision, interop_threads, thread_counts, batch_sizes, prompts, new_tokens, results),
+                name=f'autotune-{precision}-{interop_threads}',
+                daemon=True
+            )
+            process.start()
+            while True:
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    if process.is_alive():
+                        continue
+                    result = {'precision': precision, 'interop_threads': interop_threads,
+                              'error': f'process exited with code {process.exitcode}'}
+                if result is None:
+                    break
+                if 'error' in result:
+                    print(f'  {precision}, {interop_threads} inter-op threads: failed: {result["error"]}')
+                    break
+                print(f'  {result["precision"]}, {result["threads"]} threads, {result["interop_threads"]} inter-op, '
+                      f'batch {result["batch_size"]}: prefill {result["prefill_tokens_per_second"]} tokens/s, '
+                      f'decode {result["decode_tokens_per_second"]} tokens/s')
+                measurements.append(result)
+            process.join()
+    
+    if not measurements:
+        raise RuntimeError('No autotune configuration could be measured')
+    # Highest batch throughput, unless that makes each request decode too slowly
+    interactive = [m for m in measurements if m['decode_tokens_per_second'] / m['batch_size'] >= min_tokens_per_second]
+    if interactive:
+        best = max(interactive, key=lambda m: (m['decode_tokens_per_second'], m['prefill_tokens_per_second']))
+    else:
+        best = max(measurements, key=lambda m: m['decode_tokens_per_second'] / m['batch_size'])
+    print(f'Best: {best["precision"]}, {best["threads"]} threads, {best["interop_threads"]} inter-op threads, '
+          f'batch size {best["batch_size"]}')
+    if best['precision'] != config.get('precision', 'float32'):
+        print(f'Note: this changes precision from {config.get("precision", "float32")} to {best["precision"]}, '
+              'check output quality (or pass --precisions to keep it)')
+    
+    if write:
+        with open(CONFIG_FILE) as f:
+            saved = json.load(f)
+        saved.update({
+            'precision': best['precision'],
+            'torch_threads': best['threads'],
+            'torch_interop_threads': best['interop_threads'],
+            'max_batch_size': best['batch_size'],
+            'autotune': {
+                'cpu': _cpu_name(),
+                'cores': cores,
+                'tuned_at': datetime.utcnow().isoformat(),
+                'prefill_tokens_per_second': best['prefill_tokens_per_second'],
+                'decode_tokens_per_second': best['decode_tokens_per_second']
+            }
+        })
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump(saved, f, indent=2)
+        print(f'Saved to {CONFIG_FILE}')
+    return best
+
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Qwen2.5 7B API server')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='Run the API server (default)')
+    prepare = commands.add_parser('prepare', help='Write a local pre-converted model artifact for fast, offline startup')
+    prepare.add_argument('--output', help='Artifact directory (default: model_artifact_dir from config.json, else model_artifact)')
+    prepare.add_argument('--precision', choices=PRECISIONS, help='Target precision (default: precision from config.json)')
+    prepare.add_argument('--model', help='Model to prepare (default: model_name from config.json)')
+    prepare.add_argument('--engine', choices=sorted(BACKENDS), help='Engine to prepare for (default: engine from config.json)')
+    prepare.add_argument('--draft-model', help='Draft model to include for speculative decoding '
+                                               '(default: draft_model_name from config.json)')
+    tune = commands.add_parser('autotune', help='Measure thread counts, batch sizes and precisions on this machine '
+                                                'and save the fastest to config.json')
+    tune.add_argument('--threads', type=_int_list, help='Intra-op thread counts to try (default: a quarter, half and all cores)')
+    tune.add_argument('--interop-threads', type=_int_list, help='Inter-op thread counts to try (default: 1,2)')
+    tune.add_argument('--batch-sizes', type=_int_list, help='Batch sizes to try (default: 1,4,8,16)')
+    tune.add_argument('--precisions', help='Comma separated precisions to try (default: float32,bfloat16,int8)')
+    tune.add_argument('--prompts', help='JSON file with a list of prompts (default: built-in lesson analysis prompts)')
+    tune.add_argument('--new-tokens', type=int, default=32, help='Tokens decoded per measurement (default: 32)')
+    tune.add_argument('--min-tokens-per-second', type=float, default=5.0,
+                      help='Slowest per-request decode rate a batch size may have (default: 5)')
+    tune.add_argument('--dry-run', action='store_true', help='Print the results without changing config.json')
+    args = parser.parse_args()
+    
+    if args.command == 'prepare':
+        output_dir = args.output or config.get('model_artifact_dir') or 'model_artifact'
+        prepare_artifact(output_dir, args.precision or config.get('precision', 'float32'), args.model, args.engine,
+                         args.draft_model)
+        if config.get('model_artifact_dir') != output_dir:
+            print(f'Set "model_artifact_dir": "{output_dir}" in {CONFIG_FILE} to serve from it')
+        return
+    if args.command == 'autotune':
+        precisions = args.precisions.split(',') if args.precisions else None
+        for precision in precisions or []:
+            if precision not in PRECISIONS:
+                parser.error(f'Unsupported precision {precision!r}, expected one of {", ".join(PRECISIONS)}')
+        prompts = None
+        if args.prompts:
+            with open(args.prompts) as f:
+                prompts = json.load(f)
+        autotune(args.threads, args.interop_threads, args.batch_sizes, precisions, prompts,
+                 new_tokens=args.new_tokens, min_tokens_per_second=args.min_tokens_per_second, write=not args.dry_run)
+        return
+    uvicorn.run(app, host='0.0.0.0', port=8000)
+
 if __name__ == '__main__':
-    uvicorn.run(app, host='0.0.0.0', port=8000)
\ No newline at end of file
+    main()
\ No newline at end of file
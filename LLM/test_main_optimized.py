@@ -0,0 +1,936 @@
+"""
+Tests for main_optimized.py
+Usage: python -m pytest test_main_optimized.py
+
+The server runs in-process against the tiny random-weight stand-in model
+from benchmark-llm-api.py, so the tests need no network and no model
+download. Tests taking the `engine` fixture run once with the transformers
+engine and once with the onnxruntime engine (skipped when onnxruntime or
+onnx is not installed).
+"""
+
+import asyncio
+import importlib
+import importlib.util
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+import torch
+from fastapi.testclient import TestClient
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API_KEY = 'sk-demo123456789'
+OTHER_API_KEY = 'sk-other987654321'
+ENGINES = ('transformers', 'onnxruntime')
+
+PROMPTS = [
+    'Who can tell me what the denominator tells us?',
+    "Let's try that together on the board. Nine twelfths and eight twelfths, which is larger? " * 3,
+    'Well done.',
+]
+
+# Settings the tests change between loads; every load starts from these
+DEFAULT_SETTINGS = {
+    'engine': 'transformers',
+    'precision': 'float32',
+    'model_artifact_dir': None,
+    'draft_model_name': None,
+    'kv_cache': 'full',
+}
+
+
+def _load_benchmark():
+    # benchmark-llm-api.py isn't importable by name
+    spec = importlib.util.spec_from_file_location('benchmark_llm_api', os.path.join(HERE, 'benchmark-llm-api.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def headers(api_key=API_KEY):
+    return {'Authorization': f'Bearer {api_key}'}
+
+
+def write_config(work_dir, model_dir, **settings):
+    with open(os.path.join(work_dir, 'config.json'), 'w') as f:
+        json.dump(dict({
+            'api_keys': [API_KEY, OTHER_API_KEY],
+            'users': {},
+            'model_name': model_dir,
+            'max_tokens': 256,
+            'temperature': 0.7,
+            'eager_load': False,
+            'warmup_tokens': 4,
+            'memory_budget_mb': 4096,
+        }, **settings), f, indent=2)
+
+
+def run_server_process(work_dir, model_dir, code, **settings):
+    """Run `code` in a fresh Python process that imports main_optimized as
+    `server` with the test config plus `settings`; returns what the code
+    printed, parsed as JSON."""
+    write_config(work_dir, model_dir, **settings)
+    completed = subprocess.run(
+        [sys.executable, '-c', 'import json\nimport main_optimized as server\n' + textwrap.dedent(code)],
+        cwd=work_dir, env=dict(os.environ, PYTHONPATH=HERE), capture_output=True, text=True, timeout=600)
+    assert completed.returncode == 0, completed.stderr[-3000:]
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+@pytest.fixture(scope='session')
+def model_dirs(tmp_path_factory):
+    """(model, draft model) directories: two stand-in models with different
+    weights and the same tokenizer."""
+    benchmark = _load_benchmark()
+    model_dir = str(tmp_path_factory.mktemp('model'))
+    draft_dir = str(tmp_path_factory.mktemp('draft'))
+    benchmark.build_stand_in_model(model_dir, 'tiny', seed=0)
+    benchmark.build_stand_in_model(draft_dir, 'tiny', seed=1)
+    return model_dir, draft_dir
+
+
+@pytest.fixture(scope='session')
+def running_server(model_dirs, tmp_path_factory):
+    """The imported main_optimized module, with its startup hooks run, and a
+    client for its app. The model itself is loaded by the `engine` fixture
+    or `load`."""
+    work_dir = tmp_path_factory.mktemp('server')
+    write_config(work_dir, model_dirs[0])
+    # The server reads config.json (and keeps its databases) in the working directory
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    sys.path.insert(0, HERE)
+    try:
+        module = importlib.import_module('main_optimized')
+        # One client for the whole session, so every request runs on the same event loop
+        with TestClient(module.app) as client:
+            yield module, client
+    finally:
+        os.chdir(previous_dir)
+
+
+@pytest.fixture(scope='session')
+def server(running_server):
+    return running_server[0]
+
+
+@pytest.fixture(scope='session')
+def client(running_server):
+    return running_server[1]
+
+
+@pytest.fixture(scope='session')
+def onnx_artifact(server, model_dirs):
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('onnx')
+    # With the draft model, for the speculative decoding tests
+    return server.prepare_artifact(os.path.abspath('onnx-artifact'), 'float32', engine='onnxruntime',
+                                   draft_model_name=model_dirs[1])
+
+
+@pytest.fixture(scope='session')
+def reference_model(server, model_dirs):
+    """The stand-in model loaded directly through transformers."""
+    return server._from_pretrained(model_dirs[0], torch.float32).eval()
+
+
+def load(server, **settings):
+    """(Re)load the model with DEFAULT_SETTINGS overridden by `settings`,
+    unless it is already loaded that way."""
+    settings = dict(DEFAULT_SETTINGS, **settings)
+    if server.model_state['status'] == 'ready' and all(server.config.get(k) == v for k, v in settings.items()):
+        return
+    server.config.update(settings)
+    server.model_state['status'] = 'not_loaded'
+    server.load_model_sync()
+
+
+@pytest.fixture(params=ENGINES)
+def engine(request, server):
+    """Load the model with each engine in turn; returns the engine's settings."""
+    settings = {'engine': request.param}
+    if request.param == 'onnxruntime':
+        settings['model_artifact_dir'] = request.getfixturevalue('onnx_artifact')
+    load(server, **settings)
+    return settings
+
+
+def run_jobs(server, prompts, max_new_tokens=16, **kwargs):
+    """Submit one greedy job per prompt together and wait for all of them."""
+    jobs = [server.GenerationJob([{'role': 'user', 'content': prompt}], max_new_tokens, 0, **kwargs)
+            for prompt in prompts]
+    futures = [server.scheduler.submit(job) for job in jobs]
+    for future in futures:
+        future.result(timeout=60)
+    return jobs
+
+
+def reference_ids(reference_model, prompt_ids, max_new_tokens):
+    """Greedy continuation of `prompt_ids` from transformers' own generate."""
+    ids = torch.tensor([prompt_ids])
+    with torch.no_grad():
+        output = reference_model.generate(ids, max_new_tokens=max_new_tokens, do_sample=False)
+    return output[0, ids.shape[1]:].tolist()
+
+
+def assert_matches_reference(reference_model, jobs, max_new_tokens=16):
+    for job in jobs:
+        assert job.finish_reason in ('stop', 'length')
+        assert job.output_ids
+        assert job.output_ids == reference_ids(reference_model, job.prompt_ids, max_new_tokens)[:len(job.output_ids)]
+
+
+def test_scheduler_matches_generate(server, engine, reference_model):
+    # Batched together, so the shorter prompts are padded
+    jobs = run_jobs(server, PROMPTS)
+    assert_matches_reference(reference_model, jobs)
+    # Again, now with the prompts' prefixes cached
+    assert [job.output_ids for job in run_jobs(server, PROMPTS)] == [job.output_ids for job in jobs]
+    # The backend's own single-sequence loop agrees too
+    assert server.model.generate(jobs[0].prompt_ids, 8) == jobs[0].output_ids[:8]
+
+
+def test_onnx_logits_match_pytorch(server, onnx_artifact):
+    load(server)
+    pytorch = server.model
+    onnx = server.OnnxRuntimeBackend(
+        os.path.join(onnx_artifact, server.ONNX_MODEL), pytorch.config, pytorch.generation_config)
+    prompt_ids = server.tokenizer(PROMPTS[1]).input_ids
+    with torch.no_grad():
+        expected, expected_cache = pytorch.prefill(torch.tensor([prompt_ids[:-1]]), past_key_values=server.DynamicCache())
+        logits, cache = onnx.prefill(torch.tensor([prompt_ids[:-1]]), past_key_values=server.DynamicCache())
+        torch.testing.assert_close(logits, expected, atol=1e-4, rtol=1e-4)
+        # A decode step on top of each one's cache
+        expected, _ = pytorch.decode_step(torch.tensor([prompt_ids[-1:]]), None, None, expected_cache)
+        logits, _ = onnx.decode_step(torch.tensor([prompt_ids[-1:]]), None, None, cache)
+    torch.testing.assert_close(logits, expected, atol=1e-4, rtol=1e-4)
+
+
+def test_speculative_decoding_matches_generate(server, engine, model_dirs, reference_model):
+    load(server, draft_model_name=model_dirs[1], **engine)
+    try:
+        proposed = server.scheduler.proposed_tokens
+        # The scheduler only speculates for a lone job
+        jobs = [run_jobs(server, [prompt])[0] for prompt in PROMPTS]
+        assert server.scheduler.proposed_tokens > proposed
+        assert_matches_reference(reference_model, jobs)
+    finally:
+        load(server, **engine)
+
+
+def test_prepared_artifact_serves_offline(server, model_dirs, reference_model, tmp_path):
+    # Prepare from copies of the models, then remove them: the server may only read the artifact
+    model_name, draft_name = str(tmp_path / 'model'), str(tmp_path / 'draft')
+    shutil.copytree(model_dirs[0], model_name)
+    shutil.copytree(model_dirs[1], draft_name)
+    artifact = server.prepare_artifact(str(tmp_path / 'artifact'), 'float32', model_name, 'transformers', draft_name)
+    shutil.rmtree(model_name)
+    shutil.rmtree(draft_name)
+    with open(os.path.join(artifact, server.ARTIFACT_MANIFEST)) as f:
+        manifest = json.load(f)
+    assert (manifest['model_name'], manifest['draft_model_name']) == (model_name, draft_name)
+    assert (manifest['engine'], manifest['precision'], manifest['dtype']) == ('transformers', 'float32', 'float32')
+    assert os.path.exists(os.path.join(artifact, server.ARTIFACT_WEIGHTS))
+
+    served_model = server.config['model_name']
+    server.config['model_name'] = model_name
+    try:
+        load(server, model_artifact_dir=artifact, draft_model_name=draft_name)
+        assert server.scheduler.draft_model is not None
+        jobs = [run_jobs(server, [prompt])[0] for prompt in PROMPTS]
+        assert_matches_reference(reference_model, jobs)
+    finally:
+        server.config['model_name'] = served_model
+        load(server)
+
+
+def test_prepared_artifact_must_match_the_config(server, model_dirs, tmp_path):
+    artifact = server.prepare_artifact(str(tmp_path / 'artifact'), 'float32', model_dirs[0], 'transformers')
+    try:
+        with pytest.raises(RuntimeError, match='prepared without draft model'):
+            load(server, model_artifact_dir=artifact, draft_model_name=model_dirs[1])
+        with pytest.raises(RuntimeError, match="prepared for precision 'float32'"):
+            load(server, model_artifact_dir=artifact, precision='bfloat16')
+        with pytest.raises(RuntimeError, match='prepared for the transformers engine'):
+            load(server, model_artifact_dir=artifact, engine='onnxruntime')
+    finally:
+        load(server)
+
+
+def test_cancel_stops_generation(server, engine):
+    job = server.GenerationJob([{'role': 'user', 'content': PROMPTS[0]}], 200, 0)
+    job.on_text = lambda text: job.cancel()
+    result = server.scheduler.submit(job).result(timeout=60)
+    assert result['finish_reason'] == 'cancelled'
+    assert len(job.output_ids) < 200
+    # The scheduler carries on with other work
+    assert run_jobs(server, PROMPTS[:1], max_new_tokens=4)[0].finish_reason in ('stop', 'length')
+
+
+def test_stop_sequences_end_generation_and_are_never_streamed(server, engine):
+    text = run_jobs(server, PROMPTS[:1], max_new_tokens=24)[0].text
+    stop = text[6:10]
+    pieces = []
+    job = run_jobs(server, PROMPTS[:1], max_new_tokens=24, stop=['never produced', stop], on_text=pieces.append)[0]
+    assert job.finish_reason == 'stop'
+    assert job.text == text[:text.find(stop)]
+    # Text is held back while it could still be the start of a stop string
+    assert ''.join(pieces) == job.text
+    assert all(len(piece) > 0 for piece in pieces)
+
+
+def test_deadlines(server, monkeypatch):
+    job = server.GenerationJob([{'role': 'user', 'content': PROMPTS[0]}], 200, 0, timeout=1e-6)
+    assert server.scheduler.submit(job).result(timeout=60)['finish_reason'] == 'timeout'
+
+    def deadline(timeout, request_timeout):
+        monkeypatch.setitem(server.config, 'request_timeout', request_timeout)
+        job = server.GenerationJob([], 16, 0, timeout=timeout)
+        return None if job.deadline is None else round(job.deadline - job.submitted_at)
+
+    assert deadline(None, 600) == 600
+    assert deadline(30, 600) == 30
+    assert deadline(900, 600) == 600
+    # 0 or null turns the server-wide cap off
+    assert deadline(30, 0) == 30
+    assert deadline(30, None) == 30
+    assert deadline(None, 0) is None
+
+
+@pytest.mark.parametrize('timeout', [0, -5])
+def test_timeouts_must_be_positive(client, timeout):
+    response = client.post('/chat', json={'message': 'Hi', 'timeout': timeout}, headers=headers())
+    assert response.status_code == 422
+
+
+def test_batch_results_come_back_in_order_with_per_item_errors(server, client, monkeypatch):
+    load(server)
+    monkeypatch.setattr(server.model_config, 'max_position_embeddings', 128)
+    lanes = []
+    submit_job = server.submit_job
+    monkeypatch.setattr(server, 'submit_job', lambda job: lanes.append(job.lane) or submit_job(job))
+    items = [{'message': prompt, 'max_tokens': 8, 'temperature': 0} for prompt in PROMPTS]
+    items[1:1] = [
+        {'message': '  ', 'max_tokens': 8},
+        {'message': PROMPTS[0], 'max_tokens': 0},
+        {'message': 'word ' * 100, 'max_tokens': 8},
+    ]
+    response = client.post('/chat/batch', json={'items': items}, headers=headers())
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [result['index'] for result in results] == list(range(6))
+    assert [result['error'] for result in results[1:4]] == [
+        'message must not be empty', 'max_tokens must be positive', results[3]['error']]
+    assert results[3]['error'].startswith('Prompt is too long')
+    # The other items match generating each prompt on its own
+    expected = [job.text.strip() for job in run_jobs(server, PROMPTS, max_new_tokens=8)]
+    assert [results[i]['response'] for i in (0, 4, 5)] == expected
+    assert all(results[i]['completion_tokens'] > 0 and results[i]['finish_reason'] for i in (0, 4, 5))
+    assert lanes == ['bulk'] * 3
+
+    assert client.post('/chat/batch', json={'items': []}, headers=headers()).status_code == 400
+    monkeypatch.setitem(server.config, 'max_batch_items', 2)
+    assert client.post('/chat/batch', json={'items': items[:3]}, headers=headers()).status_code == 400
+
+
+def test_identical_requests_share_one_generation(server, engine, client):
+    payload = {'message': f'Coalesce me ({engine["engine"]})', 'max_tokens': 32, 'temperature': 0}
+    stats = server.response_cache.stats()
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(lambda _: client.post('/chat', json=payload, headers=headers()), range(4)))
+    assert [response.status_code for response in responses] == [200] * 4
+    assert len({response.json()['response'] for response in responses}) == 1
+    after = server.response_cache.stats()
+    # Every request either generated, waited for that generation, or hit the cache; only one generated
+    assert (after['misses'] - stats['misses']) - (after['coalesced'] - stats['coalesced']) == 1
+    assert after['inflight'] == 0
+
+
+def test_int8_kv_cache_matches_full_cache(server, engine):
+    full = run_jobs(server, PROMPTS)
+    load(server, kv_cache='int8', **engine)
+    try:
+        assert isinstance(server._new_cache(), server.Int8KVCache)
+        quantized = run_jobs(server, PROMPTS)
+    finally:
+        load(server, **engine)
+    assert [job.output_ids for job in quantized] == [job.output_ids for job in full]
+    assert all(q.kv_bytes < f.kv_bytes for q, f in zip(quantized, full))
+
+
+def coalesce(server, leader_generate, cancel_leader=False):
+    """Send a request that generates with `leader_generate`, then two
+    identical requests while it is running (cancelling the first one if
+    `cancel_leader`). Returns the two followers' (result, cached), how
+    many generations they ran and the cache."""
+    async def run():
+        cache = server.ResponseCache(path=None)
+        started = asyncio.Event()
+        generated = []
+
+        async def leader():
+            started.set()
+            return await leader_generate()
+
+        async def follower():
+            generated.append(True)
+            return {'text': 'own', 'finish_reason': 'stop'}
+
+        leading = asyncio.create_task(cache.get_or_generate('key', leader))
+        await started.wait()
+        following = [asyncio.create_task(cache.get_or_generate('key', follower)) for _ in range(2)]
+        await asyncio.sleep(0)
+        if cancel_leader:
+            leading.cancel()
+        results = await asyncio.wait_for(asyncio.gather(*following), timeout=5)
+        await asyncio.gather(leading, return_exceptions=True)
+        assert cache.stats()['inflight'] == 0
+        return results, len(generated), cache
+    return asyncio.run(run())
+
+
+def test_followers_generate_when_the_leader_is_cancelled(server):
+    async def never_finishes():
+        await asyncio.Event().wait()
+
+    results, generated, cache = coalesce(server, never_finishes, cancel_leader=True)
+    # The first follower takes over and the second shares its result
+    assert results == [({'text': 'own', 'finish_reason': 'stop'}, False), ({'text': 'own', 'finish_reason': 'stop'}, True)]
+    assert generated == 1
+
+
+@pytest.mark.parametrize('finish_reason', ['cancelled', 'timeout'])
+def test_partial_results_are_not_shared(server, finish_reason):
+    async def partial():
+        await asyncio.sleep(0.05)
+        return {'text': 'part', 'finish_reason': finish_reason}
+
+    results, generated, cache = coalesce(server, partial)
+    assert [result for result, cached in results] == [{'text': 'own', 'finish_reason': 'stop'}] * 2
+    assert generated == 1
+    assert cache.get('key') == {'text': 'own', 'finish_reason': 'stop'}
+
+
+def test_streamed_responses_are_cached_off_the_scheduler_thread(server, engine, client, monkeypatch):
+    threads = []
+    put = server.response_cache.put
+    monkeypatch.setattr(server.response_cache, 'put', lambda *args: threads.append(threading.current_thread()) or put(*args))
+    payload = {'message': f'Stream and cache me ({engine["engine"]})', 'max_tokens': 16, 'temperature': 0}
+    streamed = client.post('/chat/stream', json=payload, headers=headers())
+    assert streamed.status_code == 200
+    for _ in range(100):
+        if threads:
+            break
+        time.sleep(0.05)
+    assert threads and threads[0] is not server.scheduler.thread
+    assert client.post('/chat', json=payload, headers=headers()).json()['cached']
+
+
+def test_sessions_belong_to_their_api_key(server, client):
+    load(server)
+    session_id = client.post('/sessions', json={}, headers=headers()).json()['session_id']
+    message = {'message': 'Well done.', 'max_tokens': 4, 'temperature': 0}
+    assert client.get(f'/sessions/{session_id}', headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.post(f'/sessions/{session_id}/messages', json=message, headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.post(f'/sessions/{session_id}/messages/stream', json=message,
+                       headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.delete(f'/sessions/{session_id}', headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.post(f'/sessions/{session_id}/messages', json=message, headers=headers()).status_code == 200
+    assert client.delete(f'/sessions/{session_id}', headers=headers()).status_code == 200
+
+
+def test_jobs_belong_to_their_api_key(server, client):
+    load(server)
+    job = {'type': 'chat', 'request': {'message': 'Well done.', 'max_tokens': 4, 'temperature': 0}}
+    job_id = client.post('/jobs', json=job, headers=headers()).json()['job_id']
+    assert client.get(f'/jobs/{job_id}', headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.get(f'/jobs/{job_id}/result', headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.delete(f'/jobs/{job_id}', headers=headers(OTHER_API_KEY)).status_code == 404
+    assert job_id not in [info['job_id'] for info in client.get('/jobs', headers=headers(OTHER_API_KEY)).json()]
+    assert job_id in [info['job_id'] for info in client.get('/jobs', headers=headers()).json()]
+    assert client.get(f'/jobs/{job_id}', headers=headers()).status_code == 200
+
+
+def test_vector_indexes_belong_to_their_api_key(server, client):
+    items = {'items': [{'id': 'fractions', 'embedding': [1.0, 0.0, 0.0]}, {'id': 'plants', 'embedding': [0.0, 1.0, 0.0]}]}
+    query = {'embedding': [1.0, 0.1, 0.0], 'top_k': 1}
+    assert client.post('/vectors/lessons', json=items, headers=headers()).status_code == 200
+    assert client.get('/vectors/lessons', headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.post('/vectors/lessons/search', json=query, headers=headers(OTHER_API_KEY)).status_code == 404
+    assert client.delete('/vectors/lessons', headers=headers(OTHER_API_KEY)).status_code == 404
+    matches = client.post('/vectors/lessons/search', json=query, headers=headers()).json()['matches']
+    assert [match['id'] for match in matches] == ['fractions']
+    assert client.delete('/vectors/lessons', headers=headers()).status_code == 200
+
+
+def test_fair_queue_serves_interactive_first_and_tenants_in_turn(server):
+    def job(name, tenant, lane='interactive'):
+        return SimpleNamespace(name=name, tenant=server.Tenant(tenant, lane), lane=lane)
+
+    queue = server.FairQueue()
+    for queued in [job('a1', 'a'), job('a2', 'a'), job('a3', 'a'), job('x1', 'x', 'bulk'), job('b1', 'b')]:
+        queue.append(queued)
+    assert len(queue) == 5 and queue.stats() == {'interactive': 4, 'bulk': 1}
+    first, second = queue.pop(), queue.pop()
+    assert [first.name, second.name] == ['a1', 'b1']
+    # Jobs the scheduler couldn't admit go back to the head in their original order
+    queue.push_front([first, second])
+    assert [queue.pop().name for _ in range(3)] == ['a1', 'b1', 'a2']
+    # Interactive-only pops leave the bulk lane alone
+    assert queue.pop(server.LANES[:1]).name == 'a3'
+    assert queue.pop(server.LANES[:1]) is None
+    assert queue.pop().name == 'x1'
+    assert queue.pop() is None and len(queue) == 0
+
+
+def test_rate_limits_charge_tokens_and_set_retry_after(server, client, monkeypatch):
+    tenant = server._api_key_tenant(API_KEY)
+    monkeypatch.setitem(server.config, 'tenants', {'alice': {'tokens_per_minute': 0}})
+    limiter = server.RateLimiter(6, 10)  # 0.1 tokens per second, 10 token burst
+    assert limiter.retry_after(tenant) == 0
+    limiter.charge(tenant, 30)
+    # 20 tokens in debt take 200 seconds to refill
+    assert limiter.retry_after(tenant) in (200, 201)
+    assert limiter._bucket('alice') is None and limiter.retry_after('alice') == 0
+
+    # max_tokens is reserved up front and settled to the tokens actually used
+    job = SimpleNamespace(tenant=server.Tenant('bob'), max_new_tokens=8, future=Future())
+    limiter.reserve(job)
+    assert round(limiter.buckets['bob'].tokens) == 2
+    job.future.set_result({'prompt_tokens': 3, 'completion_tokens': 2})
+    assert round(limiter.buckets['bob'].tokens) == 5
+    assert limiter.stats()['rejected'] == 1
+
+    monkeypatch.setattr(server, 'rate_limiter', limiter)
+    response = client.post('/chat', json={'message': 'Hi'}, headers=headers())
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) in (200, 201)
+    # Other tenants have their own budget
+    assert client.post('/chat', json={'message': 'Hi', 'max_tokens': 2}, headers=headers(OTHER_API_KEY)).status_code == 200
+
+
+def test_memory_governor_defers_clamps_and_rejects(server, monkeypatch):
+    load(server)
+    monkeypatch.setattr(server, '_rss_bytes', lambda: 0)
+    monkeypatch.setattr(server, 'session_store', None)
+    per_token = server._kv_bytes_per_token(server.model.config, server.model.dtype)
+    governor = server.MemoryGovernor(server.model, 100 * per_token, min_new_tokens=32)
+
+    def job(max_new_tokens, prompt_tokens=10):
+        return server.GenerationJob([], max_new_tokens, 0, prompt_ids=list(range(prompt_tokens)))
+
+    first = job(50)
+    assert governor.reserve(first, idle=True)
+    assert governor.reserved_bytes == 60 * per_token
+    # 40 tokens left: too few for a useful answer while other work can still finish
+    second = job(50)
+    assert not governor.reserve(second, idle=False)
+    assert not governor.reserve(second, idle=False)
+    assert governor.deferred == 1 and second.deferred
+    # Enough for min_new_tokens: admitted with a smaller max_tokens
+    third = job(50, prompt_tokens=5)
+    assert governor.reserve(third, idle=False)
+    assert third.max_new_tokens == 35 and governor.clamped == 1
+    first.future.set_result(None)
+    third.future.set_result(None)
+    assert governor.reserved_bytes == 0
+    assert governor.reserve(second, idle=False) and second.max_new_tokens == 50
+    # When idle, waiting can't help: clamp to whatever fits, or fail
+    assert governor.reserve(job(500), idle=True)
+    with pytest.raises(MemoryError):
+        governor.reserve(job(10, prompt_tokens=60), idle=True)
+    assert (governor.clamped, governor.rejected) == (2, 1)
+
+    # With a sliding window a sequence never holds more than max_cached_tokens
+    windowed = server.MemoryGovernor(server.model, 100 * per_token, max_cached_tokens=20)
+    long_job = job(1000)
+    assert windowed.reserve(long_job, idle=False)
+    assert long_job.max_new_tokens == 1000 and windowed.reserved_bytes == 20 * per_token
+
+
+def test_metrics_render_in_prometheus_text_format(server):
+    registry = server.MetricsRegistry()
+    requests = registry.counter('test_requests_total', 'Requests')
+    latency = registry.histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1))
+    requests.inc(finish_reason='stop')
+    requests.inc(2, finish_reason='stop')
+    requests.inc(finish_reason='length')
+    for value in (0.05, 0.5, 5):
+        latency.observe(value, stage='decode')
+    assert registry.render() == textwrap.dedent("""\
+        # HELP test_requests_total Requests
+        # TYPE test_requests_total counter
+        test_requests_total{finish_reason="length"} 1
+        test_requests_total{finish_reason="stop"} 3
+        # HELP test_latency_seconds Latency
+        # TYPE test_latency_seconds histogram
+        test_latency_seconds_bucket{stage="decode",le="0.1"} 1
+        test_latency_seconds_bucket{stage="decode",le="1"} 2
+        test_latency_seconds_bucket{stage="decode",le="+Inf"} 3
+        test_latency_seconds_sum{stage="decode"} 5.55
+        test_latency_seconds_count{stage="decode"} 3
+    """)
+
+
+def scrape(client):
+    """/metrics as {sample name with labels: value}, checking every line parses."""
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.headers['content-type'].startswith('text/plain')
+    samples = {}
+    for line in response.text.splitlines():
+        if line.startswith('# '):
+            assert re.fullmatch(r'# (HELP \w+ .+|TYPE \w+ (counter|gauge|histogram))', line)
+            continue
+        name, value = line.rsplit(' ', 1)
+        assert re.fullmatch(r'\w+(\{\w+="[^"]*"(,\w+="[^"]*")*\})?', name)
+        samples[name] = float(value)
+    return samples
+
+
+def test_metrics_count_finished_requests(server, client):
+    load(server)
+    before = scrape(client)
+    response = client.post('/chat', json={'message': PROMPTS[0], 'max_tokens': 4, 'temperature': 0, 'cache': False},
+                           headers=headers()).json()
+    after = scrape(client)
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    assert delta(f'llm_requests_total{{finish_reason="{response["finish_reason"]}"}}') == 1
+    assert delta('llm_completion_tokens_total') == response['completion_tokens']
+    assert delta('llm_prompt_tokens_total') == response['prompt_tokens']
+    assert delta('llm_request_duration_seconds_count') == 1
+    assert delta('llm_stage_duration_seconds_count{stage="prefill"}') == 1
+    assert after['llm_requests_in_flight'] == 0 and 'llm_queue_depth' in after
+
+
+def test_token_cache_evicts_and_expires(server):
+    cache = server.TokenCache(2, 60)
+    later = time.time() + 3600
+    cache.put('a', 'alice', later)
+    cache.put('b', 'bob', later)
+    assert cache.get('a') == 'alice'
+    cache.put('c', 'carol', later)  # Evicts the least recently used entry, b
+    assert (cache.get('b'), cache.get('a'), cache.get('c')) == (None, 'alice', 'carol')
+    # An entry lasts until the token's expiry or the TTL, whichever is first
+    cache.put('d', 'dave', time.time() - 1)
+    assert cache.get('d') is None
+    assert server.TokenCache(2, 0).get('a') is None
+    assert server.TokenCache(0, 60).entries == {}
+
+
+def test_jwts_without_an_expiry_are_rejected(server, client):
+    def sign(**claims):
+        return {'Authorization': 'Bearer ' + server.jwt.encode(claims, server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)}
+
+    assert client.get('/jobs', headers=sign(sub='alice')).status_code == 401
+    assert client.get('/jobs', headers=sign(sub='alice', exp=int(time.time()) - 60)).status_code == 401
+    valid = sign(sub='alice', exp=int(time.time()) + 60)
+    hits = server.token_cache.hits
+    assert client.get('/jobs', headers=valid).status_code == 200
+    assert client.get('/jobs', headers=valid).status_code == 200
+    assert server.token_cache.hits == hits + 1
+
+
+PERSON = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'age': {'type': 'integer'},
+        'mood': {'enum': ['happy', 'sad']},
+        'tags': {'type': 'array', 'items': {'type': 'string'}, 'minItems': 1, 'maxItems': 2},
+        'nickname': {'type': ['string', 'null']},
+    },
+    'required': ['name', 'mood'],
+    'additionalProperties': False,
+}
+
+JSON_CASES = [
+    ({'type': 'object'}, '{}', True),
+    ({'type': 'object'}, ' {}', False),
+    ({'type': 'object'}, '{"a": {"b": [1, [2.5, -3e10], {"c": null}]}, "d": true}', True),
+    ({'type': 'object'}, '{"a": 01}', False),
+    ({'type': 'object'}, '{"a": 1.}', False),
+    ({'type': 'object'}, '{"a": -}', False),
+    ({'type': 'object'}, '{"a": "tab\\t quote\\" \\u00e9"}', True),
+    ({'type': 'object'}, '{"a": "\\x"}', False),
+    ({'type': 'object'}, '{"a": "\\u00g9"}', False),
+    ({'type': 'object'}, '{"a": "line\nbreak"}', False),
+    ({'type': 'object'}, '{"a": tru}', False),
+    ({'type': 'object'}, '{"a": 1,}', False),
+    ({'type': 'object'}, '{"a": 1} trailing', False),
+    ({'type': 'object'}, '{"a": 1}}', False),
+    (PERSON, '{"name": "Ada", "mood": "happy"}', True),
+    (PERSON, '{"mood": "sad", "name": "Ada", "age": 36, "tags": ["x", "y"], "nickname": null}', True),
+    (PERSON, '{"name": "Ada"}', False),
+    (PERSON, '{"name": "Ada", "mood": "angry"}', False),
+    (PERSON, '{"name": "Ada", "mood": "happy", "extra": 1}', False),
+    (PERSON, '{"name": "Ada", "name": "Bob", "mood": "happy"}', False),
+    (PERSON, '{"name": "Ada", "mood": "happy", "age": 36.5}', False),
+    (PERSON, '{"name": "Ada", "mood": "happy", "age": "36"}', False),
+    (PERSON, '{"name": "Ada", "mood": "happy", "tags": []}', False),
+    (PERSON, '{"name": "Ada", "mood": "happy", "tags": ["x", "y", "z"]}', False),
+    (PERSON, '{"name": "Ada", "mood": "happy", "nickname": "Countess"}', True),
+    (PERSON, '{"name": "Ada", "mood": "happy", "nickname": 1}', False),
+    ({'type': 'object', 'additionalProperties': {'type': 'number'}}, '{"x": 1, "y": -0.5}', True),
+    ({'type': 'object', 'additionalProperties': {'type': 'number'}}, '{"x": "1"}', False),
+]
+
+
+@pytest.mark.parametrize('schema, text, valid', JSON_CASES)
+def test_json_grammar(server, schema, text, valid):
+    # Fed whole and one character per token: both must agree
+    processor = server.JsonLogitsProcessor(schema)
+    state = processor._feed(processor.state, text)
+    assert (state is not None and not state[0]) == valid
+    for char in text:
+        state = processor._feed(processor.state, char)
+        if state is None:
+            break
+        processor.state = state
+    assert (state is not None and processor.done) == valid
+
+
+@pytest.mark.parametrize('schema', [
+    {'type': 'object', 'properties': {'a': {'type': 'date'}}},
+    {'type': 'object', 'properties': {'a': {'type': []}}},
+    {'type': 'object', 'items': {'type': ['string', 'tuple']}},
+])
+def test_unsupported_schema_types_are_rejected_up_front(server, client, schema):
+    response_format = {'type': 'json_schema', 'json_schema': {'schema': schema}}
+    response = client.post('/chat', json={'message': 'Hi', 'response_format': response_format}, headers=headers())
+    assert response.status_code == 400
+    assert 'Unsupported JSON schema type' in response.json()['detail']
+
+
+TRANSCRIPT = ('Teacher: 今天我们学习分数。 Student: 好的！ 🍕 A pizza cut into 8 slices, '
+              'you eat 3 — that is ⅜ of it. Élève: très bien. ') * 6
+
+
+@pytest.mark.parametrize('overlap_tokens', [0, 3])
+def test_transcript_chunks_split_between_characters(server, overlap_tokens):
+    load(server)
+    chunks = server.split_transcript(TRANSCRIPT, 7, overlap_tokens)
+    assert len(chunks) > 10
+    assert not any('\ufffd' in chunk for chunk in chunks)
+    if overlap_tokens == 0:
+        assert ''.join(chunks) == TRANSCRIPT
+    else:
+        # Consecutive chunks overlap, and together they cover the transcript
+        assert TRANSCRIPT.startswith(chunks[0]) and TRANSCRIPT.endswith(chunks[-1])
+        assert all(chunk in TRANSCRIPT for chunk in chunks)
+    assert server.split_transcript('short', 7, 3) == ['short']
+
+
+def test_transcript_analysis_maps_then_reduces(server, client, monkeypatch):
+    prompts = []
+
+    async def generate_text(prompt, max_new_tokens, temperature, jobs, tenant=None):
+        prompts.append(prompt)
+        if 'Findings from part' in prompt:
+            return f'merged {prompt.count("Findings from part")}'
+        return 'fractions'
+
+    monkeypatch.setattr(server, '_generate_text', generate_text)
+    payload = {'transcript': TRANSCRIPT, 'instructions': 'Summarise', 'chunk_tokens': 40, 'overlap_tokens': 5}
+    response = client.post('/analyze/transcript', json=payload, headers=headers())
+    assert response.status_code == 200
+    chunks = server.split_transcript(TRANSCRIPT, 40, 5)
+    assert response.json()['chunks'] == len(chunks) > 2
+    maps = [prompt for prompt in prompts if 'Transcript part' in prompt]
+    reduces = [prompt for prompt in prompts if 'Findings from part' in prompt]
+    assert [prompt.split(':\n', 1)[1] for prompt in maps] == chunks
+    # The findings don't fit one 40-token prompt, so they are merged in groups first
+    assert len(reduces) > 1
+    assert response.json()['response'] == f'merged {reduces[-1].count("Findings from part")}'
+
+    payload['overlap_tokens'] = 40
+    assert client.post('/analyze/transcript', json=payload, headers=headers()).status_code == 400
+
+
+def test_embeddings_take_turns_with_generation(server, client, monkeypatch):
+    load(server)
+    monkeypatch.setitem(server.config, 'embedding_max_tokens', 6)
+    monkeypatch.setitem(server.config, 'embedding_batch_size', 1)
+    threads = []
+    hook = server.model.model.base_model.register_forward_hook(
+        lambda module, args, output: threads.append(threading.current_thread().name))
+    try:
+        job = server.GenerationJob([{'role': 'user', 'content': PROMPTS[0]}], 64, 0)
+        future = server.scheduler.submit(job)
+        texts = [PROMPTS[1] * 4, 'Fractions', PROMPTS[2]]
+        response = client.post('/embeddings', json={'input': texts}, headers=headers())
+        assert future.result(timeout=60)['completion_tokens'] > 0
+    finally:
+        hook.remove()
+    assert response.status_code == 200
+    body = response.json()
+    # Inputs are capped at embedding_max_tokens without touching the shared tokenizer's settings
+    assert body['prompt_tokens'] == sum(min(len(ids), 6) for ids in server.tokenizer(texts).input_ids) < 18
+    assert server.tokenizer.backend_tokenizer.truncation is None
+    assert [round(sum(value * value for value in vector), 4) for vector in body['data']] == [1.0] * 3
+    # Every forward pass, embeddings included, ran on the scheduler thread
+    assert set(threads) == {'inference-scheduler'}
+    assert len(threads) > job.max_new_tokens
+
+
+class Unsatisfiable:
+    """Stands in for JsonLogitsProcessor: masks out every token from its
+    third step on."""
+
+    done = False
+
+    def __init__(self, *args, **kwargs):
+        self.steps = 0
+
+    def __call__(self, input_ids, scores):
+        self.steps += 1
+        return scores if self.steps < 3 else torch.full_like(scores, float('-inf'))
+
+    def advance(self, token):
+        pass
+
+
+@pytest.mark.parametrize('temperature', [0, 0.8])
+def test_a_row_without_valid_tokens_fails_only_its_job(server, engine, monkeypatch, temperature):
+    monkeypatch.setattr(server, 'JsonLogitsProcessor', Unsatisfiable)
+    jobs = [
+        server.GenerationJob([{'role': 'user', 'content': PROMPTS[0]}], 16, temperature),
+        server.GenerationJob([{'role': 'user', 'content': PROMPTS[1]}], 16, temperature, json_schema={'type': 'object'}),
+    ]
+    futures = [server.scheduler.submit(job) for job in jobs]
+    assert futures[0].result(timeout=60)['completion_tokens'] > 0
+    with pytest.raises(RuntimeError, match='No valid next token'):
+        futures[1].result(timeout=60)
+    assert len(jobs[1].output_ids) == 2
+
+
+def test_prefix_cache_stays_within_its_budget(server):
+    # One layer; a 64-token block of keys plus values is 2 * 2 * 64 * 8 * 4 = 8192 bytes
+    layers = [(torch.randn(1, 2, 256, 8), torch.randn(1, 2, 256, 8))]
+    cache = server.PrefixCache(20000, block_size=64)
+    cache.insert(list(range(256)), layers)
+    assert cache.bytes <= cache.max_bytes
+    assert cache.stats()['blocks'] == 2
+    # The leading blocks are kept
+    assert cache.lookup(list(range(256)))[0] == 128
+
+    too_small = server.PrefixCache(8000, block_size=64)
+    too_small.insert(list(range(256)), layers)
+    assert (too_small.bytes, too_small.stats()['blocks']) == (0, 0)
+
+
+def test_health_reports_the_served_models_precision(server, engine, client, model_dirs):
+    assert client.get('/health').json()['precision'] == 'float32'
+    # Loading a draft model doesn't change what is reported for the served one
+    load(server, draft_model_name=model_dirs[1], **engine)
+    try:
+        assert server.model_state['effective_precision'] == server.model.precision == 'float32'
+    finally:
+        load(server, **engine)
+
+
+def test_int8_precision_quantizes_the_linear_layers(server, client):
+    load(server, precision='int8')
+    try:
+        assert not any(type(module) is torch.nn.Linear for module in server.model.model.modules())
+        assert any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in server.model.model.modules())
+        assert server.model.precision == 'int8'
+        assert (server.model_state['precision'], client.get('/health').json()['precision']) == ('int8', 'int8')
+        assert run_jobs(server, PROMPTS[:1], max_new_tokens=4)[0].output_ids
+    finally:
+        load(server)
+
+
+def test_worker_pool_serves_like_one_process(server, engine, model_dirs, tmp_path):
+    expected = [job.text for job in run_jobs(server, PROMPTS, max_new_tokens=8)]
+    texts = run_server_process(tmp_path, model_dirs[0], """
+        server.load_model_sync()
+        jobs = [server.GenerationJob([{'role': 'user', 'content': prompt}], 8, 0) for prompt in %r]
+        futures = [server.scheduler.submit(job) for job in jobs]
+        texts = [future.result(timeout=120)['text'] for future in futures]
+        stats = server.scheduler.stats()
+        server.scheduler.stop()
+        print(json.dumps(texts + [server.model_state['effective_precision'], len(stats['workers'])]))
+    """ % PROMPTS, workers=2, worker_threads=1, **engine)
+    assert texts == expected + ['float32', 2]
+
+
+@pytest.mark.parametrize('endpoint', ['chat', 'stream'])
+def test_benchmark_counts_tokens_on_both_endpoints(client, monkeypatch, endpoint):
+    benchmark = _load_benchmark()
+
+    def http_request(url, payload=None, headers=None, timeout=60):
+        response = client.post(url, json=payload, headers=headers)
+        body = io.BytesIO(response.content)
+        body.status = response.status_code
+        return body
+
+    monkeypatch.setattr(benchmark, 'http_request', http_request)
+    payload = {'message': PROMPTS[0], 'max_tokens': 8, 'temperature': 0, 'cache': False}
+    sample = benchmark.run_request('', endpoint, payload, 60)
+    assert sample['ok'], sample.get('error')
+    assert sample['prompt_tokens'] > 0 and sample['completion_tokens'] > 0
+    assert benchmark.summarise([sample], 1.0)['output_tokens_per_second'] > 0
+
+
+def test_worker_pool_restarts_a_worker_that_dies(model_dirs, tmp_path):
+    failed, restarts, new_pid, outstanding, texts = run_server_process(tmp_path, model_dirs[0], """
+        import os, signal, time
+        server.load_model_sync()
+        pool = server.scheduler
+        job = server.GenerationJob([{'role': 'user', 'content': %r}], 2000, 0)
+        future = pool.submit(job)
+        victim = pool.jobs[0][1]
+        pid = victim['process'].pid
+        os.kill(pid, signal.SIGKILL)
+        try:
+            future.result(timeout=60)
+            error = None
+        except RuntimeError as e:
+            error = str(e)
+        while not victim['ready']:
+            time.sleep(0.1)
+        # Both workers serve again; requests go to the one with the fewest outstanding
+        futures = [pool.submit(server.GenerationJob([{'role': 'user', 'content': prompt}], 64, 0))
+                   for prompt in %r]
+        outstanding = sorted(worker['outstanding'] for worker in pool.workers)
+        texts = [future.result(timeout=120)['text'] for future in futures]
+        pool.stop()
+        print(json.dumps([error == 'Worker {} exited'.format(victim['index']), victim['restarts'],
+                          victim['process'].pid != pid, outstanding, texts]))
+    """ % (PROMPTS[0], PROMPTS[:2]), workers=2, worker_threads=1)
+    # The job on the worker that died fails; the worker is replaced by a new process
+    assert (failed, restarts, new_pid) == (True, 1, True)
+    assert outstanding == [1, 1]
+    assert len(texts) == 2
+
+
+def test_autotune_saves_the_fastest_setting(model_dirs, tmp_path):
+    best, saved = run_server_process(tmp_path, model_dirs[0], """
+        best = server.autotune([1], [1], [1, 2], ['float32', 'bogus'], new_tokens=4, min_tokens_per_second=0)
+        with open(server.CONFIG_FILE) as f:
+            print(json.dumps([best, json.load(f)]))
+    """)
+    # The precision that can't be loaded is skipped
+    assert best['precision'] == 'float32'
+    assert (best['threads'], best['interop_threads']) == (1, 1) and best['batch_size'] in (1, 2)
+    assert best['decode_tokens_per_second'] > 0 and best['prefill_tokens_per_second'] > 0
+    assert {key: saved[key] for key in ('precision', 'torch_threads', 'torch_interop_threads', 'max_batch_size')} == {
+        'precision': best['precision'], 'torch_threads': 1, 'torch_interop_threads': 1,
+        'max_batch_size': best['batch_size']}
+    assert saved['autotune']['decode_tokens_per_second'] == best['decode_tokens_per_second']
+    # The rest of config.json is kept
+    assert saved['api_keys'] == [API_KEY, OTHER_API_KEY]